@@ -0,0 +1,44 @@
+from django.apps import AppConfig
+import threading
+
+_started = False
+_start_lock = threading.Lock()
+
+
+def start():
+    """
+    预热和启动实时索引，在提供搜索服务的进程里调用 (wsgi.py/asgi.py)
+    管理命令、测试、Celery等其他进程不需要调用，重复调用只有第一次有效
+    """
+    global _started
+    from .config import ConfigManager
+    with _start_lock:
+        if _started or ConfigManager is None:
+            return
+        _started = True
+    # 启动时加载分词词典和索引，第一个搜索请求不用再等待
+    if ConfigManager.warm_up:
+        from .indexes import IndexManager
+        from .processer import initialize
+        initialize()
+        index_manager = IndexManager.get_instance()
+        # 开启模糊匹配或者拼音匹配时提前建立词典的辅助索引
+        if ConfigManager.fuzzy_match or ConfigManager.pinyin_match:
+            from .term_index import get_term_index
+            for segment in index_manager.segments:
+                get_term_index(segment)
+    # 开启实时索引时连接model的信号
+    if ConfigManager.live_index:
+        from .live_index import LiveIndexer
+        LiveIndexer.get_instance().connect()
+
+
+class CloverSearchConfig(AppConfig):
+    name = 'cloversearch'
+    verbose_name = 'CloverSearch'
+
+    def ready(self):
+        from .config import ConfigManager
+        # 开启AUTO_START时所有进程在Django启动时都会调用start()
+        if ConfigManager is not None and ConfigManager.auto_start:
+            start()
@@ -0,0 +1,244 @@
+from .config import ConfigManager
+from .indexes import IndexManager
+from .query import SearchQuery, get_shards
+from .segment import SegmentReader, SegmentWriter, VERSION
+from .suggest import Suggester
+import logging
+import numpy as np
+import os
+import random
+import tempfile
+import time
+import tracemalloc
+
+logger = logging.getLogger(ConfigManager.logger_name)
+
+
+class _LegacyIndex:
+    """旧版本加载索引时每个文档的表示：普通对象，keywords 与 clean_data 都是dict"""
+
+    def __init__(self, app_name: str, model_name: str, primary_key, keywords: dict, clean_data: dict):
+        self.app_name = app_name
+        self.model_name = model_name
+        self.primary_key = primary_key
+        self.keywords = keywords
+        self.clean_data = clean_data
+
+
+def _copy_str(value: str) -> str:
+    """旧版本从json读取的每个词都是单独的字符串对象"""
+    return (value + ' ')[:-1]
+
+
+def _build_legacy(segment, doc_ids: list) -> list:
+    """用索引段里的数据还原旧版本的Index对象，词的顺序不同，但是数量一样"""
+    keywords = {doc_id: {field_name: [] for field_name in segment.fields} for doc_id in doc_ids}
+    for word in segment.iter_terms():
+        docs, fields, tfs = segment.get_postings(word)
+        for doc_id, field_id, tf in zip(docs, fields, tfs):
+            if doc_id in keywords:
+                keywords[doc_id][segment.fields[field_id]].extend(_copy_str(word) for _ in range(tf))
+    return [_LegacyIndex(segment.app_name, segment.model_name, segment.get_primary_key(doc_id), keywords[doc_id],
+                         segment.get_clean_data(doc_id)) for doc_id in doc_ids]
+
+
+def _traced(func):
+    """
+    统计函数返回的对象占用的内存
+    :return: (返回值, 字节数)
+    """
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        result = func()
+        size = tracemalloc.get_traced_memory()[0] - before
+    finally:
+        tracemalloc.stop()
+    return result, size
+
+
+def memory_report(sample: int = 10000) -> list:
+    """
+    比较旧版本 (每个文档一个Index对象) 与段文件两种表示的内存占用
+    :param sample: 每个model最多用多少个文档统计旧版本的内存占用，超过的按平均值推算
+    :return: list of dict，每个model一行
+    """
+    index_manager, heap_size = _traced(lambda: _load_index_manager())
+    rows = []
+    for segment in index_manager.segments:
+        doc_ids = [doc_id for doc_id in range(segment.doc_count) if doc_id not in segment.deleted]
+        sample_ids = doc_ids[:sample]
+        legacy, legacy_size = _traced(lambda: _build_legacy(segment, sample_ids))
+        del legacy
+        if len(sample_ids) > 0:
+            legacy_size = legacy_size * len(doc_ids) // len(sample_ids)
+        file_size = os.path.getsize(segment.path) if hasattr(segment, 'path') else 0
+        rows.append({
+            'model': '{}.{}'.format(segment.app_name, segment.model_name),
+            'segment': os.path.basename(segment.path) if hasattr(segment, 'path') else type(segment).__name__,
+            'docs': len(doc_ids),
+            'legacy_bytes': legacy_size,
+            'file_bytes': file_size,
+        })
+    rows.append({
+        'model': 'total',
+        'segment': '',
+        'docs': sum(row['docs'] for row in rows),
+        'legacy_bytes': sum(row['legacy_bytes'] for row in rows),
+        'file_bytes': sum(row['file_bytes'] for row in rows),
+        # 加载索引后Python对象占用的内存，段文件通过mmap读取，由系统页缓存管理，多个进程共享
+        'heap_bytes': heap_size,
+    })
+    return rows
+
+
+def _load_index_manager() -> IndexManager:
+    index_manager = IndexManager()
+    index_manager.load()
+    return index_manager
+
+
+def sample_queries(count: int = 100, seed: int = 0) -> list:
+    """
+    从索引的词典里随机取1~3个词组成搜索词，同样的索引和 seed 得到的搜索词一样
+    :param count: 搜索词数量
+    """
+    terms = set()
+    for segment in IndexManager.get_instance().segments:
+        terms.update(segment.iter_terms())
+    terms = sorted(terms)
+    if len(terms) == 0:
+        return []
+    rand = random.Random(seed)
+    return [''.join(rand.choice(terms) for _ in range(rand.randint(1, 3))) for _ in range(count)]
+
+
+def query_latency(queries: list, shard_counts: list, repeat: int = 3, limit: int = 10, count: bool = True) -> list:
+    """
+    在不同的分片数量下执行同样的搜索，统计每次搜索的延迟，不使用搜索结果缓存
+    :param queries: 搜索词列表
+    :param shard_counts: 要比较的分片数量
+    :param repeat: 每个搜索词执行几次
+    :param limit: 每次搜索返回的结果数量
+    :param count: 是否计算结果总数
+    :return: list of dict，每个分片数量一行，延迟的单位是毫秒
+    """
+    segments = IndexManager.get_instance().segments
+    search_shards = ConfigManager.search_shards
+    rows = []
+    try:
+        for shard_count in shard_counts:
+            ConfigManager.search_shards = shard_count
+            # 预热线程池和分词缓存
+            for raw in queries[:10]:
+                SearchQuery.search(raw, limit=limit, count=count, cache=False)
+            latencies = []
+            for _ in range(repeat):
+                for raw in queries:
+                    start_time = time.perf_counter()
+                    SearchQuery.search(raw, limit=limit, count=count, cache=False)
+                    latencies.append((time.perf_counter() - start_time) * 1000)
+            rows.append({
+                'shards': shard_count,
+                # 分片数量不会超过model数量
+                'effective_shards': len(get_shards(segments, shard_count)),
+                'queries': len(latencies),
+                'p50': float(np.percentile(latencies, 50)) if latencies else 0,
+                'p99': float(np.percentile(latencies, 99)) if latencies else 0,
+                'mean': float(np.mean(latencies)) if latencies else 0,
+            })
+    finally:
+        ConfigManager.search_shards = search_shards
+    return rows
+
+
+def suggest_latency(queries: list, repeat: int = 3, limit: int = None) -> dict:
+    """
+    模拟边输入边提示：每个搜索词的每个前缀查找一次搜索建议，统计每次查找的延迟
+    :param queries: 搜索词列表
+    :param repeat: 每个搜索词执行几次
+    :param limit: 每次返回的搜索建议数量，不指定则使用配置 SUGGEST_SIZE
+    :return: dict，延迟的单位是毫秒
+    """
+    latencies = []
+    for _ in range(repeat):
+        for raw in queries:
+            for n in range(1, len(raw) + 1):
+                start_time = time.perf_counter()
+                Suggester.get_instance().suggest(raw[:n], limit)
+                latencies.append((time.perf_counter() - start_time) * 1000)
+    return {
+        'lookups': len(latencies),
+        'p50': float(np.percentile(latencies, 50)) if latencies else 0,
+        'p99': float(np.percentile(latencies, 99)) if latencies else 0,
+        'mean': float(np.mean(latencies)) if latencies else 0,
+    }
+
+
+def _scan_segment(segment):
+    """读取索引段的所有数据：倒排列表、n-gram 索引、存储字段"""
+    for i, _ in enumerate(segment.iter_term_keys()):
+        segment.get_postings_at(i)
+    for i, _ in enumerate(segment.iter_gram_keys()):
+        segment.get_gram_docs_at(i)
+    for doc_id in range(segment.doc_count):
+        segment.get_clean_data(doc_id)
+
+
+def compression_report(queries: list, repeat: int = 3, limit: int = 10, versions: tuple = (1, VERSION)) -> list:
+    """
+    比较不同版本的段文件：文件大小、加载时间、搜索延迟
+    当前索引的每个索引段分别写成每个版本的段文件保存在临时目录里，搜索时临时替换 IndexManager 的索引段，不使用搜索结果缓存
+    :param queries: 搜索词列表
+    :param repeat: 每个搜索词执行几次
+    :param limit: 每次搜索返回的结果数量
+    :param versions: 要比较的段文件版本，版本1没有压缩
+    :return: list of dict，每个版本一行，时间的单位是毫秒
+    """
+    index_manager = IndexManager.get_instance()
+    reload_interval = ConfigManager.index_reload_interval
+    segments = index_manager.segments
+    rows = []
+    try:
+        # 比较期间不在后台重新加载索引
+        ConfigManager.index_reload_interval = 0
+        with tempfile.TemporaryDirectory(dir=ConfigManager.index_dir) as directory:
+            for version in versions:
+                paths = []
+                for i, segment in enumerate(segments):
+                    path = os.path.join(directory, '{}-{}.v{}'.format(segment.model_name, i, version))
+                    SegmentWriter.merge(segment.app_name, segment.model_name, [segment]).write(path, version=version)
+                    paths.append(path)
+                start_time = time.perf_counter()
+                readers = [SegmentReader(path) for path in paths]
+                open_time = (time.perf_counter() - start_time) * 1000
+                start_time = time.perf_counter()
+                for reader in readers:
+                    _scan_segment(reader)
+                scan_time = (time.perf_counter() - start_time) * 1000
+
+                index_manager.segments = readers
+                for raw in queries[:10]:
+                    SearchQuery.search(raw, limit=limit, cache=False)
+                latencies = []
+                for _ in range(repeat):
+                    for raw in queries:
+                        start_time = time.perf_counter()
+                        SearchQuery.search(raw, limit=limit, cache=False)
+                        latencies.append((time.perf_counter() - start_time) * 1000)
+                rows.append({
+                    'version': version,
+                    'file_bytes': sum(os.path.getsize(path) for path in paths),
+                    'open': open_time,
+                    'scan': scan_time,
+                    'queries': len(latencies),
+                    'p50': float(np.percentile(latencies, 50)) if latencies else 0,
+                    'p99': float(np.percentile(latencies, 99)) if latencies else 0,
+                    'mean': float(np.mean(latencies)) if latencies else 0,
+                })
+                index_manager.segments = segments
+                del readers
+    finally:
+        index_manager.segments = segments
+        ConfigManager.index_reload_interval = reload_interval
+    return rows
@@ -0,0 +1,401 @@
+from .config import ConfigManager
+from .processer import normalize_text, query_segment
+import logging
+import numpy as np
+import re
+
+logger = logging.getLogger(ConfigManager.logger_name)
+
+# 查询语言的词法规则：括号、双引号括起来的短语 (没有结束引号时到末尾为止)、其他连续的非空白字符
+_TOKEN_RE = re.compile(r'\s+|(?P<paren>[()])|(?P<phrase>"[^"]*"?|“[^”]*”?)|(?P<word>[^\s()"“”]+)')
+# 运算符只识别大写，小写的 and/or/not 作为普通的词
+OPERATORS = ('AND', 'OR', 'NOT')
+# 限制model的前缀，例如 model:Post、model:blog.Post
+MODEL_PREFIX = 'model'
+
+_EMPTY = np.zeros(0, dtype=np.int64)
+
+
+class QuerySyntaxError(ValueError):
+    """查询语句语法错误"""
+    pass
+
+
+class SegmentContext:
+    """在一个索引段上执行查询树时使用的数据，倒排列表和候选文档在同一次查询里只读取一次"""
+
+    def __init__(self, segment, control=None):
+        """
+        :param segment: 索引段
+        :param control: QueryControl，控制搜索的截止时间和取消
+        """
+        self.segment = segment
+        self.control = control
+        # key: 词, value: (doc_id数组, 字段下标数组)
+        self._postings = dict()
+        # key: 经过字符过滤的短语, value: doc_id数组
+        self._candidates = dict()
+        self._live_docs = None
+        self._deleted = None
+
+    def expired(self) -> bool:
+        return self.control is not None and self.control.expired()
+
+    def get_postings(self, word: str) -> tuple:
+        if word not in self._postings:
+            docs, fields, tfs = self.segment.get_postings(word)
+            self._postings[word] = (np.asarray(docs, dtype=np.int64), np.asarray(fields, dtype=np.int64))
+        return self._postings[word]
+
+    def get_candidates(self, data: str):
+        """通过 n-gram 索引找出可能包含短语的文档 (已经去掉删除的文档)"""
+        if data not in self._candidates:
+            self._candidates[data] = np.array(self.segment.get_candidates(data), dtype=np.int64)
+        return self._candidates[data]
+
+    def get_field_id(self, field_name: str) -> int or None:
+        try:
+            return self.segment.fields.index(field_name)
+        except ValueError:
+            return None
+
+    def live_docs(self):
+        """没有删除的所有文档"""
+        if self._live_docs is None:
+            self._live_docs = np.setdiff1d(np.arange(self.segment.doc_count, dtype=np.int64), self.deleted_docs(),
+                                           assume_unique=True)
+        return self._live_docs
+
+    def deleted_docs(self):
+        if self._deleted is None:
+            self._deleted = np.array(sorted(self.segment.deleted), dtype=np.int64)
+        return self._deleted
+
+    def remove_deleted(self, doc_ids):
+        if len(self.segment.deleted) == 0:
+            return doc_ids
+        return np.setdiff1d(doc_ids, self.deleted_docs(), assume_unique=True)
+
+
+class Node:
+    """
+    查询树的节点
+    evaluate 返回排好序的 doc_id 数组，candidates 不为 None 时只在这些文档里查找，
+    AND 按 estimate 从小到大执行子节点，前面的结果作为后面的候选文档
+    """
+
+    def estimate(self, context: SegmentContext) -> int:
+        """在这个索引段里最多能匹配多少个文档，为0时整个索引段都不用再检查"""
+        raise NotImplementedError
+
+    def evaluate(self, context: SegmentContext, candidates=None):
+        raise NotImplementedError
+
+    def keywords(self) -> list:
+        """用于计算相关度的关键词，NOT 里的关键词不算"""
+        return []
+
+
+class Term(Node):
+    """词：分词之后的每个关键词都要出现，指定字段时只在这个字段的倒排列表里查找"""
+
+    def __init__(self, text: str, field_name: str = None):
+        self.text = text
+        self.field_name = field_name
+        self.words = list(query_segment(text))
+
+    def __repr__(self):
+        return 'Term({!r}, {!r})'.format(self.text, self.field_name) if self.field_name else 'Term({!r})'.format(self.text)
+
+    def get_docs(self, context: SegmentContext, word: str, field_id: int or None):
+        docs, fields = context.get_postings(word)
+        if field_id is not None:
+            docs = docs[fields == field_id]
+        # 倒排列表按 doc_id 排序，同一个文档的多个字段相邻
+        if len(docs) > 1:
+            docs = docs[np.concatenate(([True], docs[1:] != docs[:-1]))]
+        return docs
+
+    def estimate(self, context: SegmentContext) -> int:
+        if self.field_name is not None and context.get_field_id(self.field_name) is None:
+            return 0
+        return min(len(context.get_postings(word)[0]) for word in self.words)
+
+    def evaluate(self, context: SegmentContext, candidates=None):
+        field_id = None
+        if self.field_name is not None:
+            field_id = context.get_field_id(self.field_name)
+            if field_id is None:
+                return _EMPTY
+        result = candidates
+        # 从最短的倒排列表开始求交集
+        for word in sorted(set(self.words), key=lambda word: len(context.get_postings(word)[0])):
+            docs = self.get_docs(context, word, field_id)
+            result = docs if result is None else np.intersect1d(result, docs, assume_unique=True)
+            if len(result) == 0:
+                return _EMPTY
+        return context.remove_deleted(result)
+
+    def keywords(self) -> list:
+        return list(self.words)
+
+
+class Phrase(Node):
+    """短语：经过字符过滤之后是某个字段的子串，与全匹配相同；指定字段时只检查这个字段"""
+
+    def __init__(self, text: str, field_name: str = None):
+        self.text = text
+        self.field_name = field_name
+        self.data = normalize_text(text)
+
+    def __repr__(self):
+        return 'Phrase({!r}, {!r})'.format(self.text, self.field_name) if self.field_name else 'Phrase({!r})'.format(self.text)
+
+    def estimate(self, context: SegmentContext) -> int:
+        if self.field_name is not None and context.get_field_id(self.field_name) is None:
+            return 0
+        return len(context.get_candidates(self.data))
+
+    def evaluate(self, context: SegmentContext, candidates=None):
+        if self.field_name is not None and context.get_field_id(self.field_name) is None:
+            return _EMPTY
+        doc_ids = context.get_candidates(self.data)
+        if candidates is not None:
+            doc_ids = np.intersect1d(doc_ids, candidates, assume_unique=True)
+        matched = []
+        for doc_id in doc_ids.tolist():
+            if context.expired():
+                break
+            clean_data = context.segment.get_clean_data(doc_id)
+            if self.field_name is not None:
+                if self.data in clean_data.get(self.field_name, ''):
+                    matched.append(doc_id)
+            elif any(self.data in value for value in clean_data.values()):
+                matched.append(doc_id)
+        return np.array(matched, dtype=np.int64)
+
+    def keywords(self) -> list:
+        return list(query_segment(self.text))
+
+
+class ModelFilter(Node):
+    """model:名称，只搜索这个model，可以是 Model名称 或者 app_name.Model名称，不区分大小写"""
+
+    def __init__(self, name: str):
+        self.name = name.lower()
+
+    def __repr__(self):
+        return 'ModelFilter({!r})'.format(self.name)
+
+    def matches(self, segment) -> bool:
+        return segment.matches_model(self.name)
+
+    def estimate(self, context: SegmentContext) -> int:
+        return context.segment.doc_count if self.matches(context.segment) else 0
+
+    def evaluate(self, context: SegmentContext, candidates=None):
+        if not self.matches(context.segment):
+            return _EMPTY
+        return context.live_docs() if candidates is None else candidates
+
+
+class Not(Node):
+    def __init__(self, child: Node):
+        self.child = child
+
+    def __repr__(self):
+        return 'Not({!r})'.format(self.child)
+
+    def estimate(self, context: SegmentContext) -> int:
+        return context.segment.doc_count
+
+    def evaluate(self, context: SegmentContext, candidates=None):
+        base = context.live_docs() if candidates is None else candidates
+        return np.setdiff1d(base, self.child.evaluate(context, base), assume_unique=True)
+
+
+class And(Node):
+    def __init__(self, children: list):
+        self.children = children
+
+    def __repr__(self):
+        return 'And({})'.format(', '.join(repr(child) for child in self.children))
+
+    def estimate(self, context: SegmentContext) -> int:
+        estimates = [child.estimate(context) for child in self.children if not isinstance(child, Not)]
+        return min(estimates) if estimates else context.segment.doc_count
+
+    def evaluate(self, context: SegmentContext, candidates=None):
+        """从匹配文档最少的条件开始执行，结果为空时后面的条件都不用执行，NOT 条件最后从结果里排除"""
+        positives = [child for child in self.children if not isinstance(child, Not)]
+        positives.sort(key=lambda child: child.estimate(context))
+        result = candidates
+        for child in positives:
+            result = child.evaluate(context, result)
+            if len(result) == 0:
+                return _EMPTY
+        if result is None:
+            result = context.live_docs()
+        for child in self.children:
+            if isinstance(child, Not):
+                result = child.evaluate(context, result)
+                if len(result) == 0:
+                    return _EMPTY
+        return result
+
+    def keywords(self) -> list:
+        return [word for child in self.children for word in child.keywords()]
+
+
+class Or(Node):
+    def __init__(self, children: list):
+        self.children = children
+
+    def __repr__(self):
+        return 'Or({})'.format(', '.join(repr(child) for child in self.children))
+
+    def estimate(self, context: SegmentContext) -> int:
+        return min(sum(child.estimate(context) for child in self.children), context.segment.doc_count)
+
+    def evaluate(self, context: SegmentContext, candidates=None):
+        result = _EMPTY
+        for child in self.children:
+            if child.estimate(context) > 0:
+                result = np.union1d(result, child.evaluate(context, candidates))
+        return result
+
+    def keywords(self) -> list:
+        return [word for child in self.children for word in child.keywords()]
+
+
+class _Parser:
+    """
+    递归下降解析，优先级从低到高: OR < AND (相邻的条件默认为 AND) < NOT / -前缀
+    过滤之后没有内容的词和短语 (例如只有标点) 会被忽略
+    """
+
+    def __init__(self, raw: str):
+        self.tokens = tokenize(raw)
+        self.position = 0
+
+    def peek(self) -> tuple or None:
+        return self.tokens[self.position] if self.position < len(self.tokens) else None
+
+    def next(self) -> tuple:
+        token = self.peek()
+        self.position += 1
+        return token
+
+    def parse(self) -> Node or None:
+        node = self.parse_or(None)
+        if self.peek() is not None:
+            raise QuerySyntaxError('多余的 ")"，位置: {}'.format(self.position + 1))
+        return node
+
+    def parse_or(self, field_name: str or None) -> Node or None:
+        children = [self.parse_and(field_name)]
+        while self.peek() == ('word', 'OR'):
+            self.next()
+            children.append(self.parse_and(field_name))
+        children = [child for child in children if child is not None]
+        if len(children) <= 1:
+            return children[0] if children else None
+        return Or(children)
+
+    def parse_and(self, field_name: str or None) -> Node or None:
+        children = []
+        while True:
+            token = self.peek()
+            if token is None or token == ('paren', ')') or token == ('word', 'OR'):
+                break
+            if token == ('word', 'AND'):
+                self.next()
+                continue
+            children.append(self.parse_not(field_name))
+        children = [child for child in children if child is not None]
+        if len(children) <= 1:
+            return children[0] if children else None
+        return And(children)
+
+    def parse_not(self, field_name: str or None) -> Node or None:
+        token = self.peek()
+        if token == ('word', 'NOT'):
+            self.next()
+            if self.peek() is None:
+                raise QuerySyntaxError('NOT 后面缺少条件')
+            child = self.parse_not(field_name)
+            return Not(child) if child is not None else None
+        if token[0] == 'word' and len(token[1]) > 1 and token[1].startswith('-'):
+            # -词 等同于 NOT 词
+            self.tokens[self.position] = ('word', token[1][1:])
+            child = self.parse_atom(field_name)
+            return Not(child) if child is not None else None
+        return self.parse_atom(field_name)
+
+    def parse_atom(self, field_name: str or None) -> Node or None:
+        kind, value = self.next()
+        if kind == 'paren':
+            if value == ')':
+                raise QuerySyntaxError('多余的 ")"，位置: {}'.format(self.position))
+            node = self.parse_or(field_name)
+            if self.next() != ('paren', ')'):
+                raise QuerySyntaxError('缺少 ")"')
+            return node
+        if kind == 'phrase':
+            return _phrase(value, field_name)
+        name, separator, text = value.partition(':')
+        if separator and name:
+            if name.lower() == MODEL_PREFIX:
+                if not text:
+                    raise QuerySyntaxError('model: 后面缺少model名称')
+                return ModelFilter(text)
+            if text:
+                return _term(text, name)
+            # 字段名:"短语" 或者 字段名:(条件)
+            token = self.peek()
+            if token is None:
+                raise QuerySyntaxError('{}: 后面缺少条件'.format(name))
+            if token[0] == 'phrase':
+                self.next()
+                return _phrase(token[1], name)
+            if token == ('paren', '('):
+                return self.parse_atom(name)
+            raise QuerySyntaxError('{}: 后面缺少条件'.format(name))
+        return _term(value, field_name)
+
+
+def _term(text: str, field_name: str or None) -> Term or None:
+    node = Term(text, field_name)
+    return node if node.words else None
+
+
+def _phrase(text: str, field_name: str or None) -> Phrase or None:
+    node = Phrase(text, field_name)
+    return node if node.data else None
+
+
+def tokenize(raw: str) -> list:
+    """
+    切分查询语句
+    :return: [(类型, 内容), ...]，类型为 paren / phrase / word，短语不包括引号
+    """
+    tokens = []
+    for match in _TOKEN_RE.finditer(raw):
+        if match.group('paren'):
+            tokens.append(('paren', match.group('paren')))
+        elif match.group('phrase'):
+            tokens.append(('phrase', match.group('phrase').strip('"“”')))
+        elif match.group('word'):
+            tokens.append(('word', match.group('word')))
+    return tokens
+
+
+def parse_query(raw: str) -> Node or None:
+    """
+    解析查询语句
+    支持 AND / OR / NOT (大写)、-词、括号、"短语"、字段名:词、字段名:"短语"、字段名:(条件)、model:Model名称，
+    相邻的条件之间默认是 AND
+    :return: 查询树，没有任何有效条件时返回 None
+    :raise QuerySyntaxError: 语法错误
+    """
+    return _Parser(raw).parse()
@@ -0,0 +1,147 @@
+from collections import OrderedDict
+from .config import ConfigManager
+import hashlib
+import logging
+import threading
+import time
+
+logger = logging.getLogger(ConfigManager.logger_name)
+
+# 缓存中没有数据时的返回值
+MISSING = object()
+
+
+class QueryCache:
+    """
+    搜索结果缓存，单例模式
+    先在进程内的LRU缓存里查找，配置了 QUERY_CACHE_BACKEND 时再到Django的缓存里查找，多个进程可以共享缓存的结果
+    缓存的key包含索引版本，索引更新之后旧的结果不会再被使用
+    """
+
+    query_cache_instance = None
+
+    def __init__(self, size: int, ttl: float, backend: str or None = None):
+        """
+        :param size: 进程内缓存的最大数量，为0时不缓存
+        :param ttl: 缓存的有效时间 (秒)
+        :param backend: Django缓存名称，不指定则只在进程内缓存
+        """
+        self.size = size
+        self.ttl = ttl
+        self.backend = backend
+        # key: 缓存key, value: (过期时间, 数据)，按使用顺序排列，最近使用的在最后
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        # 最近一次使用的索引版本，版本变化之后清空进程内缓存
+        self.version = None
+        self.hits = 0
+        self.shared_hits = 0
+        self.misses = 0
+
+    @classmethod
+    def get_instance(cls):
+        if cls.query_cache_instance is None:
+            cls.query_cache_instance = QueryCache(ConfigManager.query_cache_size, ConfigManager.query_cache_ttl,
+                                                  ConfigManager.query_cache_backend)
+        return cls.query_cache_instance
+
+    @property
+    def enabled(self) -> bool:
+        return self.size > 0
+
+    @property
+    def stats(self) -> dict:
+        """缓存命中统计"""
+        total = self.hits + self.shared_hits + self.misses
+        return {
+            'hits': self.hits,
+            'shared_hits': self.shared_hits,
+            'misses': self.misses,
+            'hit_rate': (self.hits + self.shared_hits) / total if total > 0 else 0,
+            'size': len(self.entries),
+        }
+
+    def get(self, key: tuple, version: str):
+        """
+        查找缓存
+        :param key: 搜索参数
+        :param version: 索引版本
+        :return: 缓存的数据，没有则返回 MISSING
+        """
+        cache_key = self.make_key(key, version)
+        now = time.time()
+        with self.lock:
+            self.check_version(version)
+            entry = self.entries.get(cache_key)
+            if entry is not None:
+                if entry[0] > now:
+                    self.entries.move_to_end(cache_key)
+                    self.hits += 1
+                    return entry[1]
+                del self.entries[cache_key]
+
+        shared_cache = self.get_shared_cache()
+        if shared_cache is not None:
+            value = shared_cache.get(cache_key, MISSING)
+            if value is not MISSING:
+                self.put(cache_key, version, value, now)
+                with self.lock:
+                    self.shared_hits += 1
+                return value
+
+        with self.lock:
+            self.misses += 1
+        return MISSING
+
+    def set(self, key: tuple, version: str, value):
+        """
+        保存缓存
+        :param key: 搜索参数
+        :param version: 计算结果时的索引版本
+        :param value: 可以pickle的数据
+        """
+        cache_key = self.make_key(key, version)
+        self.put(cache_key, version, value, time.time())
+        shared_cache = self.get_shared_cache()
+        if shared_cache is not None:
+            try:
+                shared_cache.set(cache_key, value, self.ttl)
+            except Exception as e:
+                logger.error(e)
+
+    def put(self, cache_key: str, version: str, value, now: float):
+        with self.lock:
+            self.check_version(version)
+            self.entries[cache_key] = (now + self.ttl, value)
+            self.entries.move_to_end(cache_key)
+            # 超过最大数量时删掉最久没有使用的
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def check_version(self, version: str):
+        """索引版本变化之后旧版本的结果不会再用到，清空进程内缓存"""
+        if version != self.version:
+            self.entries.clear()
+            self.version = version
+
+    def clear(self):
+        """清空进程内缓存和统计"""
+        with self.lock:
+            self.entries.clear()
+            self.hits = self.shared_hits = self.misses = 0
+
+    def get_shared_cache(self):
+        if not self.backend:
+            return None
+        from django.core.cache import caches
+        return caches[self.backend]
+
+    @staticmethod
+    def make_key(key: tuple, version: str) -> str:
+        """Django缓存 (例如memcached) 对key的长度和字符有限制，这里统一用hash"""
+        return 'cloversearch:{}'.format(hashlib.md5('{}|{}'.format(version, repr(key)).encode('utf-8')).hexdigest())
+
+
+def normalize_query(raw: str) -> str:
+    """规范化搜索词：去掉首尾空白，连续的空白合并成一个空格"""
+    return ' '.join(raw.split())
@@ -31,6 +31,73 @@ class _SearchConfig:
         self.__index_dir = index_dir
         # 支持的数据库字段类型
         self.__support_fields_type = ['CharField', 'TextField']
+        # 是否开启实时索引，开启后model保存/删除时自动更新索引
+        self.__live_index = False
+        # 实时索引写入磁盘的间隔 (秒)
+        self.__live_index_flush_interval = 5
+        # 增量建立索引时使用的更新时间字段
+        self.__timestamp_field = 'updated_at'
+        # 单独配置某些model的更新时间字段, key: 'app_name.ModelName', value: 字段名
+        self.__model_timestamp_fields = {}
+        # 建立索引时的内存上限 (MB)，超过之后把数据写入临时段文件，最后再合并
+        self.__build_memory_limit = 512
+        # 词匹配的相关度算法: bm25, tfidf, count (匹配词数量 / 关键词数量)
+        self.__scoring = 'bm25'
+        # BM25 参数，k1 控制词频饱和的速度，b 控制字段长度归一化的程度
+        self.__bm25_k1 = 1.2
+        self.__bm25_b = 0.75
+        # 搜索结果缓存的最大数量，为0时不缓存
+        self.__query_cache_size = 1000
+        # 搜索结果缓存的有效时间 (秒)
+        self.__query_cache_ttl = 300
+        # 共享搜索结果缓存使用的Django缓存名称 (CACHES里的key)，不配置则只在进程内缓存
+        self.__query_cache_backend = None
+        # 启动时预先加载分词词典和索引，不用等到第一次搜索
+        self.__warm_up = True
+        # 在AppConfig.ready()里自动调用cloversearch.apps.start()，关闭时需要在wsgi.py/asgi.py里调用
+        self.__auto_start = False
+        # jieba词典缓存文件，不配置则使用jieba默认的临时目录
+        self.__jieba_cache_file = None
+        # 搜索词分词结果缓存的最大数量
+        self.__segment_cache_size = 10000
+        # 建立索引和全匹配时把全角字符转换为半角，修改之后需要重新建立索引
+        self.__normalize_width = False
+        # 建立索引和全匹配时把英文转换为小写，修改之后需要重新建立索引
+        self.__normalize_case = False
+        # 检查索引文件是否变化的间隔 (秒)，重新建立索引之后不用重启就能使用新的索引，为0时不检查
+        self.__index_reload_interval = 2
+        # 搜索视图每次搜索的时间上限 (秒)，超时返回已经找到的部分结果，为0时不限制
+        self.__query_timeout = 0
+        # 异步搜索 (SearchQuery.aquery/asearch) 使用的线程池大小
+        self.__async_query_workers = 4
+        # 搜索时把索引按model分成几个分片，在线程池里并行搜索，为1时不分片
+        self.__search_shards = 1
+        # 编译好的正则表达式缓存的最大数量
+        self.__regex_cache_size = 256
+        # 每次正则匹配最多检查多少个候选文档，超过之后返回部分结果，为0时不限制
+        self.__regex_max_candidates = 100000
+        # 每次正则匹配的时间上限 (秒)，超时返回部分结果，为0时不限制
+        self.__regex_timeout = 0
+        # 关键词在索引里不存在时，使用编辑距离相近的词匹配 (拼写错误)
+        self.__fuzzy_match = False
+        # 模糊匹配的最大编辑距离 (1或2)
+        self.__fuzzy_max_distance = 2
+        # 模糊匹配的词的权重，编辑距离为2时再乘一次
+        self.__fuzzy_weight = 0.5
+        # 每个关键词最多扩展多少个相近的词
+        self.__fuzzy_max_expansions = 10
+        # 关键词在索引里不存在时，把拼音转换成对应的中文词匹配，需要安装 pypinyin
+        self.__pinyin_match = False
+        # 拼音匹配的词的权重
+        self.__pinyin_weight = 0.8
+        # 搜索建议每次返回的数量，也是短前缀预先计算的结果数量
+        self.__suggest_size = 10
+        # 长度不超过这个值的前缀在建立索引时预先计算好搜索建议
+        self.__suggest_prefix_length = 2
+        # 作为整体加入搜索建议的字段 (例如标题), key: 'app_name.ModelName', value: 字段名列表
+        self.__suggest_fields = {}
+        # 索引段数据 (倒排列表、存储字段) 最多占用的内存 (MB)，超过之后释放最久没有搜索的model，为0时不限制
+        self.__index_memory_limit = 0
 
     @property
     def app_list(self) -> list:
@@ -116,6 +183,278 @@ class _SearchConfig:
     def support_fields_type(self, value: list):
         self.__support_fields_type = value
 
+    @property
+    def live_index(self) -> bool:
+        return self.__live_index
+
+    @live_index.setter
+    def live_index(self, value: bool):
+        self.__live_index = value
+
+    @property
+    def live_index_flush_interval(self) -> float:
+        return self.__live_index_flush_interval
+
+    @live_index_flush_interval.setter
+    def live_index_flush_interval(self, value: float):
+        self.__live_index_flush_interval = value
+
+    @property
+    def timestamp_field(self) -> str:
+        return self.__timestamp_field
+
+    @timestamp_field.setter
+    def timestamp_field(self, value: str):
+        self.__timestamp_field = value
+
+    @property
+    def model_timestamp_fields(self) -> dict:
+        return self.__model_timestamp_fields
+
+    @model_timestamp_fields.setter
+    def model_timestamp_fields(self, value: dict):
+        self.__model_timestamp_fields = value
+
+    @property
+    def build_memory_limit(self) -> int:
+        return self.__build_memory_limit
+
+    @build_memory_limit.setter
+    def build_memory_limit(self, value: int):
+        self.__build_memory_limit = value
+
+    @property
+    def scoring(self) -> str:
+        return self.__scoring
+
+    @scoring.setter
+    def scoring(self, value: str):
+        self.__scoring = value
+
+    @property
+    def bm25_k1(self) -> float:
+        return self.__bm25_k1
+
+    @bm25_k1.setter
+    def bm25_k1(self, value: float):
+        self.__bm25_k1 = value
+
+    @property
+    def bm25_b(self) -> float:
+        return self.__bm25_b
+
+    @bm25_b.setter
+    def bm25_b(self, value: float):
+        self.__bm25_b = value
+
+    @property
+    def query_cache_size(self) -> int:
+        return self.__query_cache_size
+
+    @query_cache_size.setter
+    def query_cache_size(self, value: int):
+        self.__query_cache_size = value
+
+    @property
+    def query_cache_ttl(self) -> float:
+        return self.__query_cache_ttl
+
+    @query_cache_ttl.setter
+    def query_cache_ttl(self, value: float):
+        self.__query_cache_ttl = value
+
+    @property
+    def query_cache_backend(self) -> str or None:
+        return self.__query_cache_backend
+
+    @query_cache_backend.setter
+    def query_cache_backend(self, value: str or None):
+        self.__query_cache_backend = value
+
+    @property
+    def warm_up(self) -> bool:
+        return self.__warm_up
+
+    @warm_up.setter
+    def warm_up(self, value: bool):
+        self.__warm_up = value
+
+    @property
+    def auto_start(self) -> bool:
+        return self.__auto_start
+
+    @auto_start.setter
+    def auto_start(self, value: bool):
+        self.__auto_start = value
+
+    @property
+    def jieba_cache_file(self) -> str or None:
+        return self.__jieba_cache_file
+
+    @jieba_cache_file.setter
+    def jieba_cache_file(self, value: str or None):
+        self.__jieba_cache_file = value
+
+    @property
+    def segment_cache_size(self) -> int:
+        return self.__segment_cache_size
+
+    @segment_cache_size.setter
+    def segment_cache_size(self, value: int):
+        self.__segment_cache_size = value
+
+    @property
+    def normalize_width(self) -> bool:
+        return self.__normalize_width
+
+    @normalize_width.setter
+    def normalize_width(self, value: bool):
+        self.__normalize_width = value
+
+    @property
+    def normalize_case(self) -> bool:
+        return self.__normalize_case
+
+    @normalize_case.setter
+    def normalize_case(self, value: bool):
+        self.__normalize_case = value
+
+    @property
+    def index_reload_interval(self) -> float:
+        return self.__index_reload_interval
+
+    @index_reload_interval.setter
+    def index_reload_interval(self, value: float):
+        self.__index_reload_interval = value
+
+    @property
+    def query_timeout(self) -> float:
+        return self.__query_timeout
+
+    @query_timeout.setter
+    def query_timeout(self, value: float):
+        self.__query_timeout = value
+
+    @property
+    def async_query_workers(self) -> int:
+        return self.__async_query_workers
+
+    @async_query_workers.setter
+    def async_query_workers(self, value: int):
+        self.__async_query_workers = value
+
+    @property
+    def search_shards(self) -> int:
+        return self.__search_shards
+
+    @search_shards.setter
+    def search_shards(self, value: int):
+        self.__search_shards = value
+
+    @property
+    def regex_cache_size(self) -> int:
+        return self.__regex_cache_size
+
+    @regex_cache_size.setter
+    def regex_cache_size(self, value: int):
+        self.__regex_cache_size = value
+
+    @property
+    def regex_max_candidates(self) -> int:
+        return self.__regex_max_candidates
+
+    @regex_max_candidates.setter
+    def regex_max_candidates(self, value: int):
+        self.__regex_max_candidates = value
+
+    @property
+    def regex_timeout(self) -> float:
+        return self.__regex_timeout
+
+    @regex_timeout.setter
+    def regex_timeout(self, value: float):
+        self.__regex_timeout = value
+
+    @property
+    def fuzzy_match(self) -> bool:
+        return self.__fuzzy_match
+
+    @fuzzy_match.setter
+    def fuzzy_match(self, value: bool):
+        self.__fuzzy_match = value
+
+    @property
+    def fuzzy_max_distance(self) -> int:
+        return self.__fuzzy_max_distance
+
+    @fuzzy_max_distance.setter
+    def fuzzy_max_distance(self, value: int):
+        self.__fuzzy_max_distance = value
+
+    @property
+    def fuzzy_weight(self) -> float:
+        return self.__fuzzy_weight
+
+    @fuzzy_weight.setter
+    def fuzzy_weight(self, value: float):
+        self.__fuzzy_weight = value
+
+    @property
+    def fuzzy_max_expansions(self) -> int:
+        return self.__fuzzy_max_expansions
+
+    @fuzzy_max_expansions.setter
+    def fuzzy_max_expansions(self, value: int):
+        self.__fuzzy_max_expansions = value
+
+    @property
+    def pinyin_match(self) -> bool:
+        return self.__pinyin_match
+
+    @pinyin_match.setter
+    def pinyin_match(self, value: bool):
+        self.__pinyin_match = value
+
+    @property
+    def pinyin_weight(self) -> float:
+        return self.__pinyin_weight
+
+    @pinyin_weight.setter
+    def pinyin_weight(self, value: float):
+        self.__pinyin_weight = value
+
+    @property
+    def suggest_size(self) -> int:
+        return self.__suggest_size
+
+    @suggest_size.setter
+    def suggest_size(self, value: int):
+        self.__suggest_size = value
+
+    @property
+    def suggest_prefix_length(self) -> int:
+        return self.__suggest_prefix_length
+
+    @suggest_prefix_length.setter
+    def suggest_prefix_length(self, value: int):
+        self.__suggest_prefix_length = value
+
+    @property
+    def suggest_fields(self) -> dict:
+        return self.__suggest_fields
+
+    @suggest_fields.setter
+    def suggest_fields(self, value: dict):
+        self.__suggest_fields = value
+
+    @property
+    def index_memory_limit(self) -> int:
+        return self.__index_memory_limit
+
+    @index_memory_limit.setter
+    def index_memory_limit(self, value: int):
+        self.__index_memory_limit = value
+
 
 class _ConfigParser:
     @classmethod
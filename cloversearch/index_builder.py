@@ -1,9 +1,17 @@
 from django.apps import apps
+from django.core.exceptions import FieldDoesNotExist
+from django.db.models import Max
+from django.utils.dateparse import parse_date, parse_datetime
+from django.db import connections
 from .config import ConfigManager
 from .indexes import Index, IndexManager
-from .processer import character_filter, character_cn_filter, word_segment
+from .processer import normalize_texts, word_segment, initialize
+from .segment import SEGMENT_SUFFIX, SegmentReader, SegmentWriter, merge_segments
+from .suggest import write_suggest
 import configparser
+import django
 import logging
+import multiprocessing
 import os
 
 logger = logging.getLogger(ConfigManager.logger_name)
@@ -65,50 +73,369 @@ def create_field_config():
         field_config_file.close()
 
 
-def build():
-    for app_name in ConfigManager.app_list:
-        logger.debug("正在建立App:{}的索引".format(app_name))
-        field_config_filepath = os.path.join(ConfigManager.config_dir, app_name + ConfigManager.field_config_filename_suffix)
-        # 打开配置文件
-        cf = configparser.ConfigParser()
-        cf.read(field_config_filepath, encoding=ConfigManager.default_file_encoding)
+def get_field_boost(value: str) -> float:
+    """
+    解析字段索引配置的值，true 为加入索引，false 为不加入索引，数字为加入索引并且设置词匹配的权重
+    :return: 字段权重，不加入索引则为0
+    """
+    value = value.strip().lower()
+    if value == 'true':
+        return 1.0
+    if value == 'false':
+        return 0.0
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        logger.warning('无法解析的字段索引配置: {}'.format(value))
+        return 0.0
+
+
+def read_field_config(app_name: str) -> dict:
+    """
+    读取App的字段索引配置
+    :return: dict, key: Model名称, value: {字段名: 权重}，只包含要加入索引的字段
+    """
+    field_config_filepath = os.path.join(ConfigManager.config_dir, app_name + ConfigManager.field_config_filename_suffix)
+    # 打开配置文件
+    cf = configparser.ConfigParser()
+    cf.read(field_config_filepath, encoding=ConfigManager.default_file_encoding)
+
+    result = {}
+    # 遍历配置文件
+    for section in cf.sections():
+        field_boosts = {}
+        # 读取这个Model类要加入索引的所有字段
+        for field_name, value in cf.items(section):
+            boost = get_field_boost(value)
+            if boost > 0:
+                field_boosts[str(field_name)] = boost
+        result[section] = field_boosts
+    return result
+
+
+def get_index_fields(app_name: str) -> dict:
+    """
+    读取App的字段索引配置
+    :return: dict, key: Model名称, value: 要加入索引的字段列表
+    """
+    result = {}
+    for section, field_boosts in read_field_config(app_name).items():
+        for field_name in field_boosts:
+            logger.debug('{}:{} 加入索引'.format(section, field_name))
+        result[section] = list(field_boosts)
+    return result
+
+
+def create_index(app_name: str, model_name: str, primary_key, data: dict) -> Index:
+    """
+    对一行数据做分词和字符过滤，生成Index
+    :param data: key: 字段名, value: 字段内容
+    :return: Index
+    """
+    index_obj = Index(app_name, model_name, primary_key)
+    # 过滤符号，一行数据的所有字段一起处理
+    clean_data_list = normalize_texts(list(data.values()))
+    for (field_name, content), clean_data in zip(data.items(), clean_data_list):
+        # 处理关键词，分词处理
+        words_list = word_segment(content)
+        index_obj.keywords[field_name] = words_list
+        # logger.debug('{}:{} 分词处理，共{}词'.format(model_name, field_name, len(words_list)))
+        index_obj.clean_data[field_name] = clean_data
+        # logger.debug('{}:{} 数据字符过滤，处理后长度: {}'.format(model_name, field_name, len(clean_data)))
+    return index_obj
+
+
+def get_timestamp_field(app_name: str, model) -> str or None:
+    """获取model用于增量建立索引的更新时间字段，model没有这个字段则返回None"""
+    field_name = ConfigManager.model_timestamp_fields.get('{}.{}'.format(app_name, model.__name__), ConfigManager.timestamp_field)
+    if not field_name:
+        return None
+    try:
+        model._meta.get_field(field_name)
+    except FieldDoesNotExist:
+        return None
+    return field_name
+
+
+def get_max_timestamp(model, field_name: str or None) -> str or None:
+    """获取更新时间字段的最大值 (isoformat)"""
+    if field_name is None:
+        return None
+    value = model.objects.aggregate(value=Max(field_name))['value']
+    return value.isoformat() if value is not None else None
+
+
+def parse_timestamp(value: str):
+    """把 isoformat 的时间转换为 datetime/date"""
+    return parse_datetime(value) or parse_date(value)
+
+
+class ModelIndexBuilder:
+    """
+    流式建立一个model的索引段
+    内存中的数据超过内存上限时先写入临时段文件，最后把所有临时段文件流式合并成一个段文件
+    """
+
+    def __init__(self, app_name: str, model_name: str, memory_limit: int):
+        """
+        :param memory_limit: 内存上限 (字节)，为0时不限制
+        """
+        self.app_name = app_name
+        self.model_name = model_name
+        self.memory_limit = memory_limit
+        self.writer = SegmentWriter(app_name, model_name)
+        # 已经写入磁盘的临时段文件
+        self.parts = []
+
+    def add(self, index_obj: Index):
+        self.writer.add(index_obj.primary_key, index_obj.keywords, index_obj.clean_data)
+        self.check_memory()
+
+    def extend(self, segment: SegmentWriter):
+        self.writer.extend(segment)
+        self.check_memory()
+
+    def check_memory(self):
+        if 0 < self.memory_limit <= self.writer.memory_size:
+            self.flush()
+
+    def flush(self):
+        """把内存中的数据写入临时段文件"""
+        if self.writer.doc_count == 0:
+            return
+        part_file = IndexManager.get_temp_file(self.app_name, self.model_name, '{}.part{}'.format(SEGMENT_SUFFIX, len(self.parts)))
+        self.writer.write(part_file)
+        self.parts.append(part_file)
+        logger.debug('{}:{} 写入临时段文件 {}，{}条数据'.format(self.app_name, self.model_name, part_file, self.writer.doc_count))
+        self.writer = SegmentWriter(self.app_name, self.model_name)
+
+    def finish(self) -> str:
+        """
+        完成建立索引
+        :return: 建立好的段文件 (临时文件)
+        """
+        temp_file = IndexManager.get_temp_file(self.app_name, self.model_name)
+        if len(self.parts) == 0:
+            self.writer.write(temp_file)
+            return temp_file
+        self.flush()
+        segments = [SegmentReader(part_file) for part_file in self.parts]
+        merge_segments(self.app_name, self.model_name, segments, temp_file)
+        del segments
+        for part_file in self.parts:
+            os.remove(part_file)
+        logger.debug('{}:{} 合并{}个临时段文件'.format(self.app_name, self.model_name, len(self.parts)))
+        return temp_file
+
+
+def build_chunk(task: tuple) -> SegmentWriter:
+    """
+    建立一个数据块的索引段，在进程池里执行
+    :param task: (app_name, model_name, 字段列表, 前一个数据块的结束主键, 结束主键)，为None时不限制
+    :return: SegmentWriter
+    """
+    app_name, model_name, index_fields, after_pk, last_pk = task
+    model = apps.get_app_config(app_name).get_model(model_name)
+    writer = SegmentWriter(app_name, model_name)
+    queryset = model.objects.order_by('pk')
+    if after_pk is not None:
+        queryset = queryset.filter(pk__gt=after_pk)
+    if last_pk is not None:
+        queryset = queryset.filter(pk__lte=last_pk)
+    queryset = queryset.values('pk', *index_fields)
+    for row in queryset:
+        index_obj = create_index(app_name, model_name, row['pk'], {field_name: row[field_name] for field_name in index_fields})
+        writer.add(index_obj.primary_key, index_obj.keywords, index_obj.clean_data)
+    return writer
 
-        # 获取App对象
-        app_obj = apps.get_app_config(app_name)
 
-        # 清空原有索引数据
-        IndexManager.get_instance().indexes.clear()
+def chunk_bounds(model, chunk_size: int) -> list:
+    """
+    按主键顺序把数据切分成数据块，每次只查询下一个数据块的结束主键，不需要把全部主键读到内存里
+    :param model: Model类
+    :param chunk_size: 每个数据块的行数
+    :return: [(前一个数据块的结束主键, 结束主键)]，最后一个数据块的结束主键为None
+    """
+    bounds = []
+    primary_keys = model.objects.order_by('pk').values_list('pk', flat=True)
+    after_pk = None
+    while True:
+        window = primary_keys if after_pk is None else primary_keys.filter(pk__gt=after_pk)
+        last_pk = list(window[chunk_size - 1:chunk_size])
+        if not last_pk:
+            if window.exists():
+                bounds.append((after_pk, None))
+            return bounds
+        bounds.append((after_pk, last_pk[0]))
+        after_pk = last_pk[0]
 
-        # 遍历配置文件
-        for section in cf.sections():
-            # 通过Model名称获取Model类
+
+def init_worker():
+    """进程池初始化，非fork方式启动的进程需要重新初始化Django"""
+    django.setup()
+
+
+def build_model(app_name: str, model_name: str, model, index_fields: list, workers: int = 0, pool=None,
+                chunk_size: int = 1000, memory_limit: int = 0) -> str:
+    """
+    建立一个model的索引段
+    单进程时用 iterator 分批读取需要索引的字段；多进程时把数据按主键顺序切分成固定大小的数据块，
+    在进程池里分词和过滤，再按数据块顺序合并。数据块的切分与进程数量无关，所以不管用多少个进程建立的索引都是一样的
+    :param workers: 进程数量，为0时在当前进程里逐行处理
+    :param pool: 进程池，为None时在当前进程里执行
+    :param chunk_size: 每次从数据库读取的行数 / 每个数据块的行数
+    :param memory_limit: 内存上限 (字节)
+    :return: 建立好的段文件 (临时文件)
+    """
+    builder = ModelIndexBuilder(app_name, model_name, memory_limit)
+    if workers > 0:
+        tasks = [(app_name, model_name, index_fields, after_pk, last_pk)
+                 for after_pk, last_pk in chunk_bounds(model, chunk_size)]
+        chunks = pool.imap(build_chunk, tasks) if pool is not None else map(build_chunk, tasks)
+        for chunk in chunks:
+            builder.extend(chunk)
+        logger.debug('{}:{} 共{}个数据块'.format(app_name, model_name, len(tasks)))
+    else:
+        # 从数据库读取待索引数据，只读取需要索引的字段，按主键顺序，和多进程建立的索引一样
+        for row in model.objects.order_by('pk').values('pk', *index_fields).iterator(chunk_size=chunk_size):
+            data = {field_name: row[field_name] for field_name in index_fields}
+            builder.add(create_index(app_name, model_name, row['pk'], data))
+    return builder.finish()
+
+
+def build(workers: int = 0, chunk_size: int = 1000, memory_limit: int = None):
+    """
+    建立索引
+    :param workers: 进程数量，为0时在当前进程里逐行处理
+    :param chunk_size: 每次从数据库读取的行数 / 多进程建立索引时每个数据块的行数
+    :param memory_limit: 内存上限 (MB)，不指定则使用配置
+    """
+    _run(_build, workers, chunk_size, memory_limit)
+
+
+def _run(func, workers: int, chunk_size: int, memory_limit: int or None, *args):
+    """
+    创建进程池并执行建立索引的函数
+    :param func: func(workers, pool, chunk_size, memory_limit, *args)，memory_limit的单位为字节
+    :param memory_limit: 内存上限 (MB)，不指定则使用配置
+    """
+    if memory_limit is None:
+        memory_limit = ConfigManager.build_memory_limit
+    pool = None
+    if workers > 1:
+        # fork之前加载分词词典，子进程不用再各自加载；关闭数据库连接，子进程各自建立连接
+        initialize()
+        connections.close_all()
+        pool = multiprocessing.Pool(workers, initializer=init_worker)
+    try:
+        func(workers, pool, chunk_size, memory_limit * 1024 * 1024, *args)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+
+def _build(workers: int, pool, chunk_size: int, memory_limit: int):
+    index_manager = IndexManager.get_instance()
+    models = [(app_name, model_name) for app_name in ConfigManager.app_list for model_name in get_index_fields(app_name)]
+    # 在新的版本目录里建立索引，全部完成之后再切换，其他进程不会读到建立了一半的索引
+    with index_manager.new_version(models) as path:
+        for app_name in ConfigManager.app_list:
+            _build_app(index_manager, app_name, workers, pool, chunk_size, memory_limit)
+        # 搜索建议使用新版本的全部段文件
+        write_suggest(index_manager.scan_segments(), path)
+
+
+def _build_app(index_manager: IndexManager, app_name: str, workers: int, pool, chunk_size: int, memory_limit: int):
+    logger.debug("正在建立App:{}的索引".format(app_name))
+
+    # 获取App对象
+    app_obj = apps.get_app_config(app_name)
+    index_manager.create_dir(index_manager.get_app_dir(app_name))
+
+    for section, index_fields in get_index_fields(app_name).items():
+        # 通过Model名称获取Model类
+        model = app_obj.get_model(section)
+        _rebuild_model(index_manager, app_name, section, model, index_fields, workers, pool, chunk_size, memory_limit)
+
+
+def _rebuild_model(index_manager: IndexManager, app_name: str, model_name: str, model, index_fields: list,
+                   workers: int, pool, chunk_size: int, memory_limit: int):
+    """重新建立一个model的全部索引，写入当前进程使用的版本目录"""
+    # 建立索引前记录水位线，建立索引期间修改的数据在下次增量建立索引时处理
+    timestamp_field = get_timestamp_field(app_name, model)
+    watermark = get_max_timestamp(model, timestamp_field)
+
+    temp_file = build_model(app_name, model_name, model, index_fields, workers, pool, chunk_size, memory_limit)
+    # 保存索引数据
+    segment_file = index_manager.install_segment(app_name, model_name, temp_file)
+    logger.info('写入索引段文件:{}'.format(segment_file))
+    if watermark is not None:
+        index_manager.write_watermark(app_name, model_name, timestamp_field, watermark)
+
+
+def build_incremental(since=None, workers: int = 0, chunk_size: int = 1000, memory_limit: int = None):
+    """
+    增量建立索引，只处理更新时间字段大于等于水位线的数据，删除的数据通过对比主键集合找出
+    model没有更新时间字段或者还没有水位线的时候，重新建立这个model的全部索引
+    :param since: 指定开始时间 (datetime/date)，不指定则使用上次建立索引时记录的水位线
+    :param workers: 重新建立全部索引时的进程数量，为0时在当前进程里逐行处理
+    :param chunk_size: 每次从数据库读取的行数 / 多进程建立索引时每个数据块的行数
+    :param memory_limit: 内存上限 (MB)，不指定则使用配置
+    """
+    _run(_build_incremental, workers, chunk_size, memory_limit, since)
+
+
+def _build_incremental(workers: int, pool, chunk_size: int, memory_limit: int, since):
+    index_manager = IndexManager.get_instance()
+    models = []
+    rebuild = []
+    for app_name in ConfigManager.app_list:
+        logger.debug("正在增量建立App:{}的索引".format(app_name))
+        app_obj = apps.get_app_config(app_name)
+        index_manager.create_dir(index_manager.get_app_dir(app_name))
+
+        for section, index_fields in get_index_fields(app_name).items():
+            models.append((app_name, section))
             model = app_obj.get_model(section)
-            index_fields = []
-            # 读取这个Model类要加入索引的所有字段
-            for field_name, is_index in cf.items(section):
-                if is_index.lower() == 'true':
-                    index_fields.append(str(field_name))
-                    logger.debug('{}:{} 加入索引'.format(section, field_name))
-
-            # 从数据库读取待索引数据
-            for model_obj in model.objects.all():
-                index_obj = Index(app_name, section, model_obj.pk)
-                for field_name in index_fields:
-                    content = model_obj.__dict__[field_name]
-                    # 处理关键词，分词处理
-                    words_list = word_segment(content)
-                    index_obj.keywords[field_name] = words_list
-                    # logger.debug('{}:{} 分词处理，共{}词'.format(section, field_name, len(words_list)))
-                    # 过滤符号
-                    clean_data = character_filter(content)
-                    clean_data = character_cn_filter(clean_data)
-                    index_obj.clean_data[field_name] = clean_data
-                    # logger.debug('{}:{} 数据字符过滤，处理后长度: {}'.format(section, field_name, len(clean_data)))
-                # 添加到索引管理器的列表中
-                IndexManager.get_instance().add(index_obj)
-
-        # 保存索引数据
-        IndexManager.get_instance().save()
+            timestamp_field = get_timestamp_field(app_name, model)
+            watermark = index_manager.read_watermark(app_name, section)
+            start = since
+            if start is None and watermark is not None and watermark['field'] == timestamp_field:
+                start = parse_timestamp(watermark['value'])
+
+            if timestamp_field is None or start is None:
+                logger.info('{}.{} 没有更新时间字段或水位线，重新建立全部索引'.format(app_name, section))
+                rebuild.append((app_name, section, model, index_fields))
+                continue
+
+            # 增量更新直接写入当前版本的增量段文件，其他进程重新加载之后就能搜索到
+            new_watermark = get_max_timestamp(model, timestamp_field)
+            count = 0
+            queryset = model.objects.filter(**{timestamp_field + '__gte': start}).values('pk', *index_fields)
+            for row in queryset.iterator(chunk_size=chunk_size):
+                data = {field_name: row[field_name] for field_name in index_fields}
+                index_manager.update(create_index(app_name, section, row['pk'], data))
+                count += 1
+            # 只比较主键，找出数据库里已经删除的数据
+            existing = {str(primary_key) for primary_key in model.objects.values_list('pk', flat=True)}
+            deleted = index_manager.get_primary_keys(app_name, section) - existing
+            for primary_key in deleted:
+                index_manager.delete(app_name, section, primary_key)
+            index_manager.flush()
+            logger.info('{}.{} 更新{}条数据，删除{}条数据'.format(app_name, section, count, len(deleted)))
+            if new_watermark is not None:
+                index_manager.write_watermark(app_name, section, timestamp_field, new_watermark)
+
+    if rebuild:
+        # 重新建立全部索引的model和 build_index 一样在新的版本目录里建立，其他model的索引文件从当前版本复制过去
+        with index_manager.new_version(models, copy=True):
+            for app_name, section, model, index_fields in rebuild:
+                index_manager.create_dir(index_manager.get_app_dir(app_name))
+                _rebuild_model(index_manager, app_name, section, model, index_fields, workers, pool, chunk_size, memory_limit)
+
+    index_manager.reload()
+    write_suggest(index_manager.segments)
 
 # if __name__ == '__main__':
 # create_model_config()
@@ -1,37 +1,83 @@
 import time
 
+from contextlib import contextmanager, ExitStack
 from django.apps import apps
 from .config import ConfigManager
+from .segment import SEGMENT_SUFFIX, Segment, SegmentReader, SegmentWriter
+import hashlib
 import logging
+import shutil
+import threading
 import ujson as json
-import copy
 import os
 
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
 logger = logging.getLogger(ConfigManager.logger_name)
 
+# 实时索引的增量段文件，保存建立索引之后新增、修改的文档
+DELTA_SUFFIX = '.delta' + SEGMENT_SUFFIX
+# 实时索引删除、修改过的主键，基础段文件里这些主键的文档不再使用
+DELETED_SUFFIX = SEGMENT_SUFFIX + '.del'
+# 多个进程同时写入增量段文件时使用的文件锁
+LOCK_SUFFIX = '.lock'
+# 增量建立索引的水位线，记录上次建立索引时数据的最大更新时间
+WATERMARK_SUFFIX = '.watermark'
+# 记录当前使用的索引版本目录 (相对于 INDEX_DIR 的路径)，没有这个文件时直接使用 INDEX_DIR (旧版本的目录结构)
+CURRENT_FILE = 'CURRENT'
+# 每次重新建立索引都写入 INDEX_DIR/versions 下的一个新目录
+VERSIONS_DIR = 'versions'
+# 保留的版本目录数量，还没重新加载的进程可以继续使用上一个版本
+KEEP_VERSIONS = 2
+# 正在建立新版本的索引时在当前版本目录里创建这个文件，实时索引写入当前版本时同时记录修改过的主键
+BUILDING_FILE = 'BUILDING'
+# 建立新版本期间实时索引修改过的主键，每次写入追加一行，切换版本之前合并到新版本
+CHANGES_SUFFIX = SEGMENT_SUFFIX + '.changes'
+
 
 class Index:
     """索引类，一个Index对应的就是数据库表里的一行"""
 
-    # App Name
-    app_name = ''
-    # Model类名称
-    model_name = ''
-    # 主键
-    primary_key = 0
-    # 关键词列表, key: field_name, value: keywords list
-    keywords = {}
-    # 处理后的数据, key: field_name, value: 过滤字符后的content
-    clean_data = {}
+    # 搜索时每个结果都会创建Index，使用 __slots__ 减少内存占用
+    __slots__ = ('app_name', 'model_name', 'primary_key', 'keywords', 'segment', 'doc_id', '_clean_data')
+    # model类缓存, key: (app_name, model_name)
+    _model_classes = dict()
 
     def __init__(self, app_name: str, model_name: str, primary_key):
+        # App Name
         self.app_name = app_name
+        # Model类名称
         self.model_name = model_name
+        # 主键
         self.primary_key = primary_key
-        # 不要怀疑，这里再赋值一次是非常有必要的，再复制一次可以在下次调用的使用作为 deepcopy 的新对象获取，而不会保留之前创建对象的旧数据
+        # 关键词列表, key: field_name, value: keywords list
         self.keywords = dict()
-        self.clean_data = dict()
-        self.index_manager = None
+        # 所在的索引段与段内的 doc_id，从索引段读取的Index才有
+        self.segment = None
+        self.doc_id = None
+        self._clean_data = None
+
+    @classmethod
+    def from_segment(cls, segment: Segment, doc_id: int):
+        """从索引段获取Index，clean_data 在用到的时候才读取"""
+        index = cls(segment.app_name, segment.model_name, segment.get_primary_key(doc_id))
+        index.segment = segment
+        index.doc_id = doc_id
+        return index
+
+    @property
+    def clean_data(self) -> dict:
+        """处理后的数据, key: field_name, value: 过滤字符后的content"""
+        if self._clean_data is None:
+            self._clean_data = self.segment.get_clean_data(self.doc_id) if self.segment is not None else dict()
+        return self._clean_data
+
+    @clean_data.setter
+    def clean_data(self, value: dict):
+        self._clean_data = value
 
     @property
     def __id__(self):
@@ -43,13 +89,20 @@ class Index:
 
     def get_model_class(self):
         """获取model类"""
-        try:
-            app_obj = apps.get_app_config(self.app_name)
-            model = app_obj.get_model(self.model_name)
-            return model
-        except Exception as e:
-            logger.error(e)
-            return None
+        return self.find_model_class(self.app_name, self.model_name)
+
+    @classmethod
+    def find_model_class(cls, app_name: str, model_name: str):
+        """通过App名称和Model名称获取model类，结果会缓存起来"""
+        key = (app_name, model_name)
+        if key not in cls._model_classes:
+            try:
+                app_obj = apps.get_app_config(app_name)
+                cls._model_classes[key] = app_obj.get_model(model_name)
+            except Exception as e:
+                logger.error(e)
+                return None
+        return cls._model_classes[key]
 
     def get_model_instance(self):
         """获取对应的model实例"""
@@ -74,22 +127,230 @@ class Index:
 
 
 class IndexManager:
-    # list of index objects
-    indexes = []
+    # 索引段列表，每个model的索引保存在一个段文件里，建立索引时还没保存的数据在 SegmentWriter 里
+    segments = []
+    # 建立索引时使用的 SegmentWriter, key: (app_name, model_name)
+    writers = {}
+    # 实时索引还没写入磁盘的文档, key: (app_name, model_name), value: SegmentWriter
+    pending = {}
+    # 实时索引还没写入磁盘的删除、修改的主键, key: (app_name, model_name), value: 主键集合
+    pending_deleted = {}
     index_manager_instance = None
+    instance_lock = threading.Lock()
+    # 当前进程使用的索引版本目录
+    index_root = None
+
+    def __init__(self):
+        self.segments = list()
+        self.writers = dict()
+        self.pending = dict()
+        self.pending_deleted = dict()
+        # 实时索引更新时加锁，搜索不加锁
+        self.lock = threading.RLock()
+        # 上次检查索引文件是否变化的时间
+        self.checked_time = 0
+        # 在后台重新加载索引的线程
+        self.reload_thread = None
 
     @classmethod
     def get_instance(cls):
         if cls.index_manager_instance is None:
-            cls.index_manager_instance = IndexManager()
-            # 只有在第一次获取实例的时候才加载索引
-            cls.load(cls.index_manager_instance)
+            # 启动时预热和第一个搜索请求可能同时获取实例，只加载一次
+            with cls.instance_lock:
+                if cls.index_manager_instance is None:
+                    index_manager = IndexManager()
+                    # 只有在第一次获取实例的时候才加载索引
+                    cls.load(index_manager)
+                    cls.index_manager_instance = index_manager
         return cls.index_manager_instance
 
+    @property
+    def doc_count(self) -> int:
+        return sum(segment.doc_count for segment in self.segments)
+
+    @property
+    def version(self) -> str:
+        """索引版本，重新建立索引、增量更新、实时索引更新之后都会改变"""
+        return self.get_version(self.segments)
+
+    @classmethod
+    def get_version(cls, segments: list) -> str:
+        """
+        计算索引段列表的版本，段文件相同的进程得到的版本相同，内存中还没写入磁盘的索引段只属于当前进程
+        :return: 版本字符串
+        """
+        parts = []
+        for segment in segments:
+            if isinstance(segment, SegmentReader):
+                parts.append('{}:{}:{}:{}'.format(segment.path, segment.stat.st_ino, segment.stat.st_mtime_ns, segment.stat.st_size))
+            else:
+                parts.append('{}:{}:{}'.format(os.getpid(), id(segment), segment.doc_count))
+            parts.append(str(len(segment.deleted)))
+        return hashlib.md5('|'.join(parts).encode('utf-8')).hexdigest()
+
+    def get_segments(self, models: list = None) -> list:
+        """
+        获取搜索使用的索引段，数据区域超过 INDEX_MEMORY_LIMIT 时先释放最久没有搜索的其他model
+        :param models: 只搜索这些model，可以是 Model名称 或者 app_name.Model名称，不区分大小写，不指定则搜索所有model
+        :return: 索引段列表，其他model的索引段不会被读取
+        """
+        segments = self.segments
+        if models:
+            segments = [segment for segment in segments if any(segment.matches_model(name) for name in models)]
+        self.evict(segments)
+        return segments
+
+    def evict(self, keep: list = ()):
+        """
+        段文件的数据区域 (倒排列表、存储字段) 在第一次搜索这个model时才映射，模糊匹配的辅助索引在第一次使用时建立，
+        占用的内存超过 INDEX_MEMORY_LIMIT 时，按最后使用的时间释放其他model的这些数据，词典仍然保留，再次搜索时重新映射
+        :param keep: 即将使用的索引段，不释放
+        """
+        limit = ConfigManager.index_memory_limit * 1024 * 1024
+        if not limit:
+            return
+        readers = [segment for segment in self.segments if isinstance(segment, SegmentReader) and segment.memory_size > 0]
+        total = sum(segment.memory_size for segment in readers)
+        if total <= limit:
+            return
+        kept = {(segment.app_name, segment.model_name) for segment in keep}
+        # key: (app_name, model_name), value: 这个model已经映射的索引段
+        models = dict()
+        for segment in readers:
+            key = (segment.app_name, segment.model_name)
+            if key not in kept:
+                models.setdefault(key, []).append(segment)
+        for key, group in sorted(models.items(), key=lambda item: max(segment.last_used for segment in item[1])):
+            if total <= limit:
+                break
+            for segment in group:
+                total -= segment.memory_size
+                segment.release()
+            logger.debug('释放索引段数据: {}.{}'.format(*key))
+
+    def iter_indexes(self):
+        """遍历所有索引段里的Index"""
+        for segment in self.segments:
+            for doc_id in range(segment.doc_count):
+                if doc_id not in segment.deleted:
+                    yield Index.from_segment(segment, doc_id)
+
     def add(self, index_obj: Index):
-        # 这里要使用深度复制，才能把一个新的 index_obj 对象添加到index列表中
-        # 如果不这样的话，只能添加 index_obj 的引用地址，结果就是index列表的所有数据都一样了
-        self.indexes.append(copy.deepcopy(index_obj))
+        """把Index加入对应model的索引段，数据会复制到索引段里，index_obj 可以重复使用"""
+        key = (index_obj.app_name, index_obj.model_name)
+        writer = self.writers.get(key)
+        if writer is None:
+            writer = SegmentWriter(index_obj.app_name, index_obj.model_name)
+            self.writers[key] = writer
+            self.segments.append(writer)
+        writer.add(index_obj.primary_key, index_obj.keywords, index_obj.clean_data)
+
+    def add_segment(self, writer: SegmentWriter):
+        """加入一个已经建立好的索引段，save() 时写入段文件"""
+        self.writers[(writer.app_name, writer.model_name)] = writer
+        self.segments.append(writer)
+
+    def clear(self):
+        """清空索引数据"""
+        self.segments.clear()
+        self.writers.clear()
+
+    def install_segment(self, app_name: str, model_name: str, temp_file: str) -> str:
+        """
+        用新建立的段文件替换一个model的索引，重新建立的索引已经包含实时索引的更新，增量数据一起清除
+        :param temp_file: 新建立的段文件
+        :return: 段文件路径
+        """
+        segment_file = self.get_segment_file(app_name, model_name)
+        os.replace(temp_file, segment_file)
+        for suffix in (DELTA_SUFFIX, DELETED_SUFFIX):
+            if os.path.exists(self.get_segment_file(app_name, model_name, suffix)):
+                os.remove(self.get_segment_file(app_name, model_name, suffix))
+        # 改为从文件读取
+        with self.lock:
+            self.segments = [segment for segment in self.segments
+                             if segment.app_name != app_name or segment.model_name != model_name]
+            self.segments.append(SegmentReader(segment_file))
+            self.writers.pop((app_name, model_name), None)
+            self.pending.pop((app_name, model_name), None)
+            self.pending_deleted.pop((app_name, model_name), None)
+        return segment_file
+
+    def get_primary_keys(self, app_name: str, model_name: str) -> set:
+        """获取一个model已经加入索引的主键"""
+        primary_keys = set()
+        for segment in self.segments:
+            if segment.app_name == app_name and segment.model_name == model_name:
+                for doc_id in range(segment.doc_count):
+                    if doc_id not in segment.deleted:
+                        primary_keys.add(segment.get_primary_key(doc_id))
+        return primary_keys
+
+    def update(self, index_obj: Index):
+        """实时索引：添加或更新一个文档，旧的文档标记为删除"""
+        with self.lock:
+            self.delete(index_obj.app_name, index_obj.model_name, index_obj.primary_key)
+            key = (index_obj.app_name, index_obj.model_name)
+            writer = self.pending.get(key)
+            if writer is None:
+                writer = SegmentWriter(index_obj.app_name, index_obj.model_name)
+                self.pending[key] = writer
+                self.segments = self.segments + [writer]
+            writer.add(index_obj.primary_key, index_obj.keywords, index_obj.clean_data)
+
+    def delete(self, app_name: str, model_name: str, primary_key):
+        """实时索引：删除一个文档"""
+        with self.lock:
+            for segment in self.segments:
+                if segment.app_name == app_name and segment.model_name == model_name:
+                    doc_id = segment.get_doc_id(primary_key)
+                    if doc_id is not None:
+                        segment.deleted.add(doc_id)
+            self.pending_deleted.setdefault((app_name, model_name), set()).add(str(primary_key))
+
+    def flush(self):
+        """实时索引：把还没保存的更新写入磁盘"""
+        with self.lock:
+            for app_name, model_name in list(self.pending_deleted):
+                # 重新建立索引之后加载新版本，写入新版本的增量段文件
+                while not self.flush_model(app_name, model_name):
+                    self.reload()
+
+    def flush_model(self, app_name: str, model_name: str) -> bool:
+        """
+        把一个model的更新合并到增量段文件，写入之后重新加载这个model的索引段
+        其他进程写入的更新也会一起加载进来
+        :return: CURRENT 已经指向其他版本时不写入，返回 False
+        """
+        key = (app_name, model_name)
+        self.create_dir(self.get_app_dir(app_name))
+        with self.lock_model(app_name, model_name):
+            # 建立新版本的进程在切换 CURRENT 之前会锁住当前版本的所有model，拿到锁之后 CURRENT 没有变化就可以写入
+            if self.read_current() != self.get_index_root():
+                return False
+            writer = self.pending.pop(key, None)
+            deleted = self.pending_deleted.pop(key, set())
+            segments = []
+            delta_file = self.get_segment_file(app_name, model_name, DELTA_SUFFIX)
+            if os.path.exists(delta_file):
+                delta = SegmentReader(delta_file)
+                self.apply_deleted(delta, deleted)
+                segments.append(delta)
+            if writer is not None:
+                segments.append(writer)
+            self.write_segment(SegmentWriter.merge(app_name, model_name, segments), DELTA_SUFFIX)
+            self.write_deleted(app_name, model_name, self.read_deleted(app_name, model_name) | deleted)
+            if os.path.exists(os.path.join(self.get_index_root(), BUILDING_FILE)):
+                # 正在建立新版本，新版本可能没有包含这些修改
+                changes_file = self.get_segment_file(app_name, model_name, CHANGES_SUFFIX)
+                with open(changes_file, 'a', encoding=ConfigManager.default_file_encoding) as f:
+                    f.write(json.dumps(sorted(deleted), ensure_ascii=False) + '\n')
+        current = [segment for segment in self.segments if segment.app_name == app_name and segment.model_name == model_name]
+        others = [segment for segment in self.segments if segment.app_name != app_name or segment.model_name != model_name]
+        # 替换整个列表，正在搜索的线程继续使用旧的列表
+        self.segments = others + self.load_model(app_name, model_name, current)
+        logger.debug('实时索引写入: {}.{}'.format(app_name, model_name))
+        return True
 
     def load(self):
         # 没有索引文件夹则立即退出！
@@ -98,50 +359,427 @@ class IndexManager:
             return
 
         start_time = time.time()
-        for app_dir in os.listdir(ConfigManager.index_dir):
-            for model_dir in os.listdir(os.path.join(ConfigManager.index_dir, app_dir)):
-                for index_dir in os.listdir(os.path.join(ConfigManager.index_dir, app_dir, model_dir)):
-                    primary_key = index_dir
-                    index = Index(app_dir, model_dir, primary_key)
-                    index_dir = os.path.join(ConfigManager.index_dir, app_dir, model_dir, index_dir)
-                    with open(os.path.join(index_dir, 'clean_data.json'), 'r', encoding=ConfigManager.default_file_encoding) as f:
-                        index.deserialize_clean_data(f.read())
-                    with open(os.path.join(index_dir, 'keywords.json'), 'r', encoding=ConfigManager.default_file_encoding) as f:
-                        index.deserialize_keywords(f.read())
-                    # 添加到index列表
-                    self.indexes.append(index)
+        IndexManager.index_root = self.read_current()
+        self.segments = self.scan_segments()
+        self.checked_time = time.time()
         end_time = time.time()
         used_time = end_time - start_time
         logger.info("Loaded indexes data finished. took={}s".format(used_time))
 
+    def scan_segments(self, current: list = None) -> list:
+        """
+        扫描索引目录，加载所有model的索引段
+        :param current: 当前已经打开的索引段，文件没有变化的就继续使用
+        :return: 索引段列表
+        """
+        current = current or []
+        segments = []
+        index_root = self.get_index_root()
+        for app_dir in sorted(os.listdir(index_root)):
+            app_path = os.path.join(index_root, app_dir)
+            if not os.path.isdir(app_path) or app_dir == VERSIONS_DIR:
+                continue
+            for name in sorted(os.listdir(app_path)):
+                path = os.path.join(app_path, name)
+                if name.endswith(DELTA_SUFFIX):
+                    # 增量段文件与基础段文件一起加载，只有增量没有基础段的时候单独加载
+                    model_name = name[:-len(DELTA_SUFFIX)]
+                    if not os.path.exists(self.get_segment_file(app_dir, model_name)):
+                        segments.extend(self.load_model(app_dir, model_name, current))
+                elif name.endswith(SEGMENT_SUFFIX):
+                    segments.extend(self.load_model(app_dir, name[:-len(SEGMENT_SUFFIX)], current))
+                elif os.path.isdir(path) and not os.path.exists(path + SEGMENT_SUFFIX):
+                    # 旧版本的索引目录，先转换成段文件
+                    self.convert_model(app_dir, name)
+                    segments.extend(self.load_model(app_dir, name))
+        return segments
+
+    def reload(self) -> bool:
+        """
+        重新扫描索引目录，CURRENT 指向新版本时加载新版本的全部段文件，
+        否则只加载增量建立索引或者其他进程写入实时索引之后变化的段文件，没有变化的段文件继续使用；
+        替换整个列表，正在搜索的线程继续使用旧的索引段，旧的段文件在没有引用之后才关闭
+        :return: 索引是否有变化
+        """
+        if not os.path.exists(ConfigManager.index_dir):
+            return False
+        index_root = self.read_current()
+        with self.lock:
+            version = self.version
+            current = self.segments
+            if index_root != self.get_index_root():
+                # 切换到新版本，当前进程还没写入磁盘的实时索引数据可能是建立索引期间的修改，继续保留
+                IndexManager.index_root = index_root
+                current = []
+            segments = self.scan_segments(current)
+            # 当前进程还没写入磁盘的实时索引数据
+            for (app_name, model_name), primary_keys in self.pending_deleted.items():
+                for segment in segments:
+                    if segment.app_name == app_name and segment.model_name == model_name:
+                        self.apply_deleted(segment, primary_keys)
+            segments.extend(self.writers.values())
+            segments.extend(self.pending.values())
+            self.segments = segments
+            self.checked_time = time.time()
+            changed = self.version != version
+        if changed:
+            logger.info('索引已更新，重新加载索引段: {}'.format(index_root))
+        return changed
+
+    def refresh(self):
+        """
+        距离上次检查超过 INDEX_RELOAD_INTERVAL 秒时，在后台线程里检查索引文件是否变化，
+        检查和加载新的段文件时搜索请求继续使用旧的索引段，不需要等待
+        """
+        interval = ConfigManager.index_reload_interval
+        if interval and time.time() - self.checked_time >= interval:
+            self.checked_time = time.time()
+            if self.reload_thread is None or not self.reload_thread.is_alive():
+                self.reload_thread = threading.Thread(target=self.background_reload, name='cloversearch-reload', daemon=True)
+                self.reload_thread.start()
+
+    def background_reload(self):
+        try:
+            self.reload()
+        except Exception as e:
+            logger.error(e)
+
+    @classmethod
+    def read_current(cls) -> str:
+        """
+        读取 CURRENT 文件
+        :return: 当前版本的索引目录，没有 CURRENT 文件时返回 INDEX_DIR
+        """
+        current_file = os.path.join(ConfigManager.index_dir, CURRENT_FILE)
+        try:
+            with open(current_file, 'r', encoding=ConfigManager.default_file_encoding) as f:
+                name = f.read().strip()
+        except OSError:
+            return ConfigManager.index_dir
+        return os.path.join(ConfigManager.index_dir, name) if name else ConfigManager.index_dir
+
+    @classmethod
+    def get_index_root(cls) -> str:
+        """当前进程使用的索引目录，还没加载索引时读取 CURRENT 文件"""
+        if cls.index_root is None:
+            cls.index_root = cls.read_current()
+        return cls.index_root
+
+    @classmethod
+    def get_app_dir(cls, app_name: str, index_root: str = None) -> str:
+        """
+        :param index_root: 索引版本目录，不指定则使用当前进程的版本
+        """
+        return os.path.join(index_root or cls.get_index_root(), app_name)
+
+    @contextmanager
+    def new_version(self, models: list = (), copy: bool = False):
+        """
+        在一个新的版本目录里建立索引，全部完成之后原子地把 CURRENT 指向新目录，
+        建立索引期间其他进程继续使用旧版本；出错时删除新目录，CURRENT 不变
+        其他进程的实时索引在建立期间写入旧版本的修改，在切换之前合并到新版本
+        :param models: 建立索引的model, [(app_name, model_name), ...]
+        :param copy: 先复制当前版本的索引文件，只重新建立部分model时使用
+        :return: 新的版本目录
+        """
+        self.create_dir(ConfigManager.index_dir)
+        self.create_dir(os.path.join(ConfigManager.index_dir, VERSIONS_DIR))
+        index_root = self.get_index_root()
+        building_file = os.path.join(index_root, BUILDING_FILE)
+        open(building_file, 'w').close()
+        # 版本目录按名称排序就是建立的先后顺序，精确到微秒，同一秒内多次建立索引也不会重名
+        now = time.time()
+        name = '{}{:06d}-{}'.format(time.strftime('%Y%m%d%H%M%S', time.localtime(now)), int(now % 1 * 1000000), os.getpid())
+        path = os.path.join(ConfigManager.index_dir, VERSIONS_DIR, name)
+        os.mkdir(path)
+        IndexManager.index_root = path
+        try:
+            if copy:
+                self.copy_version(index_root, path)
+            yield path
+            # 锁住旧版本的所有model，合并修改和切换 CURRENT 之间其他进程不能再写入旧版本
+            with ExitStack() as stack:
+                for app_name, model_name in sorted(models):
+                    self.create_dir(self.get_app_dir(app_name, index_root))
+                    stack.enter_context(self.lock_model(app_name, model_name, index_root))
+                self.replay_changes(index_root, models)
+                self.write_current(path)
+        except BaseException:
+            IndexManager.index_root = index_root
+            shutil.rmtree(path, ignore_errors=True)
+            raise
+        finally:
+            os.remove(building_file)
+            for app_name, model_name in models:
+                changes_file = self.get_segment_file(app_name, model_name, CHANGES_SUFFIX, index_root)
+                if os.path.exists(changes_file):
+                    os.remove(changes_file)
+        self.reload()
+        self.remove_old_versions(path)
+
+    def replay_changes(self, index_root: str, models: list):
+        """
+        把建立新版本期间实时索引写入旧版本的修改合并到新版本：修改、删除过的主键在新版本的基础段里标记为删除，
+        旧版本增量段里这些主键的文档加入新版本的增量段
+        :param index_root: 旧版本的索引目录
+        :param models: [(app_name, model_name), ...]
+        """
+        for app_name, model_name in models:
+            changes_file = self.get_segment_file(app_name, model_name, CHANGES_SUFFIX, index_root)
+            if not os.path.exists(changes_file):
+                continue
+            changed = set()
+            with open(changes_file, 'r', encoding=ConfigManager.default_file_encoding) as f:
+                for line in f:
+                    changed.update(json.loads(line))
+            segments = []
+            delta_file = self.get_segment_file(app_name, model_name, DELTA_SUFFIX)
+            if os.path.exists(delta_file):
+                delta = SegmentReader(delta_file)
+                self.apply_deleted(delta, changed)
+                segments.append(delta)
+            old_delta_file = self.get_segment_file(app_name, model_name, DELTA_SUFFIX, index_root)
+            if os.path.exists(old_delta_file):
+                old_delta = SegmentReader(old_delta_file)
+                # 只使用修改过的主键的文档，其他文档已经包含在新版本里
+                old_delta.deleted.update(doc_id for doc_id in range(old_delta.doc_count)
+                                         if old_delta.get_primary_key(doc_id) not in changed)
+                segments.append(old_delta)
+            self.create_dir(self.get_app_dir(app_name))
+            self.write_segment(SegmentWriter.merge(app_name, model_name, segments), DELTA_SUFFIX)
+            self.write_deleted(app_name, model_name, self.read_deleted(app_name, model_name) | changed)
+            logger.info('合并建立索引期间的实时索引修改: {}.{} {}条数据'.format(app_name, model_name, len(changed)))
+
+    @classmethod
+    def copy_version(cls, index_root: str, path: str):
+        """
+        把一个版本的索引文件复制到新的版本目录，段文件只会整体替换，使用硬链接，不支持时复制
+        锁文件、临时文件和实时索引的修改记录不复制
+        """
+        for app_dir in os.listdir(index_root):
+            app_path = os.path.join(index_root, app_dir)
+            if not os.path.isdir(app_path) or app_dir == VERSIONS_DIR:
+                # 版本目录里的其他文件，例如搜索建议数据
+                if os.path.isfile(app_path) and app_dir not in (CURRENT_FILE, BUILDING_FILE) and not app_dir.endswith('.tmp'):
+                    shutil.copyfile(app_path, os.path.join(path, app_dir))
+                continue
+            cls.create_dir(os.path.join(path, app_dir))
+            for name in os.listdir(app_path):
+                source = os.path.join(app_path, name)
+                target = os.path.join(path, app_dir, name)
+                if not os.path.isfile(source) or name.endswith((LOCK_SUFFIX, CHANGES_SUFFIX, '.tmp')):
+                    continue
+                if name.endswith(SEGMENT_SUFFIX):
+                    try:
+                        os.link(source, target)
+                        continue
+                    except OSError:
+                        pass
+                shutil.copyfile(source, target)
+
+    def switch_version(self, path: str):
+        """
+        把 CURRENT 指向新的版本目录并重新加载，比新版本更早的版本目录只保留 KEEP_VERSIONS - 1 个
+        """
+        self.write_current(path)
+        self.reload()
+        self.remove_old_versions(path)
+
+    @classmethod
+    def write_current(cls, path: str):
+        """把 CURRENT 指向新的版本目录，先写临时文件再替换，读取 CURRENT 的进程只会看到旧版本或者新版本"""
+        current_file = os.path.join(ConfigManager.index_dir, CURRENT_FILE)
+        temp_file = '{}.{}.tmp'.format(current_file, os.getpid())
+        with open(temp_file, 'w', encoding=ConfigManager.default_file_encoding) as f:
+            f.write(os.path.relpath(path, ConfigManager.index_dir).replace(os.sep, '/'))
+        os.replace(temp_file, current_file)
+        logger.info('切换索引版本: {}'.format(path))
+
+    @classmethod
+    def remove_old_versions(cls, path: str):
+        """
+        删除比 path 更早的版本目录，只保留 KEEP_VERSIONS - 1 个
+        已经打开的段文件在删除之后仍然可以读取，还没重新加载的进程不受影响
+        """
+        versions_dir = os.path.join(ConfigManager.index_dir, VERSIONS_DIR)
+        name = os.path.basename(path)
+        older = sorted(version for version in os.listdir(versions_dir) if version < name)
+        for version in older[:max(len(older) - KEEP_VERSIONS + 1, 0)]:
+            shutil.rmtree(os.path.join(versions_dir, version), ignore_errors=True)
+            logger.debug('删除旧版本索引目录：{}'.format(version))
+
     def save(self):
         # 建立各个app的文件夹
         for app_name in ConfigManager.app_list:
-            app_dir = os.path.join(ConfigManager.index_dir, app_name)
-            self.create_dir(app_dir)
+            self.create_dir(self.get_app_dir(app_name))
 
         start_time = time.time()
-        for item in self.indexes:
-            # 检查相关文件夹是否建立
-            model_dir = os.path.join(ConfigManager.index_dir, item.app_name, item.model_name)
-            self.create_dir(model_dir)
-            index_dir = os.path.join(model_dir, str(item.primary_key))
-            self.create_dir(index_dir)
-            # 写入数据
-            clean_data_file = os.path.join(index_dir, 'clean_data.json')
-            keywords_file = os.path.join(index_dir, 'keywords.json')
-            with open(clean_data_file, 'w', encoding='utf-8') as f:
-                f.write(item.serialize_clean_data())
-                logger.debug('写入索引数据文件:{}'.format(clean_data_file))
-            with open(keywords_file, 'w', encoding='utf-8') as f:
-                f.write(item.serialize_keywords())
-                logger.debug('写入索引数据文件:{}'.format(keywords_file))
+        for key, writer in list(self.writers.items()):
+            app_name, model_name = key
+            self.create_dir(self.get_app_dir(app_name))
+            temp_file = self.get_temp_file(app_name, model_name)
+            writer.write(temp_file)
+            segment_file = self.install_segment(app_name, model_name, temp_file)
+            logger.debug('写入索引段文件:{}'.format(segment_file))
+        self.writers.clear()
         end_time = time.time()
         used_time = end_time - start_time
-        logger.info("Loaded indexes data finished. took={}s".format(used_time))
+        logger.info("Saved indexes data finished. took={}s".format(used_time))
+
+    def load_model(self, app_name: str, model_name: str, current: list = None) -> list:
+        """
+        加载一个model的基础段与增量段，并标记已删除的文档
+        :param current: 当前已经打开的索引段，文件没有变化的就继续使用
+        :return: 索引段列表
+        """
+        current = current or []
+        segments = []
+        for suffix in (SEGMENT_SUFFIX, DELTA_SUFFIX):
+            segment_file = self.get_segment_file(app_name, model_name, suffix)
+            if not os.path.exists(segment_file):
+                continue
+            stat = os.stat(segment_file)
+            for segment in current:
+                if isinstance(segment, SegmentReader) and segment.path == segment_file and segment.is_same_file(stat):
+                    break
+            else:
+                segment = SegmentReader(segment_file)
+            segments.append(segment)
+        if segments and segments[0].path == self.get_segment_file(app_name, model_name):
+            self.apply_deleted(segments[0], self.read_deleted(app_name, model_name))
+        return segments
+
+    @classmethod
+    def apply_deleted(cls, segment: Segment, primary_keys: set):
+        """把这些主键对应的文档标记为删除"""
+        for primary_key in primary_keys:
+            doc_id = segment.get_doc_id(primary_key)
+            if doc_id is not None:
+                segment.deleted.add(doc_id)
+
+    @classmethod
+    def read_deleted(cls, app_name: str, model_name: str) -> set:
+        """读取基础段文件里已删除、修改过的主键"""
+        deleted_file = cls.get_segment_file(app_name, model_name, DELETED_SUFFIX)
+        if not os.path.exists(deleted_file):
+            return set()
+        with open(deleted_file, 'r', encoding=ConfigManager.default_file_encoding) as f:
+            return set(json.loads(f.read()))
+
+    @classmethod
+    def write_deleted(cls, app_name: str, model_name: str, primary_keys: set):
+        deleted_file = cls.get_segment_file(app_name, model_name, DELETED_SUFFIX)
+        temp_file = '{}.{}.tmp'.format(deleted_file, os.getpid())
+        with open(temp_file, 'w', encoding=ConfigManager.default_file_encoding) as f:
+            f.write(json.dumps(sorted(primary_keys), ensure_ascii=False))
+        os.replace(temp_file, deleted_file)
+
+    @classmethod
+    def read_watermark(cls, app_name: str, model_name: str) -> dict or None:
+        """
+        读取水位线
+        :return: {'field': 更新时间字段, 'value': 最大更新时间 (isoformat)}，没有则返回None
+        """
+        watermark_file = cls.get_segment_file(app_name, model_name, WATERMARK_SUFFIX)
+        if not os.path.exists(watermark_file):
+            return None
+        with open(watermark_file, 'r', encoding=ConfigManager.default_file_encoding) as f:
+            return json.loads(f.read())
+
+    @classmethod
+    def write_watermark(cls, app_name: str, model_name: str, field_name: str, value: str):
+        cls.create_dir(cls.get_app_dir(app_name))
+        watermark_file = cls.get_segment_file(app_name, model_name, WATERMARK_SUFFIX)
+        with open(watermark_file, 'w', encoding=ConfigManager.default_file_encoding) as f:
+            f.write(json.dumps({'field': field_name, 'value': value}, ensure_ascii=False))
+
+    @classmethod
+    @contextmanager
+    def lock_model(cls, app_name: str, model_name: str, index_root: str = None):
+        """给一个model的索引文件加锁，不支持 fcntl 的系统上不加锁"""
+        with open(cls.get_segment_file(app_name, model_name, LOCK_SUFFIX, index_root), 'w') as f:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+
+    @classmethod
+    def get_segment_file(cls, app_name: str, model_name: str, suffix: str = SEGMENT_SUFFIX, index_root: str = None) -> str:
+        return os.path.join(cls.get_app_dir(app_name, index_root), model_name + suffix)
+
+    @classmethod
+    def get_temp_file(cls, app_name: str, model_name: str, suffix: str = SEGMENT_SUFFIX) -> str:
+        """建立索引时使用的临时文件，写完之后再替换正式文件"""
+        return '{}.{}.tmp'.format(cls.get_segment_file(app_name, model_name, suffix), os.getpid())
+
+    @classmethod
+    def write_segment(cls, writer: SegmentWriter, suffix: str = SEGMENT_SUFFIX) -> str:
+        """
+        写入段文件，先写临时文件再替换，正在读取旧文件的进程不受影响
+        :return: 段文件路径
+        """
+        segment_file = cls.get_segment_file(writer.app_name, writer.model_name, suffix)
+        temp_file = cls.get_temp_file(writer.app_name, writer.model_name, suffix)
+        writer.write(temp_file)
+        os.replace(temp_file, segment_file)
+        return segment_file
+
+    @classmethod
+    def convert_model(cls, app_name: str, model_name: str) -> str:
+        """
+        把旧版本的索引目录 (app/model/主键/*.json) 转换成段文件，旧目录保留不删除
+        :return: 段文件路径
+        """
+        model_path = os.path.join(cls.get_app_dir(app_name), model_name)
+        logger.info('转换旧版本索引目录:{}'.format(model_path))
+        writer = SegmentWriter(app_name, model_name)
+        for primary_key in sorted(os.listdir(model_path)):
+            index_dir = os.path.join(model_path, primary_key)
+            if not os.path.isdir(index_dir):
+                continue
+            index = Index(app_name, model_name, primary_key)
+            with open(os.path.join(index_dir, 'clean_data.json'), 'r', encoding=ConfigManager.default_file_encoding) as f:
+                index.deserialize_clean_data(f.read())
+            with open(os.path.join(index_dir, 'keywords.json'), 'r', encoding=ConfigManager.default_file_encoding) as f:
+                index.deserialize_keywords(f.read())
+            writer.add(index.primary_key, index.keywords, index.clean_data)
+        return cls.write_segment(writer)
+
+    @classmethod
+    def convert(cls) -> list:
+        """
+        转换 INDEX_DIR 里所有旧版本的索引目录
+        :return: 生成的段文件路径列表
+        """
+        segment_files = []
+        index_root = cls.get_index_root()
+        for app_dir in sorted(os.listdir(index_root)):
+            app_path = os.path.join(index_root, app_dir)
+            if not os.path.isdir(app_path) or app_dir == VERSIONS_DIR:
+                continue
+            for name in sorted(os.listdir(app_path)):
+                if os.path.isdir(os.path.join(app_path, name)):
+                    segment_files.append(cls.convert_model(app_dir, name))
+        return segment_files
 
     @classmethod
     def create_dir(cls, path):
         if not os.path.exists(path):
             os.mkdir(path)
             logger.debug('建立文件夹：{}'.format(path))
+
+
+def _after_fork():
+    """fork之后子进程只有当前线程，父进程里其他线程持有的锁需要重新创建"""
+    IndexManager.instance_lock = threading.Lock()
+    if IndexManager.index_manager_instance is not None:
+        IndexManager.index_manager_instance.lock = threading.RLock()
+        IndexManager.index_manager_instance.reload_thread = None
+
+
+# 在master进程加载索引 (例如gunicorn --preload) 之后fork出的worker直接使用已经映射的段文件
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_after_fork)
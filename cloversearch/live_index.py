@@ -0,0 +1,141 @@
+from django.apps import apps
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete
+from .config import ConfigManager
+from .index_builder import get_index_fields, create_index
+from .indexes import IndexManager
+import atexit
+import configparser
+import logging
+import os
+import threading
+
+logger = logging.getLogger(ConfigManager.logger_name)
+
+# 保存的实例有延迟加载 (defer/only) 的索引字段，后台线程处理时从数据库重新读取
+RELOAD = object()
+
+
+class LiveIndexer:
+    """
+    实时索引，单例模式
+    监听开启索引的model的 post_save/post_delete 信号，信号处理只记录变化的数据，
+    分词、更新索引和写入磁盘都在后台线程里批量完成，不会拖慢请求处理
+    """
+
+    live_indexer_instance = None
+
+    def __init__(self, flush_interval: float):
+        self.flush_interval = flush_interval
+        # 要加入索引的字段, key: model类, value: (app_name, model_name, 字段列表)
+        self.models = dict()
+        # 等待处理的数据, key: (app_name, model_name, 主键), value: 字段数据，删除则为 None，需要重新读取则为 RELOAD
+        self.queue = dict()
+        self.queue_lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = None
+
+    @classmethod
+    def get_instance(cls):
+        if cls.live_indexer_instance is None:
+            cls.live_indexer_instance = LiveIndexer(ConfigManager.live_index_flush_interval)
+        return cls.live_indexer_instance
+
+    def connect(self):
+        """连接所有开启索引的model的信号，启动后台线程"""
+        model_cf = configparser.ConfigParser()
+        model_cf.read(ConfigManager.model_index_config_file, encoding=ConfigManager.default_file_encoding)
+        for app_name in ConfigManager.app_list:
+            app_obj = apps.get_app_config(app_name)
+            for model_name, index_fields in get_index_fields(app_name).items():
+                if not model_cf.getboolean(app_name, model_name, fallback=True) or len(index_fields) == 0:
+                    continue
+                model = app_obj.get_model(model_name)
+                self.models[model] = (app_name, model_name, index_fields)
+                post_save.connect(self.on_save, sender=model, dispatch_uid='cloversearch_save_{}'.format(model._meta.label))
+                post_delete.connect(self.on_delete, sender=model, dispatch_uid='cloversearch_delete_{}'.format(model._meta.label))
+                logger.debug('实时索引: {}.{}'.format(app_name, model_name))
+
+        if self.thread is None:
+            self.start()
+            atexit.register(self.stop)
+            # gunicorn/uwsgi 在master进程加载应用之后fork出的worker里没有后台线程，需要重新启动
+            if hasattr(os, 'register_at_fork'):
+                os.register_at_fork(after_in_child=self.after_fork)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name='cloversearch-live-index', daemon=True)
+        self.thread.start()
+
+    def after_fork(self):
+        """fork之后子进程只有当前线程，父进程里还没处理的数据由父进程处理"""
+        self.queue = dict()
+        self.queue_lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.start()
+
+    def on_save(self, sender, instance, **kwargs):
+        # 索引出错只记录日志，不能影响调用方的 save()
+        try:
+            app_name, model_name, index_fields = self.models[sender]
+            primary_key = instance.pk
+            if instance.get_deferred_fields().intersection(index_fields):
+                # 没有加载的字段不能从实例里读取，访问时还会再查询一次数据库
+                data = RELOAD
+            else:
+                data = {field_name: getattr(instance, field_name) for field_name in index_fields}
+            # 事务提交之后再更新索引，回滚的数据不会进入索引
+            transaction.on_commit(lambda: self.enqueue(app_name, model_name, primary_key, data))
+        except Exception as e:
+            logger.error('实时索引处理保存信号失败: {}'.format(e))
+
+    def on_delete(self, sender, instance, **kwargs):
+        try:
+            app_name, model_name, index_fields = self.models[sender]
+            primary_key = instance.pk
+            transaction.on_commit(lambda: self.enqueue(app_name, model_name, primary_key, None))
+        except Exception as e:
+            logger.error('实时索引处理删除信号失败: {}'.format(e))
+
+    def enqueue(self, app_name: str, model_name: str, primary_key, data: dict or None):
+        """同一行数据多次变化只保留最后一次"""
+        with self.queue_lock:
+            self.queue[(app_name, model_name, primary_key)] = data
+
+    def load_row(self, app_name: str, model_name: str, primary_key) -> dict or None:
+        """从数据库读取一行数据的索引字段，已经删除则返回 None"""
+        model = apps.get_model(app_name, model_name)
+        index_fields = self.models[model][2]
+        return model.objects.filter(pk=primary_key).values(*index_fields).first()
+
+    def run(self):
+        while not self.stopped.wait(self.flush_interval):
+            self.process()
+
+    def stop(self):
+        """停止后台线程，处理剩下的数据"""
+        self.stopped.set()
+        self.process()
+
+    def process(self):
+        """处理等待中的数据，更新内存中的索引并写入磁盘"""
+        with self.queue_lock:
+            queue, self.queue = self.queue, dict()
+        if len(queue) == 0:
+            return
+        index_manager = IndexManager.get_instance()
+        for (app_name, model_name, primary_key), data in queue.items():
+            try:
+                if data is RELOAD:
+                    data = self.load_row(app_name, model_name, primary_key)
+                if data is None:
+                    index_manager.delete(app_name, model_name, primary_key)
+                else:
+                    index_manager.update(create_index(app_name, model_name, primary_key, data))
+            except Exception as e:
+                logger.error(e)
+        try:
+            index_manager.flush()
+        except Exception as e:
+            logger.error(e)
+        logger.info('实时索引更新{}条数据'.format(len(queue)))
@@ -7,10 +7,30 @@ import time
 class Command(BaseCommand):
     help = '{}: build search index from model and field configs.'.format(config.MODULE_NAME)
 
+    def add_arguments(self, parser):
+        parser.add_argument('--since', nargs='?', const='', default=None,
+                            help='incremental build: only index rows updated since this time '
+                                 '(isoformat), or since the last recorded watermark if no time is given.')
+        parser.add_argument('--workers', type=int, default=0,
+                            help='segment rows in a pool of N processes, chunked by primary key.')
+        parser.add_argument('--chunk-size', type=int, default=1000,
+                            help='rows fetched per database round trip, or rows per chunk when building with --workers.')
+        parser.add_argument('--memory-limit', type=int, default=None,
+                            help='memory limit in MB, segments are flushed to disk and merged when it is exceeded.')
+
     def handle(self, *args, **options):
+        since = options['since']
+        if since:
+            since = index_builder.parse_timestamp(since)
+            if since is None:
+                raise CommandError('invalid --since value: {}'.format(options['since']))
         try:
             start_time = time.time()
-            index_builder.build()
+            if since is None:
+                index_builder.build(options['workers'], options['chunk_size'], options['memory_limit'])
+            else:
+                index_builder.build_incremental(since or None, options['workers'], options['chunk_size'],
+                                                options['memory_limit'])
             end_time = time.time()
             took_time = end_time - start_time
         except Exception as e:
@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand, CommandError
+from ...indexes import IndexManager
+from ... import config
+import time
+
+
+class Command(BaseCommand):
+    help = '{}: convert index directories of older versions to segment files.'.format(config.MODULE_NAME)
+
+    def handle(self, *args, **options):
+        try:
+            start_time = time.time()
+            segment_files = IndexManager.convert()
+            end_time = time.time()
+            took_time = end_time - start_time
+        except Exception as e:
+            raise CommandError(e)
+        else:
+            self.stdout.write(self.style.SUCCESS('convert index finished. {} segment files. Took {} seconds.'.format(len(segment_files), took_time)))
@@ -0,0 +1,30 @@
+from django.core.management.base import BaseCommand, CommandError
+from ... import benchmark
+from ... import config
+
+
+def _format_size(size: int) -> str:
+    return '{:.2f} MB'.format(size / 1024 / 1024)
+
+
+class Command(BaseCommand):
+    help = '{}: compare the memory footprint of the legacy per-document index objects ' \
+           'with the mmap-backed segment files.'.format(config.MODULE_NAME)
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sample', type=int, default=10000,
+                            help='documents per segment used to measure the legacy representation, larger segments are extrapolated.')
+
+    def handle(self, *args, **options):
+        try:
+            rows = benchmark.memory_report(options['sample'])
+        except Exception as e:
+            raise CommandError(e)
+        self.stdout.write('{:<30} {:<24} {:>10} {:>16} {:>16}'.format('model', 'segment', 'docs', 'legacy objects', 'segment file'))
+        for row in rows:
+            self.stdout.write('{:<30} {:<24} {:>10} {:>16} {:>16}'.format(
+                row['model'], row['segment'], row['docs'], _format_size(row['legacy_bytes']), _format_size(row['file_bytes'])))
+        total = rows[-1]
+        self.stdout.write(self.style.SUCCESS(
+            'legacy objects: {}, segment files: {} (mmap, shared page cache), python heap after load: {}'.format(
+                _format_size(total['legacy_bytes']), _format_size(total['file_bytes']), _format_size(total['heap_bytes']))))
@@ -0,0 +1,68 @@
+from django.core.management.base import BaseCommand, CommandError
+from ... import benchmark
+from ... import config
+
+
+class Command(BaseCommand):
+    help = '{}: measure search latency (p50/p99) for different SEARCH_SHARDS values, ' \
+           'suggest latency per keystroke with --suggest, ' \
+           'or size, load time and latency of uncompressed and compressed segment files with --compression.'.format(config.MODULE_NAME)
+
+    def add_arguments(self, parser):
+        parser.add_argument('--shards', default='1,2,4',
+                            help='comma separated shard counts to compare.')
+        parser.add_argument('--queries', type=int, default=100,
+                            help='number of queries sampled from the index terms.')
+        parser.add_argument('--query', action='append', default=[],
+                            help='search this query instead of sampled ones, can be repeated.')
+        parser.add_argument('--repeat', type=int, default=3,
+                            help='times each query is searched.')
+        parser.add_argument('--limit', type=int, default=10,
+                            help='results per search.')
+        parser.add_argument('--suggest', action='store_true',
+                            help='measure suggest lookups for every prefix of each query instead of searches.')
+        parser.add_argument('--compression', action='store_true',
+                            help='rewrite the index as uncompressed (version 1) and compressed segment files and compare them.')
+
+    def handle(self, *args, **options):
+        try:
+            shard_counts = [int(value) for value in options['shards'].split(',') if value.strip()]
+        except ValueError:
+            raise CommandError('invalid --shards value: {}'.format(options['shards']))
+        if options['suggest']:
+            return self.handle_suggest(options)
+        if options['compression']:
+            return self.handle_compression(options)
+        try:
+            queries = options['query'] or benchmark.sample_queries(options['queries'])
+            rows = benchmark.query_latency(queries, shard_counts, options['repeat'], options['limit'])
+        except Exception as e:
+            raise CommandError(e)
+        self.stdout.write('{:>8} {:>10} {:>10} {:>12} {:>12} {:>12}'.format('shards', 'effective', 'searches', 'p50 (ms)', 'p99 (ms)', 'mean (ms)'))
+        for row in rows:
+            self.stdout.write('{:>8} {:>10} {:>10} {:>12.3f} {:>12.3f} {:>12.3f}'.format(
+                row['shards'], row['effective_shards'], row['queries'], row['p50'], row['p99'], row['mean']))
+        self.stdout.write(self.style.SUCCESS('search benchmark finished, {} queries.'.format(len(queries))))
+
+    def handle_suggest(self, options):
+        try:
+            queries = options['query'] or benchmark.sample_queries(options['queries'])
+            row = benchmark.suggest_latency(queries, options['repeat'], options['limit'])
+        except Exception as e:
+            raise CommandError(e)
+        self.stdout.write('{:>10} {:>12} {:>12} {:>12}'.format('lookups', 'p50 (ms)', 'p99 (ms)', 'mean (ms)'))
+        self.stdout.write('{:>10} {:>12.3f} {:>12.3f} {:>12.3f}'.format(row['lookups'], row['p50'], row['p99'], row['mean']))
+        self.stdout.write(self.style.SUCCESS('suggest benchmark finished, {} queries.'.format(len(queries))))
+
+    def handle_compression(self, options):
+        try:
+            queries = options['query'] or benchmark.sample_queries(options['queries'])
+            rows = benchmark.compression_report(queries, options['repeat'], options['limit'])
+        except Exception as e:
+            raise CommandError(e)
+        self.stdout.write('{:>8} {:>14} {:>12} {:>12} {:>12} {:>12} {:>12}'.format(
+            'version', 'size (MB)', 'open (ms)', 'scan (ms)', 'p50 (ms)', 'p99 (ms)', 'mean (ms)'))
+        for row in rows:
+            self.stdout.write('{:>8} {:>14.2f} {:>12.3f} {:>12.3f} {:>12.3f} {:>12.3f} {:>12.3f}'.format(
+                row['version'], row['file_bytes'] / 1024 / 1024, row['open'], row['scan'], row['p50'], row['p99'], row['mean']))
+        self.stdout.write(self.style.SUCCESS('compression benchmark finished, {} queries.'.format(len(queries))))
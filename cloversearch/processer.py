@@ -1,6 +1,8 @@
 from .config import ConfigManager
+from functools import lru_cache
 import jieba
 import logging
+import re
 
 # 字符过滤器
 CHARACTER_FILTER = [',', '.', '?', '!', '<', '>', ':', ';', '\\', '/', '|', '[', ']', '{', '}', '-', '=', '+', '-',
@@ -8,8 +10,20 @@ CHARACTER_FILTER = [',', '.', '?', '!', '<', '>', ':', ';', '\\', '/', '|', '[',
 CHARACTER_CN_FILTER = ['，', '。', '？', '《', '》', '：', '；', '“', '”', '‘', '’', '【', '】', '——', '！', '……', '￥', '（',
                        '）', '、']
 
+# n-gram 索引的最大片段长度，建立索引时记录长度为 1~NGRAM_SIZE 的所有字符片段
+NGRAM_SIZE = 2
+
 logger = logging.getLogger(ConfigManager.logger_name)
 
+# 使用指定的词典缓存文件，文件不存在则在第一次加载词典时生成，之后直接读取序列化的词典
+if ConfigManager.jieba_cache_file:
+    jieba.dt.cache_file = ConfigManager.jieba_cache_file
+
+
+def initialize():
+    """提前加载分词词典，jieba默认在第一次分词时才加载"""
+    jieba.initialize()
+
 
 def word_segment(data: str) -> list:
     """分词：句子->列表"""
@@ -20,17 +34,95 @@ def word_segment(data: str) -> list:
         return []
 
 
+@lru_cache(maxsize=ConfigManager.segment_cache_size)
+def _cached_segment(data: str) -> tuple:
+    return tuple(word_segment(data))
+
+
+def query_segment(data: str) -> list:
+    """搜索词分词，重复的搜索词直接使用缓存的结果"""
+    return list(_cached_segment(data))
+
+
+def _compile_chars(chars: list):
+    """单字符的过滤列表编译成一个字符集正则，一次扫描删除所有字符"""
+    return re.compile('[{}]+'.format(''.join(re.escape(char) for char in chars)))
+
+
+def _compile_stages(filters: list) -> list:
+    """
+    把过滤列表编译成按顺序执行的步骤：连续的单字符合并成一个正则，多字符的过滤词单独一步
+    与按列表顺序逐个 str.replace 的结果完全一致
+    """
+    stages = []
+    singles = []
+    for item in filters:
+        if len(item) == 1:
+            singles.append(item)
+        else:
+            if singles:
+                stages.append(_compile_chars(singles))
+                singles = []
+            stages.append(item)
+    if singles:
+        stages.append(_compile_chars(singles))
+    return stages
+
+
+def _compile_filter(filters: list) -> tuple:
+    """
+    :return: (所有单字符的正则, 多字符过滤词包含的字符, 按顺序执行的步骤)
+    数据里没有多字符过滤词包含的字符时 (大部分情况)，只需要用一个正则扫描一次
+    """
+    pattern = _compile_chars([item for item in filters if len(item) == 1])
+    multi_chars = sorted({char for item in filters if len(item) > 1 for char in item})
+    return pattern, multi_chars, _compile_stages(filters)
+
+
+def _apply_filter(data: str, compiled: tuple) -> str:
+    pattern, multi_chars, stages = compiled
+    if not any(char in data for char in multi_chars):
+        return pattern.sub('', data)
+    for stage in stages:
+        data = data.replace(stage, '') if isinstance(stage, str) else stage.sub('', data)
+    return data
+
+
+_EN_FILTER = _compile_filter(CHARACTER_FILTER)
+_CN_FILTER = _compile_filter(CHARACTER_CN_FILTER)
+# 英文字符过滤之后再做中文字符过滤
+_TEXT_FILTER = _compile_filter(CHARACTER_FILTER + CHARACTER_CN_FILTER)
+# 全角字符转换为半角：全角空格 -> 空格，！(U+FF01) ~ ～(U+FF5E) -> ! ~ ~
+_WIDTH_TABLE = dict([(0x3000, 0x20)] + [(code, code - 0xFEE0) for code in range(0xFF01, 0xFF5F)])
+
+
 def character_filter(data: str) -> str:
     """英文字符过滤"""
-    output = data
-    for item in CHARACTER_FILTER:
-        output = output.replace(item, '')
-    return output
+    return _apply_filter(data, _EN_FILTER)
 
 
 def character_cn_filter(data: str) -> str:
     """中文字符过滤"""
-    output = data
-    for item in CHARACTER_CN_FILTER:
-        output = output.replace(item, '')
-    return output
+    return _apply_filter(data, _CN_FILTER)
+
+
+def normalize_text(data: str) -> str:
+    """
+    建立索引和全匹配搜索使用的文本处理：全角转半角 (NORMALIZE_WIDTH)、转小写 (NORMALIZE_CASE)、英文和中文字符过滤
+    不开启转换时结果与 character_cn_filter(character_filter(data)) 一致
+    """
+    if ConfigManager.normalize_width:
+        data = data.translate(_WIDTH_TABLE)
+    if ConfigManager.normalize_case:
+        data = data.lower()
+    return _apply_filter(data, _TEXT_FILTER)
+
+
+def normalize_texts(items: list) -> list:
+    """批量处理文本"""
+    return [normalize_text(item) for item in items]
+
+
+def ngram_split(data: str, n: int) -> set:
+    """字符片段切分：句子->长度为n的所有字符片段"""
+    return {data[i:i + n] for i in range(len(data) - n + 1)}
@@ -1,13 +1,34 @@
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from enum import Enum, unique
+from .boolean_query import SegmentContext, parse_query
+from .cache import MISSING, QueryCache, normalize_query
 from .config import ConfigManager
 from .indexes import IndexManager, Index
-from .processer import character_filter, character_cn_filter, word_segment
+from .processer import normalize_text, query_segment
+from .regex_engine import RegexBudget, compile_pattern, iter_matches
+from .scoring import get_scorer
+from .term_index import expand_keywords
 
+import asyncio
+import heapq
+import itertools
 import logging
+import numpy as np
+import os
 import re
+import threading
+import time
 
 logger = logging.getLogger(ConfigManager.logger_name)
 
+# 异步搜索使用的线程池，第一次使用时创建
+_executor = None
+_executor_lock = threading.Lock()
+# 并行搜索各个分片使用的线程池和线程数量
+_shard_executor = None
+_shard_executor_size = 0
+
 
 @unique
 class SearchResultObjectType(Enum):
@@ -23,12 +44,8 @@ class SearchResultObject:
     """
     搜索结果对象，一个搜索结果对象对应一条数据
     """
-    index = None  # Index对象
-    raw = ''  # 输入的原始关键词
-    keyword_count = 0  # 输入的关键词数量
-    matching_type = None  # 匹配的类型
-    matching_count = 0  # 匹配到的词数量
-    matching_score = 0  # 匹配度，全匹配则为1；词匹配：输入的关键词在索引中出现的次数 / 总关键词数量
+
+    __slots__ = ('index', 'raw', 'keyword_count', 'matching_type', 'matching_count', 'matching_score', 'instance')
 
     def __init__(self, index: Index, raw: str, keyword_count: int, matching_type: SearchResultObjectType):
         """
@@ -38,10 +55,13 @@ class SearchResultObject:
         :param keyword_count: 关键词数量，用于计算词模式的匹配度
         :param matching_type: 匹配的类型
         """
-        self.index = index
-        self.raw = raw
-        self.keyword_count = keyword_count
-        self.matching_type = matching_type
+        self.index = index  # Index对象
+        self.raw = raw  # 输入的原始关键词
+        self.keyword_count = keyword_count  # 输入的关键词数量
+        self.matching_type = matching_type  # 匹配的类型
+        self.matching_count = 0  # 匹配到的词数量
+        self.matching_score = 0  # 匹配度，全匹配则为1 (加上词匹配的相关度)；词匹配：按相关度算法计算并归一化到0~1
+        self.instance = None  # 对应的model实例，调用 SearchResultSet.hydrate 之后才有
 
     @property
     def __id__(self):
@@ -61,7 +81,9 @@ class SearchResultObject:
         获取序列化的搜索结果对象，dict结构
         :return: dict
         """
-        model_dict = self.index.get_model_instance().__dict__
+        if self.instance is None:
+            self.instance = self.index.get_model_instance()
+        model_dict = dict(self.instance.__dict__) if self.instance is not None else dict()
         # 删掉无法序列化的字段
         if '_state' in model_dict:
             del model_dict['_state']
@@ -74,15 +96,49 @@ class SearchResultObject:
         return data_dict
 
 
+class QueryControl:
+    """
+    控制一次搜索的执行：截止时间和取消标记
+    耗时的循环里调用 expired() 检查，超时或者被取消之后停止搜索，返回已经找到的部分结果
+    """
+
+    def __init__(self, timeout: float = None):
+        """
+        :param timeout: 搜索的时间上限 (秒)，为None或0时不限制
+        """
+        self.deadline = time.monotonic() + timeout if timeout else None
+        self.cancelled = threading.Event()
+        # 是否已经因为超时或者取消而停止
+        self.stopped = False
+
+    def cancel(self):
+        """取消搜索，例如客户端已经断开连接"""
+        self.cancelled.set()
+
+    def expired(self) -> bool:
+        if not self.stopped and (self.cancelled.is_set() or
+                                 (self.deadline is not None and time.monotonic() >= self.deadline)):
+            self.stopped = True
+        return self.stopped
+
+
 class SearchResultSet:
     """
     搜索结果集，用于传递、管理搜索结果对象，API方面部分参考了Django ORM的设计
     """
 
     objects = []  # SearchResultObject 对象列表
+    total = None  # 搜索结果总数，SearchQuery.search 只有在 count=True 时才计算
+    partial = False  # 搜索超时或者被取消，只包含部分结果，total 也只是已经找到的数量
 
     def __init__(self):
         self.objects = list()
+        # objects 是否已经排好序，添加结果之后需要重新排序
+        self.sorted = False
+        self.partial = False
+
+    def __len__(self):
+        return len(self.objects)
 
     def add(self, obj: SearchResultObject) -> None:
         """
@@ -91,6 +147,7 @@ class SearchResultSet:
         :return: None
         """
         self.objects.append(obj)
+        self.sorted = False
 
     def extend(self, query_set) -> None:
         """
@@ -99,30 +156,103 @@ class SearchResultSet:
         :return: None
         """
         self.objects.extend(query_set.objects)
+        self.sorted = False
+        self.partial = self.partial or query_set.partial
 
     @property
     def all(self) -> list:
         """
-        获取搜索结果列表
+        获取搜索结果列表，按匹配度从高到低排序，只在结果变化之后排序一次
         :return: list
         """
-        # 使用lambda表达式对搜索结果进行排序
-        self.objects.sort(key=lambda elem: elem.matching_score, reverse=True)
+        if not self.sorted:
+            # 使用lambda表达式对搜索结果进行排序
+            self.objects.sort(key=lambda elem: elem.matching_score, reverse=True)
+            self.sorted = True
         return self.objects
 
+    def hydrate(self, only=None):
+        """
+        批量获取搜索结果对应的model实例，每个model只查询一次数据库，保持搜索结果的顺序
+        数据库里已经删除的数据会从结果集中去掉
+        :param only: 只读取指定的字段，list: 所有model都使用这些字段；dict: key为 'app_name.ModelName'，value为字段列表
+        :return: self
+        """
+        # key: (app_name, model_name, 主键), value: model实例
+        instances = dict()
+        for (app_name, model_name), queryset, primary_keys in self.get_hydrate_querysets(only):
+            for primary_key, instance in queryset.in_bulk(primary_keys).items():
+                instances[(app_name, model_name, str(primary_key))] = instance
+        return self.attach_instances(instances)
+
+    async def ahydrate(self, only=None):
+        """
+        hydrate 的异步版本，使用Django的异步ORM查询，不支持异步ORM的Django版本在线程里查询
+        :param only: 同 hydrate
+        :return: self
+        """
+        instances = dict()
+        for (app_name, model_name), queryset, primary_keys in self.get_hydrate_querysets(only):
+            if hasattr(queryset, 'ain_bulk'):
+                bulk = await queryset.ain_bulk(primary_keys)
+            else:
+                from asgiref.sync import sync_to_async
+                bulk = await sync_to_async(queryset.in_bulk)(primary_keys)
+            for primary_key, instance in bulk.items():
+                instances[(app_name, model_name, str(primary_key))] = instance
+        return self.attach_instances(instances)
+
+    def get_hydrate_querysets(self, only=None) -> list:
+        """
+        按model分组还没有model实例的结果
+        :return: [((app_name, model_name), QuerySet, 主键列表), ...]
+        """
+        # key: (app_name, model_name), value: 主键列表
+        groups = OrderedDict()
+        for item in self.objects:
+            if item.instance is None:
+                groups.setdefault((item.index.app_name, item.index.model_name), []).append(item.index.primary_key)
+        querysets = []
+        for (app_name, model_name), primary_keys in groups.items():
+            model = Index.find_model_class(app_name, model_name)
+            if model is None:
+                continue
+            queryset = model.objects.all()
+            fields = only.get('{}.{}'.format(app_name, model_name)) if isinstance(only, dict) else only
+            if fields:
+                queryset = queryset.only(*fields)
+            querysets.append(((app_name, model_name), queryset, primary_keys))
+        return querysets
+
+    def attach_instances(self, instances: dict):
+        """
+        把查询到的model实例放进搜索结果，去掉数据库里已经删除的数据
+        :param instances: key: (app_name, model_name, 主键), value: model实例
+        :return: self
+        """
+        objects = []
+        for item in self.objects:
+            if item.instance is None:
+                item.instance = instances.get((item.index.app_name, item.index.model_name, str(item.index.primary_key)))
+                if item.instance is None:
+                    continue
+            objects.append(item)
+        self.objects = objects
+        return self
+
     def remove_duplicates(self) -> None:
         """
-        删除重复搜索结果
+        删除重复搜索结果，保留第一次出现的结果
         :return: None
         """
-        temp_list = []
-        new_objects = self.objects.copy()
+        seen = set()
+        new_objects = []
         for item in self.objects:
-            if item.__id__ in temp_list:
-                new_objects.remove(item)
-            else:
-                temp_list.append(item.__id__)
+            if item.__id__ not in seen:
+                seen.add(item.__id__)
+                new_objects.append(item)
         self.objects = new_objects
+        self.sorted = False
 
     def print(self) -> None:
         """
@@ -138,103 +268,764 @@ class SearchQuery:
     """
 
     @classmethod
-    def query(cls, raw: str, full_match: bool = True, word_match: bool = True, regex_match: bool = False) -> SearchResultSet:
+    def query(cls, raw: str, full_match: bool = True, word_match: bool = True, regex_match: bool = False,
+              cache: bool = True, timeout: float = None, control: QueryControl = None, models: list = None) -> SearchResultSet:
         """
         开始一个搜索请求
         :param full_match: 是否开启全匹配
         :param word_match: 是否开启词匹配
         :param regex_match: 是否开启正则匹配
         :param raw: 输入的原始搜索词
+        :param cache: 是否使用搜索结果缓存
+        :param timeout: 搜索的时间上限 (秒)，超时返回部分结果 (SearchResultSet.partial)，不指定则不限制
+        :param control: 控制搜索的截止时间和取消，指定之后忽略 timeout
+        :param models: 只搜索这些model (Model名称 或者 app_name.Model名称)，其他model的索引段不会被读取，不指定则搜索所有model
         :return: SearchResultSet
         """
-        all_set = SearchResultSet()
+        control = control or QueryControl(timeout)
+        IndexManager.get_instance().refresh()
+        key = ('query', _query_key(raw, full_match, regex_match), full_match, word_match, regex_match,
+               _scoring_key(None), _models_key(models))
+        return cls.cached(key, lambda: cls._query(raw, full_match, word_match, regex_match, control, models), cache)
 
-        if full_match:
-            full_set = cls.full_match(raw)
-            all_set.extend(full_set)
+    @classmethod
+    async def aquery(cls, raw: str, full_match: bool = True, word_match: bool = True, regex_match: bool = False,
+                     cache: bool = True, timeout: float = None, models: list = None) -> SearchResultSet:
+        """
+        query 的异步版本，参数同 query
+        """
+        control = QueryControl(timeout)
+        return await cls.run_async(lambda: cls.query(raw, full_match, word_match, regex_match, cache, control=control,
+                                                     models=models), control)
 
+    @classmethod
+    def _query(cls, raw: str, full_match: bool, word_match: bool, regex_match: bool, control: QueryControl,
+               models: list = None) -> SearchResultSet:
+        """
+        一次遍历执行所有开启的匹配方式：词匹配在倒排列表上计算，全匹配只确认 n-gram 候选文档，
+        正则匹配只检查前两种方式都没有找到的文档；同一个文档的结果按 (索引段, doc_id) 合并：
+        全匹配的匹配度 = 1 + 词匹配相关度，只被词匹配找到的为词匹配相关度，只被正则匹配找到的为0
+        """
+        all_set = SearchResultSet()
+        segments = IndexManager.get_instance().get_segments(models)
+        shards = get_shards(segments)
         if word_match:
-            word_set = cls.word_match(raw)
-            all_set.extend(word_set)
+            keyword_count, shard_results = cls.shard_word_scores(raw, None, segments, shards, control)
+        else:
+            keyword_count, shard_results = 0, [[] for _ in shards]
+        data = normalize_text(raw) if full_match else None
+        # 当输入的搜索关键词长度小于符合正则匹配规则的时候启用正则匹配
+        pattern = short_pattern(raw) if regex_match and len(raw) <= 2 else None
+        budget = RegexBudget(control)
+        shard_hits = map_shards(lambda j: cls._match_shard(segments, shards[j], shard_results[j], data, pattern, budget),
+                                range(len(shards)))
+
+        # 按文档合并结果, key: (索引段序号, doc_id), value: SearchResultObject
+        hits = dict()
+        for ordinal, doc_id in sorted(hit for full_hits, regex_hits in shard_hits for hit in full_hits):
+            search_obj = SearchResultObject(Index.from_segment(segments[ordinal], doc_id), raw, 1, SearchResultObjectType.FullMatch)
+            # 全匹配的匹配度为1
+            search_obj.matching_score = 1
+            hits[(ordinal, doc_id)] = search_obj
+            all_set.objects.append(search_obj)
 
-        if regex_match:
-            # 当输入的搜索关键词长度小于符合正则匹配规则的时候启用正则匹配
-            if len(raw) <= 2:
-                pattern = r'\w'.join(raw)
-                regex_set = cls.regex_match(pattern)
-                all_set.extend(regex_set)
+        ordinals = {id(segment): i for i, segment in enumerate(segments)}
+        for segment, doc_ids, scores, matching_counts in _merge_word_results(segments, shard_results):
+            ordinal = ordinals[id(segment)]
+            for doc_id, score, matching_count in zip(doc_ids.tolist(), scores.tolist(), matching_counts.tolist()):
+                search_obj = hits.get((ordinal, doc_id))
+                if search_obj is None:
+                    search_obj = SearchResultObject(Index.from_segment(segment, doc_id), raw, keyword_count, SearchResultObjectType.WordMatch)
+                    hits[(ordinal, doc_id)] = search_obj
+                    all_set.objects.append(search_obj)
+                # 同时被全匹配找到的结果，按词匹配的相关度在全匹配的结果里排序
+                search_obj.matching_count = matching_count
+                search_obj.matching_score += score
 
-        # 去除重复结果
-        all_set.remove_duplicates()
+        for ordinal, doc_id in sorted(hit for full_hits, regex_hits in shard_hits for hit in regex_hits):
+            search_obj = SearchResultObject(Index.from_segment(segments[ordinal], doc_id), pattern, 1, SearchResultObjectType.RegexMatch)
+            search_obj.matching_score = 0  # 正则匹配的匹配度接近于0，所以这里取0
+            all_set.objects.append(search_obj)
 
+        all_set.partial = budget.stopped
         return all_set
 
     @classmethod
-    def full_match(cls, raw: str) -> SearchResultSet:
+    def _match_shard(cls, segments: list, shard: list, word_results: list, data: str or None, pattern: str or None,
+                     budget: RegexBudget) -> tuple:
+        """
+        在一个分片里确认全匹配的候选文档，再对全匹配和词匹配都没有找到的文档做正则匹配
+        :param word_results: 分片里的词匹配结果
+        :param data: 经过字符过滤的搜索词，为None时不做全匹配
+        :param pattern: 正则表达式，为None时不做正则匹配
+        :param budget: 这次搜索的正则匹配预算，budget.control 控制整个搜索的截止时间和取消
+        :return: (全匹配的 [(索引段序号, doc_id), ...], 正则匹配的 [(索引段序号, doc_id), ...])
+        """
+        control = budget.control
+        word_docs = {id(result[0]): result[1] for result in word_results}
+        full_hits, regex_hits = [], []
+        for i in shard:
+            segment = segments[i]
+            matched = set()
+            if data is not None:
+                # 先用 n-gram 索引缩小范围，只对候选文档做子串匹配
+                for doc_id in segment.get_candidates(data):
+                    if control.expired():
+                        return full_hits, regex_hits
+                    if cls.is_full_match(segment, doc_id, data):
+                        matched.add(doc_id)
+                        full_hits.append((i, doc_id))
+            if pattern is not None:
+                doc_ids = word_docs.get(id(segment))
+                for doc_id in cls.regex_docs(segment, pattern, budget):
+                    if doc_id not in matched and (doc_ids is None or not _contains(doc_ids, doc_id)):
+                        regex_hits.append((i, doc_id))
+        return full_hits, regex_hits
+
+    @classmethod
+    async def run_async(cls, compute, control: QueryControl):
+        """
+        在线程池里执行搜索，不会阻塞事件循环
+        协程被取消 (例如ASGI下客户端断开连接) 时，线程里的搜索在下一次检查时停止
+        :param compute: 执行搜索的函数
+        :param control: 这次搜索的 QueryControl
+        :return: compute 的返回值
+        """
+        # 在协程里总是有正在运行的事件循环；Python 3.6 没有 get_running_loop，get_event_loop 在协程里返回的也是它
+        loop = getattr(asyncio, 'get_running_loop', asyncio.get_event_loop)()
+        try:
+            return await loop.run_in_executor(get_executor(), compute)
+        except asyncio.CancelledError:
+            control.cancel()
+            raise
+
+    @classmethod
+    def cached(cls, key: tuple, compute, cache: bool = True) -> SearchResultSet:
+        """
+        先查找搜索结果缓存，没有再计算
+        缓存里只保存 (索引段序号, doc_id, 匹配信息)，可以放进Django的缓存里给其他进程使用
+        :param key: 搜索参数
+        :param compute: 计算搜索结果的函数
+        :param cache: 是否使用缓存
+        :return: SearchResultSet
+        """
+        query_cache = QueryCache.get_instance()
+        if not cache or not query_cache.enabled:
+            return compute()
+        # 同一个版本的索引段列表是一样的，可以用序号找到索引段
+        segments = IndexManager.get_instance().segments
+        version = IndexManager.get_version(segments)
+        value = query_cache.get(key, version)
+        if value is not MISSING:
+            return cls.load_result_set(value, segments)
+        search_set = compute()
+        # 超时或者被取消的部分结果不缓存
+        if search_set.partial:
+            return search_set
+        value = cls.dump_result_set(search_set, segments)
+        if value is not None:
+            query_cache.set(key, version, value)
+        return search_set
+
+    @classmethod
+    def dump_result_set(cls, search_set: SearchResultSet, segments: list) -> tuple or None:
+        """把搜索结果集转换成可以缓存的数据，搜索期间索引段发生变化则返回None"""
+        ordinals = {id(segment): i for i, segment in enumerate(segments)}
+        items = []
+        for item in search_set.objects:
+            ordinal = ordinals.get(id(item.index.segment))
+            if ordinal is None:
+                return None
+            items.append((ordinal, item.index.doc_id, item.raw, item.keyword_count, item.matching_type.name,
+                          item.matching_count, item.matching_score))
+        return search_set.total, search_set.sorted, items
+
+    @classmethod
+    def load_result_set(cls, value: tuple, segments: list) -> SearchResultSet:
+        """从缓存的数据还原搜索结果集"""
+        total, is_sorted, items = value
+        search_set = SearchResultSet()
+        for ordinal, doc_id, raw, keyword_count, matching_type, matching_count, matching_score in items:
+            search_obj = SearchResultObject(Index.from_segment(segments[ordinal], doc_id), raw, keyword_count,
+                                            SearchResultObjectType[matching_type])
+            search_obj.matching_count = matching_count
+            search_obj.matching_score = matching_score
+            search_set.objects.append(search_obj)
+        search_set.total = total
+        search_set.sorted = is_sorted
+        return search_set
+
+    @classmethod
+    def full_match(cls, raw: str, control: QueryControl = None) -> SearchResultSet:
         """
         全匹配搜索，将原始搜索词与索引数据进行匹配查找
+        索引段按model分片，各个分片在线程池里并行确认候选文档
         :param raw: 输入的原始搜索词
+        :param control: 控制搜索的截止时间和取消
         :return: SearchResultSet
         """
-        data = character_filter(raw)
-        data = character_cn_filter(data)
+        control = control or QueryControl()
+        data = normalize_text(raw)
+        segments = IndexManager.get_instance().get_segments()
+
+        def match_shard(shard: list) -> list:
+            hits = []
+            for i in shard:
+                # 先用 n-gram 索引缩小范围，只对候选文档做子串匹配
+                for doc_id in segments[i].get_candidates(data):
+                    if control.expired():
+                        return hits
+                    if cls.is_full_match(segments[i], doc_id, data):
+                        hits.append((i, doc_id))
+            return hits
+
         # 搜索结果集
         search_set = SearchResultSet()
-        for index in IndexManager.get_instance().indexes:
-            search_obj = SearchResultObject(index, raw, 1, SearchResultObjectType.FullMatch)
+        for i, doc_id in sorted(hit for hits in map_shards(match_shard, get_shards(segments)) for hit in hits):
+            search_obj = SearchResultObject(Index.from_segment(segments[i], doc_id), raw, 1, SearchResultObjectType.FullMatch)
             # 全匹配的匹配度为1
             search_obj.matching_score = 1
-            for field_name, clean_data in index.clean_data.items():
-                if data in clean_data:
-                    search_set.add(search_obj)
-                    # 我发现匹配的时候输出这个调试信息很浪费性能！
-                    # logger.debug('full_match: {}'.format(search_obj.__repr__()))
-                    break
+            search_set.add(search_obj)
+        search_set.partial = control.stopped
         return search_set
 
     @classmethod
-    def word_match(cls, raw: str) -> SearchResultSet:
+    def is_full_match(cls, segment, doc_id: int, data: str) -> bool:
+        """确认文档的某个字段包含经过字符过滤的搜索词"""
+        for field_name, clean_data in segment.get_clean_data(doc_id).items():
+            if data in clean_data:
+                return True
+        return False
+
+    @classmethod
+    def word_match(cls, raw: str, scoring: str = None, control: QueryControl = None) -> SearchResultSet:
         """
         词匹配搜索，将搜索词进行分词处理之后与索引数据（已经进行分词处理）进行匹配查找
         :param raw: 输入的原始搜索词
+        :param scoring: 相关度算法 (bm25, tfidf, count)，不指定则使用配置
+        :param control: 控制搜索的截止时间和取消
         :return: SearchResultSet
         """
-        # 先对输入的搜索语分词处理
-        keywords = word_segment(raw)
+        control = control or QueryControl()
+        keyword_count, results = cls.word_scores(raw, scoring, control)
         # 搜索结果集
         search_set = SearchResultSet()
-        for index in IndexManager.get_instance().indexes:
-            search_obj = SearchResultObject(index, raw, len(keywords), SearchResultObjectType.WordMatch)
-            for word in keywords:
-                # 统计匹配词数量，输入的关键词有多少个出现在索引数据里面
-                for field_name, words_list in index.keywords.items():
-                    if word in words_list:
-                        # 检测到这个关键词的出现，记录下，跳出循环，测试下个关键词
-                        search_obj.matching_count += 1
-                        break
-                # 计算匹配度：匹配词数量 / 总输入关键词数
-                search_obj.matching_score = search_obj.matching_count / search_obj.keyword_count
-            if search_obj.matching_score > 0:
-                # 匹配度大于0才添加到结果集中
+        search_set.partial = control.stopped
+        for segment, doc_ids, scores, matching_counts in results:
+            for doc_id, score, matching_count in zip(doc_ids.tolist(), scores.tolist(), matching_counts.tolist()):
+                index = Index.from_segment(segment, doc_id)
+                search_obj = SearchResultObject(index, raw, keyword_count, SearchResultObjectType.WordMatch)
+                search_obj.matching_count = matching_count
+                search_obj.matching_score = score
                 search_set.add(search_obj)
+        return search_set
+
+    @classmethod
+    def word_scores(cls, raw: str, scoring: str = None, control: QueryControl = None) -> tuple:
+        """
+        计算词匹配的相关度，不创建搜索结果对象
+        :param raw: 输入的原始搜索词
+        :param scoring: 相关度算法 (bm25, tfidf, count)，不指定则使用配置
+        :param control: 控制搜索的截止时间和取消，每个model计算之前检查一次
+        :return: (关键词数量, [(索引段, doc_id数组, 相关度数组, 匹配词数量数组), ...])
+        """
+        segments = IndexManager.get_instance().get_segments()
+        keyword_count, shard_results = cls.shard_word_scores(raw, scoring, segments, get_shards(segments), control)
+        return keyword_count, _merge_word_results(segments, shard_results)
+
+    @classmethod
+    def shard_word_scores(cls, raw: str, scoring: str or None, segments: list, shards: list, control: QueryControl = None) -> tuple:
+        """
+        在各个分片里并行计算词匹配的相关度，再用所有分片里最大的相关度归一化
+        :param segments: 索引段列表
+        :param shards: get_shards 得到的分片
+        :return: (关键词数量, 每个分片的 [(索引段, doc_id数组, 相关度数组, 匹配词数量数组), ...])
+        """
+        # 先对输入的搜索语分词处理
+        keywords = query_segment(raw)
+        word_counts = Counter(keywords)
+        scorer_class = get_scorer(scoring)
+        # 索引里不存在的关键词，用编辑距离相近的词和拼音对应的词代替 (FUZZY_MATCH、PINYIN_MATCH)
+        expansions = expand_keywords(keywords, segments)
+
+        # 只需要查搜索词里的关键词的倒排列表，在倒排列表上直接计算所有文档的相关度
+        shard_results = _score_shards(segments, shards, lambda group: scorer_class(group, word_counts, expansions).score(),
+                                      scorer_class.normalize, control)
+        return len(keywords), shard_results
+
+    @classmethod
+    def search(cls, raw: str, limit: int = 10, offset: int = 0, full_match: bool = True, word_match: bool = True,
+               regex_match: bool = False, count: bool = False, scoring: str = None, cache: bool = True,
+               timeout: float = None, control: QueryControl = None, models: list = None) -> SearchResultSet:
+        """
+        搜索并且只返回一页结果，排序与 query(...).all[offset:offset + limit] 一致
+        词匹配的相关度在numpy数组上计算，用 partition 选出前 offset + limit 个，不需要为所有结果创建对象再排序；
+        全匹配的候选文档按匹配度从高到低确认，找够 offset + limit 个就停止
+        :param raw: 输入的原始搜索词
+        :param limit: 返回的结果数量
+        :param offset: 跳过的结果数量
+        :param count: 是否计算结果总数 (SearchResultSet.total)，需要确认所有全匹配候选文档
+        :param scoring: 相关度算法 (bm25, tfidf, count)，不指定则使用配置
+        :param cache: 是否使用搜索结果缓存
+        :param timeout: 搜索的时间上限 (秒)，超时返回部分结果 (SearchResultSet.partial)，不指定则不限制
+        :param control: 控制搜索的截止时间和取消，指定之后忽略 timeout
+        :param models: 只搜索这些model，同 query
+        :return: SearchResultSet
+        """
+        control = control or QueryControl(timeout)
+        IndexManager.get_instance().refresh()
+        key = ('search', _query_key(raw, full_match, regex_match), limit, offset, full_match, word_match, regex_match, count,
+               _scoring_key(scoring), _models_key(models))
+        return cls.cached(key, lambda: cls._search(raw, limit, offset, full_match, word_match, regex_match, count, scoring,
+                                                   control, models), cache)
+
+    @classmethod
+    async def asearch(cls, raw: str, limit: int = 10, offset: int = 0, full_match: bool = True, word_match: bool = True,
+                      regex_match: bool = False, count: bool = False, scoring: str = None, cache: bool = True,
+                      timeout: float = None, models: list = None) -> SearchResultSet:
+        """
+        search 的异步版本，参数同 search
+        """
+        control = QueryControl(timeout)
+        return await cls.run_async(lambda: cls.search(raw, limit, offset, full_match, word_match, regex_match, count, scoring,
+                                                      cache, control=control, models=models), control)
+
+    @classmethod
+    def _search(cls, raw: str, limit: int, offset: int, full_match: bool, word_match: bool, regex_match: bool,
+                count: bool, scoring: str or None, control: QueryControl, models: list = None) -> SearchResultSet:
+        top_k = offset + limit
+        objects = []
+        total = 0
+
+        segments = IndexManager.get_instance().get_segments(models)
+        shards = get_shards(segments)
+        if word_match:
+            keyword_count, shard_results = cls.shard_word_scores(raw, scoring, segments, shards, control)
+        else:
+            keyword_count, shard_results = 0, [[] for _ in shards]
+        word_results = _merge_word_results(segments, shard_results)
+        # 词匹配的结果按 word_scores 返回的顺序排列相关度相同的文档，与 query 的结果顺序一致
+        word_ranks = {id(result[0]): rank for rank, result in enumerate(word_results)}
+        data = normalize_text(raw) if full_match else None
+
+        # 各个分片分别找出自己的前 top_k 个结果
+        shard_hits = map_shards(lambda j: cls._search_shard(segments, shards[j], shard_results[j], word_ranks, data,
+                                                            top_k, count, control), range(len(shards)))
+        # 已经加入结果的文档, key: id(索引段), value: doc_id 集合
+        matched = dict()
+        for hits in shard_hits:
+            matched.update(hits['matched'])
+
+        # 按 (匹配度从高到低, 索引段顺序, doc_id) 多路归并各个分片的结果，与不分片时的顺序完全一样
+        if full_match:
+            total += sum(hits['full_total'] for hits in shard_hits)
+            for key, ordinal, doc_id in _merge_hits([hits['full'] for hits in shard_hits], top_k):
+                search_obj = SearchResultObject(Index.from_segment(segments[ordinal], doc_id), raw, 1, SearchResultObjectType.FullMatch)
+                search_obj.matching_score = 1 - key
+                objects.append(search_obj)
+
+        if word_results and (count or len(objects) < top_k):
+            total += sum(hits['word_total'] for hits in shard_hits)
+            merged = _merge_hits([hits['word'] for hits in shard_hits], top_k - len(objects))
+            for key, rank, doc_id, matching_count in merged:
+                segment = word_results[rank][0]
+                search_obj = SearchResultObject(Index.from_segment(segment, doc_id), raw, keyword_count,
+                                                SearchResultObjectType.WordMatch)
+                search_obj.matching_count = matching_count
+                search_obj.matching_score = -key
+                objects.append(search_obj)
+                matched.setdefault(id(segment), set()).add(doc_id)
 
+        # 正则匹配需要检查 n-gram 索引找到的所有候选文档，只在结果不够或者需要计算总数时执行
+        budget = RegexBudget(control)
+        if regex_match and len(raw) <= 2 and (count or len(objects) < top_k) and not control.expired():
+            pattern = short_pattern(raw)
+            word_docs = {id(result[0]): result[1] for result in word_results}
+            for segment in segments:
+                if not count and len(objects) >= top_k:
+                    break
+                doc_ids = word_docs.get(id(segment))
+                found = matched.get(id(segment), ())
+                # 只检查全匹配和词匹配都没有找到的文档
+                for doc_id in cls.regex_docs(segment, pattern, budget):
+                    if doc_id in found or (doc_ids is not None and _contains(doc_ids, doc_id)):
+                        continue
+                    total += 1
+                    if len(objects) < top_k:
+                        search_obj = SearchResultObject(Index.from_segment(segment, doc_id), pattern, 1, SearchResultObjectType.RegexMatch)
+                        search_obj.matching_score = 0
+                        objects.append(search_obj)
+                    elif not count:
+                        break
+
+        search_set = SearchResultSet()
+        search_set.objects = objects[offset:top_k]
+        search_set.sorted = True
+        search_set.total = total if count else None
+        search_set.partial = budget.stopped
         return search_set
 
     @classmethod
-    def regex_match(cls, pattern: str) -> SearchResultSet:
+    def _search_shard(cls, segments: list, shard: list, word_results: list, word_ranks: dict, data: str or None,
+                      top_k: int, count: bool, control: QueryControl) -> dict:
+        """
+        在一个分片里找出全匹配和词匹配的前 top_k 个结果
+        全匹配的候选文档按匹配度从高到低确认，找够 top_k 个就停止；
+        词匹配的相关度用 partition 选出前 top_k 个，不需要对所有结果排序
+        :param shard: 分片里的索引段序号
+        :param word_results: 分片里的词匹配结果 (已经归一化)
+        :param word_ranks: key: id(索引段), value: 词匹配结果的顺序
+        :param data: 经过字符过滤的搜索词，为None时不做全匹配
+        :return: dict, full: [(-匹配度, 索引段序号, doc_id), ...], word: [(-相关度, 词匹配结果顺序, doc_id, 匹配词数量), ...]，
+                 都已经排好序；full_total/word_total: 结果数量；matched: 全匹配找到的文档
+        """
+        full_hits = []
+        full_total = 0
+        matched = dict()
+
+        if data is not None:
+            dense_scores = dict()
+            for segment, doc_ids, scores, matching_counts in word_results:
+                dense = dense_scores.setdefault(id(segment), np.zeros(segment.doc_count))
+                dense[doc_ids] = scores
+            # 所有候选文档按 (匹配度从高到低, 索引段顺序, doc_id) 排序
+            candidate_scores, candidate_segments, candidate_docs = [], [], []
+            for i in shard:
+                doc_ids = np.array(segments[i].get_candidates(data), dtype=np.int64)
+                dense = dense_scores.get(id(segments[i]))
+                candidate_scores.append(dense[doc_ids] if dense is not None else np.zeros(len(doc_ids)))
+                candidate_segments.append(np.full(len(doc_ids), i, dtype=np.int64))
+                candidate_docs.append(doc_ids)
+            if candidate_docs:
+                candidate_scores = np.concatenate(candidate_scores)
+                candidate_segments = np.concatenate(candidate_segments)
+                candidate_docs = np.concatenate(candidate_docs)
+                order = np.lexsort((candidate_docs, candidate_segments, -candidate_scores))
+                for i in order.tolist():
+                    if (not count and full_total >= top_k) or control.expired():
+                        break
+                    segment, doc_id = segments[candidate_segments[i]], int(candidate_docs[i])
+                    if not cls.is_full_match(segment, doc_id, data):
+                        continue
+                    full_total += 1
+                    matched.setdefault(id(segment), set()).add(doc_id)
+                    if len(full_hits) < top_k:
+                        full_hits.append((-float(candidate_scores[i]), int(candidate_segments[i]), doc_id))
+
+        word_hits = []
+        word_total = 0
+        if word_results and (count or len(full_hits) < top_k):
+            # 去掉已经被全匹配找到的文档
+            results = []
+            for segment, doc_ids, scores, matching_counts in word_results:
+                if id(segment) in matched:
+                    mask = ~np.isin(doc_ids, list(matched[id(segment)]))
+                    doc_ids, scores, matching_counts = doc_ids[mask], scores[mask], matching_counts[mask]
+                results.append((segment, doc_ids, scores, matching_counts))
+            word_total = sum(len(result[1]) for result in results)
+            word_hits = _top_word_hits(results, word_ranks, top_k - len(full_hits))
+
+        return {'full': full_hits, 'full_total': full_total, 'word': word_hits, 'word_total': word_total, 'matched': matched}
+
+    @classmethod
+    def boolean_search(cls, raw: str, limit: int = 10, offset: int = 0, count: bool = False, scoring: str = None,
+                       cache: bool = True, timeout: float = None, control: QueryControl = None,
+                       models: list = None) -> SearchResultSet:
+        """
+        使用查询语言搜索，语法见 boolean_query.parse_query，例如：
+            python AND (django OR flask) NOT java
+            "全文 搜索" post_title:索引 model:Post
+        结果都是词匹配 (WordMatch)，按查询里的正向关键词计算相关度排序
+        :param raw: 查询语句
+        :param limit: 返回的结果数量
+        :param offset: 跳过的结果数量
+        :param count: 是否计算结果总数 (SearchResultSet.total)
+        :param scoring: 相关度算法 (bm25, tfidf, count)，不指定则使用配置
+        :param cache: 是否使用搜索结果缓存
+        :param timeout: 搜索的时间上限 (秒)，超时返回部分结果 (SearchResultSet.partial)，不指定则不限制
+        :param control: 控制搜索的截止时间和取消，指定之后忽略 timeout
+        :param models: 只搜索这些model，同 query；查询语句里的 model: 在这些model里继续筛选
+        :return: SearchResultSet
+        :raise QuerySyntaxError: 查询语句语法错误
+        """
+        control = control or QueryControl(timeout)
+        IndexManager.get_instance().refresh()
+        # 先解析，语法错误不需要查缓存
+        tree = parse_query(raw)
+        key = ('boolean', _query_key(raw), limit, offset, count, _scoring_key(scoring), _models_key(models))
+        return cls.cached(key, lambda: cls._boolean_search(raw, tree, limit, offset, count, scoring, control, models),
+                          cache)
+
+    @classmethod
+    async def aboolean_search(cls, raw: str, limit: int = 10, offset: int = 0, count: bool = False, scoring: str = None,
+                              cache: bool = True, timeout: float = None, models: list = None) -> SearchResultSet:
+        """
+        boolean_search 的异步版本，参数同 boolean_search
+        """
+        control = QueryControl(timeout)
+        # 语法错误在当前协程里抛出
+        parse_query(raw)
+        return await cls.run_async(lambda: cls.boolean_search(raw, limit, offset, count, scoring, cache, control=control,
+                                                              models=models), control)
+
+    @classmethod
+    def _boolean_search(cls, raw: str, tree, limit: int, offset: int, count: bool, scoring: str or None,
+                        control: QueryControl, models: list = None) -> SearchResultSet:
+        top_k = offset + limit
+        search_set = SearchResultSet()
+        search_set.sorted = True
+        search_set.total = 0 if count else None
+        if tree is None:
+            return search_set
+
+        segments = IndexManager.get_instance().get_segments(models)
+        keywords = tree.keywords()
+        word_counts = Counter(keywords)
+        scorer_class = get_scorer(scoring)
+
+        def match_group(group: list) -> list:
+            matched = []
+            for segment in group:
+                context = SegmentContext(segment, control)
+                # model: 或者字段限制排除的索引段不需要执行
+                if tree.estimate(context) == 0:
+                    continue
+                doc_ids = tree.evaluate(context)
+                if len(doc_ids) > 0:
+                    matched.append((segment, doc_ids))
+            if not matched:
+                return []
+            # 相关度的统计数据仍然按整个model计算，与 search 一致
+            word_scores = dict()
+            if word_counts:
+                for segment, doc_ids, scores, matching_counts in scorer_class(group, word_counts).score():
+                    word_scores[id(segment)] = (doc_ids, scores, matching_counts)
+            results = []
+            for segment, doc_ids in matched:
+                scores = np.zeros(len(doc_ids), dtype=np.float64)
+                matching_counts = np.zeros(len(doc_ids), dtype=np.int64)
+                if id(segment) in word_scores:
+                    # NOT 和 model: 匹配的文档可能不包含任何关键词，相关度为0
+                    score_docs, score_values, score_counts = word_scores[id(segment)]
+                    positions = np.minimum(np.searchsorted(score_docs, doc_ids), len(score_docs) - 1)
+                    found = score_docs[positions] == doc_ids
+                    scores[found] = score_values[positions[found]]
+                    matching_counts[found] = score_counts[positions[found]]
+                results.append((segment, doc_ids, scores, matching_counts))
+            return results
+
+        shard_results = _score_shards(segments, get_shards(segments), match_group, scorer_class.normalize, control)
+        results = _merge_word_results(segments, shard_results)
+        if count:
+            search_set.total = sum(len(result[1]) for result in results)
+        # 和 search 一样，各个分片分别选出前 top_k 个，再多路归并
+        word_ranks = {id(result[0]): rank for rank, result in enumerate(results)}
+        shard_hits = map_shards(lambda shard_result: _top_word_hits(shard_result, word_ranks, top_k), shard_results)
+        for key, rank, doc_id, matching_count in list(_merge_hits(shard_hits, top_k))[offset:]:
+            search_obj = SearchResultObject(Index.from_segment(results[rank][0], doc_id), raw, len(keywords),
+                                            SearchResultObjectType.WordMatch)
+            search_obj.matching_count = matching_count
+            search_obj.matching_score = -key
+            search_set.objects.append(search_obj)
+        search_set.partial = control.stopped
+        return search_set
+
+    @classmethod
+    def regex_match(cls, pattern: str, control: QueryControl = None, budget: RegexBudget = None) -> SearchResultSet:
         """
         正则匹配，在索引的clean_data里做正则匹配
+        表达式里一定出现的字面量先在 n-gram 索引里缩小范围，检查的候选文档数量和时间受 REGEX_MAX_CANDIDATES、REGEX_TIMEOUT 限制，
+        超过之后返回部分结果 (SearchResultSet.partial)
         :param pattern: 正则表达式
+        :param control: 控制搜索的截止时间和取消
+        :param budget: 正则匹配的预算，指定之后忽略 control
         :return: SearchResultSet
+        :raise re.error: 正则表达式语法错误
         """
+        budget = budget or RegexBudget(control or QueryControl())
         search_set = SearchResultSet()
-        for index in IndexManager.get_instance().indexes:
-            for field_name, clean_data in index.clean_data.items():
-                match_result = re.search(pattern, clean_data)
-                if match_result is not None:
-                    search_obj = SearchResultObject(index, pattern, 1, SearchResultObjectType.RegexMatch)
-                    search_obj.matching_score = 0  # 正则匹配的匹配度接近于0，所以这里取0
-                    search_set.add(search_obj)
-                    logger.debug('regex_match: {}'.format(search_obj.__dict__))
-                    break
+        for segment in IndexManager.get_instance().get_segments():
+            for doc_id in cls.regex_docs(segment, pattern, budget):
+                search_obj = SearchResultObject(Index.from_segment(segment, doc_id), pattern, 1, SearchResultObjectType.RegexMatch)
+                search_obj.matching_score = 0  # 正则匹配的匹配度接近于0，所以这里取0
+                search_set.add(search_obj)
+        search_set.partial = budget.stopped
         return search_set
+
+    @classmethod
+    def regex_docs(cls, segment, pattern: str, budget: RegexBudget):
+        """
+        在一个索引段里做正则匹配，编译好的表达式有缓存 (REGEX_CACHE_SIZE)
+        :param budget: 这次搜索的正则匹配预算
+        :return: 迭代匹配的 doc_id
+        """
+        return iter_matches(segment, compile_pattern(pattern), budget)
+
+
+def get_executor() -> ThreadPoolExecutor:
+    """
+    异步搜索使用的线程池
+    索引段是mmap映射的只读数据，多个线程可以同时搜索；numpy的向量运算会释放GIL
+    """
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(max_workers=ConfigManager.async_query_workers,
+                                               thread_name_prefix='cloversearch-query')
+    return _executor
+
+
+def get_shard_executor() -> ThreadPoolExecutor:
+    """并行搜索各个分片使用的线程池，SEARCH_SHARDS 变化之后重新创建"""
+    global _shard_executor, _shard_executor_size
+    with _executor_lock:
+        if _shard_executor is None or _shard_executor_size != ConfigManager.search_shards:
+            if _shard_executor is not None:
+                _shard_executor.shutdown(wait=False)
+            _shard_executor_size = ConfigManager.search_shards
+            _shard_executor = ThreadPoolExecutor(max_workers=_shard_executor_size, thread_name_prefix='cloversearch-shard')
+    return _shard_executor
+
+
+def get_shards(segments: list, shard_count: int = None) -> list:
+    """
+    把索引段按model分成若干个分片，同一个model的索引段在同一个分片里，相关度的统计数据不受分片影响
+    按文档数量从多到少，依次放进文档数量最少的分片
+    :param segments: 索引段列表
+    :param shard_count: 分片数量，不指定则使用配置 SEARCH_SHARDS，超过model数量时按model数量
+    :return: 每个分片的索引段序号列表
+    """
+    shard_count = shard_count or ConfigManager.search_shards
+    groups = OrderedDict()
+    for i, segment in enumerate(segments):
+        groups.setdefault((segment.app_name, segment.model_name), []).append(i)
+    shards = [[] for _ in range(max(min(shard_count, len(groups)), 1))]
+    sizes = [0] * len(shards)
+    for ordinals in sorted(groups.values(), key=lambda ordinals: -sum(segments[i].doc_count for i in ordinals)):
+        j = sizes.index(min(sizes))
+        shards[j].extend(ordinals)
+        sizes[j] += sum(segments[i].doc_count for i in ordinals)
+    return [sorted(shard) for shard in shards]
+
+
+def map_shards(func, shards) -> list:
+    """在线程池里并行处理各个分片，只有一个分片时直接在当前线程里处理"""
+    shards = list(shards)
+    if len(shards) <= 1:
+        return [func(shard) for shard in shards]
+    return list(get_shard_executor().map(func, shards))
+
+
+def _score_shards(segments: list, shards: list, score_group, normalize: bool, control: QueryControl = None) -> list:
+    """
+    在线程池里并行计算各个分片的相关度，同一个model的索引段一起交给 score_group，文档数量、平均字段长度等统计数据按整个model计算
+    :param shards: get_shards 得到的分片
+    :param score_group: 计算一个model的索引段，返回 [(索引段, doc_id数组, 相关度数组, 匹配词数量数组), ...]
+    :param normalize: 是否用所有分片里最大的相关度把相关度归一化到 0~1，全匹配 (匹配度为1) 的结果仍然排在前面
+    :param control: 每个model计算之前检查一次是否超时
+    :return: 每个分片的 [(索引段, doc_id数组, 相关度数组, 匹配词数量数组), ...]
+    """
+    def score_shard(shard: list) -> list:
+        model_segments = OrderedDict()
+        for i in shard:
+            model_segments.setdefault((segments[i].app_name, segments[i].model_name), []).append(segments[i])
+        results = []
+        for group in model_segments.values():
+            if control is not None and control.expired():
+                break
+            results.extend(score_group(group))
+        return results
+
+    shard_results = map_shards(score_shard, shards)
+    max_score = 0
+    for results in shard_results:
+        for result in results:
+            if len(result[2]) > 0:
+                max_score = max(max_score, float(result[2].max()))
+    if normalize and max_score > 0:
+        for results in shard_results:
+            for segment, doc_ids, scores, matching_counts in results:
+                scores /= max_score
+    return shard_results
+
+
+def _top_word_hits(results: list, word_ranks: dict, size: int) -> list:
+    """
+    选出相关度最高的 size 个词匹配结果：先用 partition 找出第 size 大的相关度，只对不小于它的结果排序
+    :param results: [(索引段, doc_id数组, 相关度数组, 匹配词数量数组), ...]
+    :param word_ranks: key: id(索引段), value: 词匹配结果的顺序，相关度相同时按这个顺序排列
+    :return: [(-相关度, 词匹配结果顺序, doc_id, 匹配词数量), ...]，已经排好序
+    """
+    if not results:
+        return []
+    scores = np.concatenate([result[2] for result in results])
+    size = min(size, len(scores))
+    if size <= 0:
+        return []
+    ranks = np.concatenate([np.full(len(result[1]), word_ranks[id(result[0])], dtype=np.int64) for result in results])
+    doc_ids = np.concatenate([result[1] for result in results])
+    matching_counts = np.concatenate([result[3] for result in results])
+    threshold = np.partition(scores, len(scores) - size)[len(scores) - size]
+    selected = np.flatnonzero(scores >= threshold)
+    order = selected[np.lexsort((doc_ids[selected], ranks[selected], -scores[selected]))][:size]
+    return [(-float(scores[i]), int(ranks[i]), int(doc_ids[i]), int(matching_counts[i])) for i in order.tolist()]
+
+
+def _merge_hits(shard_hits: list, size: int):
+    """多路归并各个分片排好序的结果，取前 size 个，与不分片时的顺序完全一样"""
+    return itertools.islice(heapq.merge(*shard_hits), max(size, 0))
+
+
+def _merge_word_results(segments: list, shard_results: list) -> list:
+    """把各个分片的词匹配结果按model在索引段列表里第一次出现的顺序合并，与不分片时的顺序一样"""
+    ordinals = {id(segment): i for i, segment in enumerate(segments)}
+    first = dict()
+    for i, segment in enumerate(segments):
+        first.setdefault((segment.app_name, segment.model_name), i)
+    results = [result for results in shard_results for result in results]
+    results.sort(key=lambda result: (first[(result[0].app_name, result[0].model_name)], ordinals[id(result[0])]))
+    return results
+
+
+def _reset_executor():
+    """fork之后子进程里没有线程池的线程，重新创建"""
+    global _executor, _executor_lock, _shard_executor
+    _executor = None
+    _executor_lock = threading.Lock()
+    _shard_executor = None
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_executor)
+
+
+def _query_key(raw: str, full_match: bool = False, regex_match: bool = False) -> str:
+    """
+    搜索结果缓存的key里的搜索词，只用于key，搜索时仍然使用原始的搜索词
+    词匹配只使用分词结果，空白不影响结果，规范化之后只有空白不同的搜索词可以共用缓存；全匹配和正则匹配与空白有关，使用原始搜索词
+    """
+    return raw if full_match or regex_match else normalize_query(raw)
+
+
+def _scoring_key(scoring: str or None) -> tuple:
+    """搜索结果缓存的key里影响词匹配结果的配置：相关度算法、模糊匹配和拼音匹配"""
+    return ((scoring or ConfigManager.scoring).lower(), ConfigManager.fuzzy_match, ConfigManager.fuzzy_max_distance,
+            ConfigManager.fuzzy_weight, ConfigManager.fuzzy_max_expansions, ConfigManager.pinyin_match,
+            ConfigManager.pinyin_weight)
+
+
+def _models_key(models: list or None) -> tuple or None:
+    """搜索结果缓存的key里的model列表，与顺序和大小写无关"""
+    return tuple(sorted({name.lower() for name in models})) if models else None
+
+
+def short_pattern(raw: str) -> str:
+    """短搜索词的正则匹配：每两个字符之间可以有一个其他字符，例如 '天气' 可以匹配 '天的气'"""
+    return r'\w'.join(re.escape(char) for char in raw)
+
+
+def _contains(doc_ids, doc_id: int) -> bool:
+    """在排好序的 doc_id 数组里查找"""
+    position = int(np.searchsorted(doc_ids, doc_id))
+    return position < len(doc_ids) and doc_ids[position] == doc_id
@@ -0,0 +1,201 @@
+from .config import ConfigManager
+from functools import lru_cache
+import logging
+import re
+import threading
+import time
+
+logger = logging.getLogger(ConfigManager.logger_name)
+
+# 每次从预算里申请的候选文档数量，多个分片的线程共用一个预算，不需要每个文档都加锁
+BUDGET_CHUNK = 256
+
+# 提取字面量使用标准库内部的正则解析器，以后的Python版本里可能变化，
+# 导入失败或者缺少用到的常量时不提取字面量，所有文档都做正则匹配
+try:
+    try:
+        from re import _parser as sre_parse
+    except ImportError:
+        # Python 3.10 及之前的版本
+        import sre_parse
+    _LITERAL = sre_parse.LITERAL
+    _SUBPATTERN = sre_parse.SUBPATTERN
+    _IGNORECASE = sre_parse.SRE_FLAG_IGNORECASE
+    # 零宽断言 (^、$、\b 等) 不占字符，前后的字面量仍然是连续的
+    _ZERO_WIDTH = {sre_parse.AT}
+    _REPEATS = {sre_parse.MAX_REPEAT, sre_parse.MIN_REPEAT}
+    if hasattr(sre_parse, 'POSSESSIVE_REPEAT'):
+        _REPEATS.add(sre_parse.POSSESSIVE_REPEAT)
+except (ImportError, AttributeError) as e:
+    logger.warning('无法使用正则解析器提取字面量，正则匹配会检查所有文档: {}'.format(e))
+    sre_parse = None
+
+
+class CompiledPattern:
+    """编译好的正则表达式，以及匹配的文本里一定会出现的字面量"""
+
+    __slots__ = ('pattern', 'regex', 'literals')
+
+    def __init__(self, pattern: str, regex, literals: list):
+        """
+        :param pattern: 正则表达式
+        :param regex: re.compile 的结果
+        :param literals: 匹配的文本里一定包含的字符串，为空时不能用 n-gram 索引缩小范围
+        """
+        self.pattern = pattern
+        self.regex = regex
+        self.literals = literals
+
+    def __repr__(self):
+        return '<CompiledPattern {} literals:{}>'.format(self.pattern, self.literals)
+
+
+class RegexBudget:
+    """
+    一次正则匹配的预算：最多检查的候选文档数量和时间上限，同一次搜索的所有分片共用
+    预算用完之后停止匹配，exhausted 为 True，搜索结果标记为部分结果
+    """
+
+    def __init__(self, control=None, max_candidates: int = None, timeout: float = None):
+        """
+        :param control: 这次搜索的 QueryControl，超时或者被取消时同样停止
+        :param max_candidates: 最多检查的候选文档数量，不指定则使用配置 REGEX_MAX_CANDIDATES，为0时不限制
+        :param timeout: 时间上限 (秒)，不指定则使用配置 REGEX_TIMEOUT，为0时不限制
+        """
+        self.control = control
+        self.max_candidates = ConfigManager.regex_max_candidates if max_candidates is None else max_candidates
+        timeout = ConfigManager.regex_timeout if timeout is None else timeout
+        self.deadline = time.monotonic() + timeout if timeout else None
+        # 已经分配出去的候选文档数量
+        self.checked = 0
+        self.exhausted = False
+        self.lock = threading.Lock()
+
+    def take(self, count: int) -> int:
+        """
+        申请检查 count 个候选文档
+        :return: 可以检查的数量，小于 count 说明预算已经用完
+        """
+        if not self.max_candidates:
+            return count
+        with self.lock:
+            allowed = max(min(count, self.max_candidates - self.checked), 0)
+            self.checked += allowed
+            if allowed < count:
+                self.exhausted = True
+        return allowed
+
+    @property
+    def stopped(self) -> bool:
+        """预算用完，或者整个搜索已经超时、被取消"""
+        return self.exhausted or (self.control is not None and self.control.stopped)
+
+    def expired(self) -> bool:
+        """是否超过时间上限，或者整个搜索已经超时、被取消；候选文档数量由 take 控制"""
+        if self.control is not None and self.control.expired():
+            return True
+        if self.deadline is not None and time.monotonic() >= self.deadline:
+            self.exhausted = True
+            return True
+        return False
+
+
+def _required_literals(items, literals: list, run: list) -> bool:
+    """
+    遍历解析后的正则表达式，收集一定会出现的连续字面量
+    :param items: sre_parse 解析的结果
+    :param literals: 收集到的字面量
+    :param run: 正在拼接的连续字面量
+    :return: items 是否全部是字面量 (可以和前后的字面量拼接在一起)
+    """
+    plain = True
+    for op, av in items:
+        if op is _LITERAL:
+            run.append(chr(av))
+            continue
+        if op in _ZERO_WIDTH:
+            continue
+        if op is _SUBPATTERN and not av[1] & _IGNORECASE:
+            # 分组：(?:abc) 里的字面量与前后连在一起
+            if _required_literals(av[-1], literals, run):
+                continue
+        elif op in _REPEATS and av[0] >= 1:
+            # 至少出现一次的重复，里面的字面量一定出现，但是与前后不连续
+            _flush(literals, run)
+            _required_literals(av[-1], literals, run)
+        plain = False
+        _flush(literals, run)
+    return plain
+
+
+def _flush(literals: list, run: list):
+    if run:
+        literals.append(''.join(run))
+        run.clear()
+
+
+def extract_literals(pattern: str, flags: int = 0) -> list:
+    """
+    找出匹配的文本里一定会出现的字符串，例如 'python\\d+教程' -> ['python', '教程']
+    分支 (|)、字符集、忽略大小写等情况里的字面量不一定出现，不提取
+    解析器不可用或者解析结果的结构和预期不一致时返回空列表，退回到检查所有文档，结果不会漏掉
+    :param flags: 正则表达式的标记，应该包括表达式里的 (?i) 等全局标记 (re.compile(pattern).flags)
+    :return: 字面量列表，按长度从长到短
+    """
+    if sre_parse is None or flags & re.IGNORECASE:
+        return []
+    try:
+        parsed = sre_parse.parse(pattern, flags)
+        literals, run = [], []
+        _required_literals(parsed, literals, run)
+        _flush(literals, run)
+    except Exception as e:
+        logger.debug('正则表达式 {} 不提取字面量: {}'.format(pattern, e))
+        return []
+    return sorted(set(literals), key=lambda literal: -len(literal))
+
+
+@lru_cache(maxsize=ConfigManager.regex_cache_size)
+def compile_pattern(pattern: str) -> CompiledPattern:
+    """
+    编译正则表达式，重复的表达式直接使用缓存的结果
+    :raise re.error: 正则表达式语法错误
+    """
+    regex = re.compile(pattern)
+    return CompiledPattern(pattern, regex, extract_literals(pattern, regex.flags))
+
+
+def candidate_docs(segment, compiled: CompiledPattern) -> list:
+    """
+    用字面量在 n-gram 索引里找出可能匹配的文档，没有字面量时返回所有未删除的文档
+    :return: 按顺序排列的 doc_id 列表
+    """
+    if not compiled.literals:
+        return [doc_id for doc_id in range(segment.doc_count) if doc_id not in segment.deleted]
+    candidates = None
+    for literal in compiled.literals:
+        doc_ids = segment.get_candidates(literal)
+        candidates = set(doc_ids) if candidates is None else candidates.intersection(doc_ids)
+        if not candidates:
+            return []
+    return sorted(candidates)
+
+
+def iter_matches(segment, compiled: CompiledPattern, budget: RegexBudget):
+    """
+    在一个索引段里做正则匹配，只读取段文件里的 clean_data，不查询数据库
+    :return: 迭代匹配的 doc_id
+    """
+    candidates = candidate_docs(segment, compiled)
+    allowed = 0
+    for position, doc_id in enumerate(candidates):
+        if position >= allowed:
+            allowed += budget.take(min(BUDGET_CHUNK, len(candidates) - position))
+            if position >= allowed:
+                return
+        if budget.expired():
+            return
+        for clean_data in segment.get_clean_data(doc_id).values():
+            if compiled.regex.search(clean_data) is not None:
+                yield doc_id
+                break
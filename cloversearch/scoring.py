@@ -0,0 +1,210 @@
+from .config import ConfigManager
+from .index_builder import read_field_config
+import logging
+import numpy as np
+import os
+
+logger = logging.getLogger(ConfigManager.logger_name)
+
+# 字段权重缓存, key: app_name, value: (配置文件修改时间, {Model名称: {字段名: 权重}})
+_field_boosts_cache = dict()
+
+
+def get_field_boosts(app_name: str, model_name: str) -> dict:
+    """
+    获取model各个字段的词匹配权重，配置文件修改之后自动重新读取
+    :return: dict, key: 字段名, value: 权重
+    """
+    field_config_filepath = os.path.join(ConfigManager.config_dir, app_name + ConfigManager.field_config_filename_suffix)
+    try:
+        mtime = os.stat(field_config_filepath).st_mtime_ns
+    except OSError:
+        mtime = None
+    cached = _field_boosts_cache.get(app_name)
+    if cached is None or cached[0] != mtime:
+        cached = (mtime, read_field_config(app_name))
+        _field_boosts_cache[app_name] = cached
+    return cached[1].get(model_name, {})
+
+
+class Scorer:
+    """
+    词匹配相关度计算，一次计算同一个model的所有索引段
+    倒排列表按列保存，计算时直接转换成numpy数组，对整个倒排列表做向量运算
+    """
+
+    # 是否需要把相关度归一化到 0~1
+    normalize = True
+
+    def __init__(self, segments: list, word_counts: dict, expansions: dict = None):
+        """
+        :param segments: 同一个model的索引段列表
+        :param word_counts: key: 关键词, value: 关键词在搜索词里出现的次数
+        :param expansions: 模糊匹配、拼音匹配扩展的词, key: 关键词, value: [(相近的词, 权重), ...]
+        """
+        self.segments = segments
+        self.word_counts = word_counts
+        self.expansions = expansions or {}
+        self.keyword_count = sum(word_counts.values())
+        # 整个model的文档数量 (包括已删除的文档)
+        self.doc_count = sum(segment.doc_count for segment in segments)
+        # key: (第几个索引段, 关键词), value: (doc_id数组, 字段下标数组, 词频数组)
+        self.postings = dict()
+        # key: 关键词, value: 包含关键词的文档数量
+        self.doc_freqs = dict()
+        words = set(word_counts)
+        for terms in self.expansions.values():
+            words.update(term for term, weight in terms)
+        for i, segment in enumerate(segments):
+            for word in words:
+                docs, fields, tfs = segment.get_postings(word)
+                postings = (np.asarray(docs, dtype=np.uint32), np.asarray(fields, dtype=np.intp), np.asarray(tfs, dtype=np.float64))
+                self.postings[(i, word)] = postings
+                self.doc_freqs[word] = self.doc_freqs.get(word, 0) + _count_docs(postings[0])
+
+    def score(self):
+        """
+        计算相关度
+        :return: 迭代 (索引段, doc_id数组, 相关度数组, 匹配词数量数组)，只包含匹配到的未删除文档
+        """
+        for i, segment in enumerate(self.segments):
+            scores = np.zeros(segment.doc_count, dtype=np.float64)
+            matching_counts = np.zeros(segment.doc_count, dtype=np.int64)
+            context = self.prepare(segment)
+            for word, word_count in self.word_counts.items():
+                docs, fields, tfs = self.postings[(i, word)]
+                if len(docs) == 0:
+                    continue
+                weights = self.term_weights(segment, context, word, docs, fields, tfs)
+                scores += np.bincount(docs, weights=weights, minlength=segment.doc_count) * word_count
+                matching_counts[np.unique(docs)] += word_count
+            for keyword, terms in self.expansions.items():
+                # 扩展的词按权重计算相关度，包含任意一个扩展词的文档算作匹配了这个关键词
+                word_count = self.word_counts.get(keyword, 1)
+                matched = np.zeros(segment.doc_count, dtype=bool)
+                for term, weight in terms:
+                    docs, fields, tfs = self.postings[(i, term)]
+                    if len(docs) == 0:
+                        continue
+                    weights = self.term_weights(segment, context, term, docs, fields, tfs)
+                    scores += np.bincount(docs, weights=weights, minlength=segment.doc_count) * word_count * weight
+                    matched[docs] = True
+                matching_counts[matched] += word_count
+            if segment.deleted:
+                matching_counts[list(segment.deleted)] = 0
+            doc_ids = np.flatnonzero(matching_counts)
+            if len(doc_ids) > 0:
+                yield segment, doc_ids, self.finish(scores[doc_ids], matching_counts[doc_ids]), matching_counts[doc_ids]
+
+    def prepare(self, segment):
+        """计算一个索引段之前的准备工作，返回值传给 term_weights"""
+        return None
+
+    def term_weights(self, segment, context, word: str, docs, fields, tfs):
+        """
+        计算倒排列表里每一项的相关度
+        :return: numpy数组，与倒排列表一一对应
+        """
+        raise NotImplementedError
+
+    def finish(self, scores, matching_counts):
+        return scores
+
+
+class CountScorer(Scorer):
+    """匹配度 = 匹配词数量 / 关键词数量"""
+
+    normalize = False
+
+    def term_weights(self, segment, context, word: str, docs, fields, tfs):
+        return np.zeros(len(docs), dtype=np.float64)
+
+    def finish(self, scores, matching_counts):
+        return matching_counts / self.keyword_count
+
+
+class FieldScorer(Scorer):
+    """按字段计算相关度的基类，每个字段有各自的权重和平均长度"""
+
+    def __init__(self, segments: list, word_counts: dict, expansions: dict = None):
+        super(FieldScorer, self).__init__(segments, word_counts, expansions)
+        # 整个model每个字段的总词数
+        length_sums = dict()
+        for segment in segments:
+            for field_name, length_sum in zip(segment.fields, segment.get_field_length_sums()):
+                length_sums[field_name] = length_sums.get(field_name, 0) + int(length_sum)
+        self.avg_lengths = {field_name: max(length_sum / max(self.doc_count, 1), 1.0)
+                            for field_name, length_sum in length_sums.items()}
+        self.field_boosts = get_field_boosts(segments[0].app_name, segments[0].model_name) if segments else {}
+
+    def prepare(self, segment):
+        boosts = np.array([self.field_boosts.get(field_name, 1.0) for field_name in segment.fields], dtype=np.float64)
+        avg_lengths = np.array([self.avg_lengths.get(field_name, 1.0) for field_name in segment.fields], dtype=np.float64)
+        return boosts, avg_lengths, segment.get_field_lengths()
+
+    def idf(self, word: str) -> float:
+        raise NotImplementedError
+
+
+class BM25Scorer(FieldScorer):
+    """
+    BM25，词频的作用会逐渐饱和，较长的字段会按平均长度归一化
+    score = idf * tf * (k1 + 1) / (tf + k1 * (1 - b + b * 字段长度 / 平均字段长度))
+    """
+
+    def __init__(self, segments: list, word_counts: dict, expansions: dict = None):
+        super(BM25Scorer, self).__init__(segments, word_counts, expansions)
+        self.k1 = ConfigManager.bm25_k1
+        self.b = ConfigManager.bm25_b
+
+    def idf(self, word: str) -> float:
+        doc_freq = self.doc_freqs[word]
+        return np.log(1 + (self.doc_count - doc_freq + 0.5) / (doc_freq + 0.5))
+
+    def term_weights(self, segment, context, word: str, docs, fields, tfs):
+        boosts, avg_lengths, field_lengths = context
+        lengths = field_lengths[docs, fields]
+        norms = self.k1 * (1 - self.b + self.b * lengths / avg_lengths[fields])
+        return boosts[fields] * self.idf(word) * tfs * (self.k1 + 1) / (tfs + norms)
+
+
+class TfIdfScorer(FieldScorer):
+    """
+    TF-IDF，词频取对数，并且按字段长度的平方根归一化
+    score = (1 + log(tf)) * idf / sqrt(字段长度 / 平均字段长度)
+    """
+
+    def idf(self, word: str) -> float:
+        return np.log(1 + self.doc_count / self.doc_freqs[word])
+
+    def term_weights(self, segment, context, word: str, docs, fields, tfs):
+        boosts, avg_lengths, field_lengths = context
+        lengths = np.maximum(field_lengths[docs, fields], 1)
+        return boosts[fields] * (1 + np.log(tfs)) * self.idf(word) / np.sqrt(lengths / avg_lengths[fields])
+
+
+SCORERS = {
+    'bm25': BM25Scorer,
+    'tfidf': TfIdfScorer,
+    'count': CountScorer,
+}
+
+
+def get_scorer(name: str = None):
+    """
+    获取相关度算法
+    :param name: 算法名称，不指定则使用配置
+    :return: Scorer 子类
+    """
+    name = (name or ConfigManager.scoring).lower()
+    if name not in SCORERS:
+        logger.warning('不支持的相关度算法: {}，使用bm25'.format(name))
+        name = 'bm25'
+    return SCORERS[name]
+
+
+def _count_docs(docs) -> int:
+    """倒排列表按 doc_id 排序，同一个文档的多个字段相邻"""
+    if len(docs) == 0:
+        return 0
+    return int(np.count_nonzero(docs[1:] != docs[:-1])) + 1
@@ -0,0 +1,1094 @@
+from collections import Counter
+from .processer import NGRAM_SIZE, ngram_split
+import array
+import heapq
+import itertools
+import mmap
+import numpy as np
+import os
+import shutil
+import struct
+import sys
+import tempfile
+import threading
+import time
+import ujson as json
+import lzma
+import zlib
+
+# 段文件：一个model的全部索引数据保存在一个文件里，读取时使用mmap映射，不需要把数据全部读进内存
+SEGMENT_SUFFIX = '.seg'
+MAGIC = b'CLOVSEG1'
+VERSION = 2
+
+# 版本1的段文件没有压缩，仍然可以读取
+SECTIONS_V1 = (
+    'meta',
+    'pk_offsets', 'pk_data',
+    'term_offsets', 'term_data', 'term_postings',
+    # 倒排列表: 按列保存 (文档, 字段, 词频)
+    'posting_docs', 'posting_fields', 'posting_tfs',
+    'gram_offsets', 'gram_data', 'gram_postings', 'gram_docs',
+    'field_lengths',
+    # 存储字段: 每个文档每个字段的 clean_data
+    'stored_offsets', 'stored_data',
+)
+ARRAY_TYPES_V1 = {
+    'pk_offsets': 'Q',
+    'term_offsets': 'I',
+    'term_postings': 'I',
+    'posting_docs': 'I',
+    'posting_fields': 'H',
+    'posting_tfs': 'I',
+    'gram_offsets': 'I',
+    'gram_postings': 'I',
+    'gram_docs': 'I',
+    'field_lengths': 'I',
+    'stored_offsets': 'Q',
+}
+
+# 段文件按顺序保存以下区域，文件头记录每个区域的 (偏移, 长度)
+SECTIONS = (
+    # 元数据: app/model名称、字段列表、文档数量等
+    'meta',
+    # 主键: 每个文档主键在 pk_data 里的偏移
+    'pk_offsets', 'pk_data',
+    # 词典: 按utf-8字节排序的词，以及每个词的倒排列表的长度 (term_postings) 和在 posting_data 里的字节范围 (posting_offsets)
+    'term_offsets', 'term_data', 'term_postings', 'posting_offsets',
+    # 倒排列表: 每个词一块，依次是 doc_id 的差值、字段、词频，都用varint编码
+    'posting_data',
+    # n-gram 词典与对应的文档列表 (doc_id 的差值，varint编码)，gram_postings 是字节范围
+    'gram_offsets', 'gram_data', 'gram_postings', 'gram_docs',
+    # 每个文档每个字段的词数量
+    'field_lengths',
+    # 存储字段: 每 STORED_BLOCK_SIZE 个文档的 clean_data 压缩成一块，stored_offsets 是每块的字节范围
+    'stored_offsets', 'stored_data',
+)
+# 数组区域的类型
+ARRAY_TYPES = {
+    'pk_offsets': 'Q',
+    'term_offsets': 'I',
+    'term_postings': 'I',
+    'posting_offsets': 'Q',
+    'gram_offsets': 'I',
+    'gram_postings': 'Q',
+    'field_lengths': 'I',
+    'stored_offsets': 'Q',
+}
+# 每个版本的区域和数组类型
+FORMATS = {
+    1: (SECTIONS_V1, ARRAY_TYPES_V1),
+    VERSION: (SECTIONS, ARRAY_TYPES),
+}
+
+# 存储字段每块的文档数量，读取一个文档时解压整块
+STORED_BLOCK_SIZE = 32
+# 存储字段的压缩方式
+STORED_COMPRESSION = 'zlib'
+COMPRESSORS = {
+    'zlib': (zlib.compress, zlib.decompress),
+    'lzma': (lzma.compress, lzma.decompress),
+}
+# 每个段文件缓存的解压之后的块数量，全匹配、正则匹配按 doc_id 顺序读取，连续的文档在同一块里
+STORED_CACHE_BLOCKS = 64
+# 数据区域: 倒排列表、n-gram 文档列表、文档长度、存储字段，第一次搜索这个model时才映射，可以释放；
+# 其他区域 (元数据、主键、词典) 打开段文件时就映射
+DATA_SECTIONS = (
+    'posting_docs', 'posting_fields', 'posting_tfs', 'posting_data', 'gram_docs',
+    'field_lengths', 'stored_offsets', 'stored_data',
+)
+# 文件头: magic, 版本, 区域数量，后面跟着每个区域的 (偏移, 长度)
+HEADER = struct.Struct('<8sII')
+SECTION_ENTRY = struct.Struct('<QQ')
+# 区域按8字节对齐
+ALIGNMENT = 8
+
+EMPTY_POSTINGS = ((), (), ())
+
+# 估算 SegmentWriter 内存占用时使用的大致数值 (字节)
+DOC_MEMORY = 200
+POSTING_MEMORY = 12
+TERM_MEMORY = 450
+GRAM_DOC_MEMORY = 5
+GRAM_MEMORY = 220
+# 流式写入段文件时，数组缓冲区满了就写入临时文件
+BUFFER_SIZE = 65536
+
+
+class SegmentError(Exception):
+    """段文件格式错误"""
+    pass
+
+
+class Segment:
+    """
+    索引段，保存一个model的索引数据
+    文档在段内用 doc_id (0 ~ doc_count-1) 表示
+    """
+
+    app_name = ''
+    model_name = ''
+    # 字段名称列表，倒排列表里的字段用下标表示
+    fields = []
+    ngram_size = NGRAM_SIZE
+
+    def __init__(self, app_name: str, model_name: str):
+        self.app_name = app_name
+        self.model_name = model_name
+        self.fields = list()
+        # 已删除的 doc_id，搜索时跳过
+        self.deleted = set()
+        # 按主键查找 doc_id 使用的索引，第一次按主键查找文档时才建立
+        self._doc_ids = None
+        # 每个字段的总词数，计算相关度时用来求平均字段长度，(文档数量, 总词数)
+        self._field_length_sums = None
+        # 模糊匹配、拼音匹配使用的词典辅助索引，(文档数量, TermIndex)，见 term_index.get_term_index
+        self._term_index = None
+
+    def __repr__(self):
+        return '<{} {}.{} docs:{}>'.format(type(self).__name__, self.app_name, self.model_name, self.doc_count)
+
+    @property
+    def doc_count(self) -> int:
+        raise NotImplementedError
+
+    def get_primary_key(self, doc_id: int) -> str:
+        raise NotImplementedError
+
+    def get_clean_data(self, doc_id: int) -> dict:
+        raise NotImplementedError
+
+    def get_field_length(self, doc_id: int, field_id: int) -> int:
+        raise NotImplementedError
+
+    def get_field_lengths(self):
+        """
+        获取所有文档所有字段的词数量
+        :return: numpy数组，形状为 (文档数量, 字段数量)
+        """
+        raise NotImplementedError
+
+    def get_field_length_sums(self):
+        """
+        获取每个字段的总词数，文档数量不变时使用缓存
+        :return: numpy数组，长度为字段数量
+        """
+        doc_count = self.doc_count
+        if self._field_length_sums is None or self._field_length_sums[0] != doc_count:
+            sums = self.get_field_lengths().sum(axis=0, dtype=np.int64)
+            self._field_length_sums = (doc_count, sums)
+        return self._field_length_sums[1]
+
+    def get_postings(self, word: str) -> tuple:
+        """
+        获取一个词的倒排列表
+        :return: (doc_id 列表, 字段下标列表, 词频列表)
+        """
+        raise NotImplementedError
+
+    def get_gram_docs(self, gram: str):
+        """获取包含这个字符片段的 doc_id 列表"""
+        raise NotImplementedError
+
+    def iter_terms(self):
+        """遍历词典里的所有词"""
+        raise NotImplementedError
+
+    def iter_grams(self):
+        """遍历 n-gram 索引里的所有字符片段"""
+        raise NotImplementedError
+
+    def matches_model(self, name: str) -> bool:
+        """name 是否表示这个索引段的model，可以是 Model名称 或者 app_name.Model名称，不区分大小写"""
+        name = name.lower()
+        return name in (self.model_name.lower(), '{}.{}'.format(self.app_name, self.model_name).lower())
+
+    def get_doc_id(self, primary_key) -> int or None:
+        """通过主键查找 doc_id"""
+        if self._doc_ids is None:
+            self._doc_ids = {self.get_primary_key(doc_id): doc_id for doc_id in range(self.doc_count)}
+        return self._doc_ids.get(str(primary_key))
+
+    def get_candidates(self, data: str) -> list:
+        """
+        通过 n-gram 索引找出可能包含 data 的文档，结果还需要再做一次子串匹配确认
+        :param data: 经过字符过滤的搜索词
+        :return: 按顺序排列的 doc_id 列表
+        """
+        if len(data) == 0:
+            candidates = np.arange(self.doc_count)
+        else:
+            grams = ngram_split(data, min(len(data), self.ngram_size))
+            # 从最短的列表开始求交集，每个列表都是排好序的，在较长的列表里二分查找较短列表的每个 doc_id
+            # 复制一份：实时索引的后台线程还会继续追加数据
+            doc_lists = sorted((np.array(self.get_gram_docs(gram), dtype=np.int64) for gram in grams), key=len)
+            candidates = doc_lists[0]
+            for doc_list in doc_lists[1:]:
+                if len(candidates) == 0:
+                    break
+                positions = np.minimum(np.searchsorted(doc_list, candidates), len(doc_list) - 1)
+                candidates = candidates[doc_list[positions] == candidates]
+        if self.deleted:
+            candidates = candidates[~np.isin(candidates, list(self.deleted))]
+        return candidates.tolist()
+
+
+class SegmentWriter(Segment):
+    """在内存中建立的索引段，可以直接搜索，也可以写入段文件"""
+
+    def __init__(self, app_name: str, model_name: str):
+        super(SegmentWriter, self).__init__(app_name, model_name)
+        self.field_ids = dict()
+        self.primary_keys = list()
+        # 每个文档的 clean_data 与字段词数量, key: 字段下标
+        self.stored = list()
+        self.field_lengths = list()
+        # key: 词, value: (doc_id数组, 字段下标数组, 词频数组)，按列保存在 array 里，不为每个数字创建对象
+        self.postings = dict()
+        # key: 字符片段, value: doc_id数组
+        self.grams = dict()
+        # 估算的内存占用 (字节)，用于建立索引时控制内存
+        self.memory_size = 0
+
+    @property
+    def doc_count(self) -> int:
+        return len(self.primary_keys)
+
+    def get_field_id(self, field_name: str) -> int:
+        if field_name not in self.field_ids:
+            self.field_ids[field_name] = len(self.fields)
+            self.fields.append(field_name)
+        return self.field_ids[field_name]
+
+    def add(self, primary_key, keywords: dict, clean_data: dict) -> int:
+        """
+        添加一个文档
+        :param primary_key: 主键
+        :param keywords: key: 字段名, value: 分词结果
+        :param clean_data: key: 字段名, value: 过滤字符后的内容
+        :return: doc_id
+        """
+        stored = {self.get_field_id(field_name): data for field_name, data in clean_data.items()}
+        field_lengths = {self.get_field_id(field_name): len(words_list) for field_name, words_list in keywords.items()}
+        doc_id = self.add_stored(primary_key, stored, field_lengths)
+        for field_name, words_list in keywords.items():
+            field_id = self.get_field_id(field_name)
+            for word, tf in Counter(words_list).items():
+                self.add_posting(word, doc_id, field_id, tf)
+        grams = set()
+        for data in clean_data.values():
+            for n in range(1, self.ngram_size + 1):
+                grams.update(ngram_split(data, n))
+        for gram in grams:
+            self.add_gram(gram, doc_id)
+        return doc_id
+
+    def add_stored(self, primary_key, stored: dict, field_lengths: dict) -> int:
+        """
+        添加一个文档的存储字段，要在添加倒排列表之前调用
+        实时索引时搜索线程会同时读取，所以文档的数据要先于倒排列表写入
+        :param stored: key: 字段下标, value: clean_data
+        :param field_lengths: key: 字段下标, value: 词数量
+        :return: doc_id
+        """
+        self.stored.append(stored)
+        self.field_lengths.append(field_lengths)
+        self.primary_keys.append(str(primary_key))
+        self.memory_size += DOC_MEMORY + sum(len(data) for data in stored.values()) * 2
+        doc_id = len(self.primary_keys) - 1
+        if self._doc_ids is not None:
+            self._doc_ids[self.primary_keys[doc_id]] = doc_id
+        return doc_id
+
+    def add_posting(self, word: str, doc_id: int, field_id: int, tf: int):
+        if word not in self.postings:
+            self.postings[word] = (array.array('I'), array.array('H'), array.array('I'))
+            self.memory_size += TERM_MEMORY
+        docs, fields, tfs = self.postings[word]
+        docs.append(doc_id)
+        fields.append(field_id)
+        tfs.append(tf)
+        self.memory_size += POSTING_MEMORY
+
+    def add_gram(self, gram: str, doc_id: int):
+        if gram not in self.grams:
+            self.grams[gram] = array.array('I')
+            self.memory_size += GRAM_MEMORY
+        self.grams[gram].append(doc_id)
+        self.memory_size += GRAM_DOC_MEMORY
+
+    def extend(self, segment: Segment):
+        """
+        把另一个索引段的文档追加到这个索引段，跳过已删除的文档
+        :param segment: 索引段
+        """
+        field_ids = [self.get_field_id(field_name) for field_name in segment.fields]
+        # 原 doc_id -> 新 doc_id
+        doc_ids = {}
+        for doc_id in range(segment.doc_count):
+            if doc_id in segment.deleted:
+                continue
+            clean_data = segment.get_clean_data(doc_id)
+            stored = {field_ids[field_id]: clean_data[field_name] for field_id, field_name in enumerate(segment.fields)}
+            field_lengths = {field_ids[field_id]: segment.get_field_length(doc_id, field_id)
+                             for field_id in range(len(segment.fields))}
+            doc_ids[doc_id] = self.add_stored(segment.get_primary_key(doc_id), stored, field_lengths)
+        for word in segment.iter_terms():
+            docs, fields, tfs = segment.get_postings(word)
+            for doc_id, field_id, tf in zip(docs, fields, tfs):
+                if doc_id in doc_ids:
+                    self.add_posting(word, doc_ids[doc_id], field_ids[field_id], tf)
+        for gram in segment.iter_grams():
+            for doc_id in segment.get_gram_docs(gram):
+                if doc_id in doc_ids:
+                    self.add_gram(gram, doc_ids[doc_id])
+
+    @classmethod
+    def merge(cls, app_name: str, model_name: str, segments: list):
+        """
+        合并多个索引段，跳过已删除的文档
+        :param segments: 索引段列表，合并后的文档顺序与列表顺序一致
+        :return: SegmentWriter
+        """
+        writer = cls(app_name, model_name)
+        for segment in segments:
+            writer.extend(segment)
+        return writer
+
+    def get_primary_key(self, doc_id: int) -> str:
+        return self.primary_keys[doc_id]
+
+    def get_clean_data(self, doc_id: int) -> dict:
+        stored = self.stored[doc_id]
+        return {field_name: stored.get(field_id, '') for field_id, field_name in enumerate(self.fields)}
+
+    def get_field_length(self, doc_id: int, field_id: int) -> int:
+        return self.field_lengths[doc_id].get(field_id, 0)
+
+    def get_field_lengths(self):
+        lengths = np.zeros((self.doc_count, len(self.fields)), dtype=np.uint32)
+        for doc_id, field_lengths in enumerate(self.field_lengths):
+            for field_id, length in field_lengths.items():
+                lengths[doc_id, field_id] = length
+        return lengths
+
+    def get_postings(self, word: str) -> tuple:
+        postings = self.postings.get(word)
+        if postings is None:
+            return EMPTY_POSTINGS
+        # 返回副本：实时索引的后台线程还会继续追加数据，array 被 numpy 引用时不能扩容
+        return tuple(column[:] for column in postings)
+
+    def get_gram_docs(self, gram: str):
+        return self.grams.get(gram, ())
+
+    def iter_terms(self):
+        return iter(list(self.postings))
+
+    def iter_grams(self):
+        return iter(list(self.grams))
+
+    def write(self, path: str, version: int = VERSION, compression: str = None):
+        """
+        把索引段写入文件
+        :param version: 段文件版本，默认写入当前版本
+        :param compression: 存储字段的压缩方式 (zlib/lzma)，不指定则使用 STORED_COMPRESSION
+        """
+        if version == 1:
+            return self._write_v1(path)
+        compression = compression or STORED_COMPRESSION
+        out = SegmentFile(path)
+        out.write('meta', _pack_meta(self.app_name, self.model_name, self.fields, self.doc_count, self.ngram_size,
+                                     stored_block_size=STORED_BLOCK_SIZE, stored_compression=compression))
+        out.write_strings('pk_offsets', 'pk_data', self.primary_keys)
+
+        # 词典按utf-8字节排序，读取时就可以直接在mmap上二分查找
+        terms = sorted(self.postings, key=lambda item: item.encode('utf-8'))
+        out.write_strings('term_offsets', 'term_data', terms)
+        term_postings = array.array('I', [0])
+        postings = _PostingBuffer(out, 'posting_offsets', 'posting_data', ('I', 'H', 'I'))
+        for term in terms:
+            postings.extend(*self.postings[term])
+            postings.end_block()
+            term_postings.append(postings.count)
+        postings.flush()
+        out.write('term_postings', term_postings)
+
+        grams = sorted(self.grams, key=lambda item: item.encode('utf-8'))
+        out.write_strings('gram_offsets', 'gram_data', grams)
+        gram_docs = _PostingBuffer(out, 'gram_postings', 'gram_docs', ('I',))
+        for gram in grams:
+            gram_docs.extend(self.grams[gram])
+            gram_docs.end_block()
+        gram_docs.flush()
+
+        # 存储字段按 文档 * 字段 展开
+        field_lengths = array.array('I')
+        stored = _StoredBuffer(out, STORED_BLOCK_SIZE, compression)
+        for doc_id in range(self.doc_count):
+            for field_id in range(len(self.fields)):
+                field_lengths.append(self.field_lengths[doc_id].get(field_id, 0))
+            stored.append([self.stored[doc_id].get(field_id, '') for field_id in range(len(self.fields))])
+        stored.flush()
+        out.write('field_lengths', field_lengths)
+        out.close()
+
+    def _write_v1(self, path: str):
+        """写入没有压缩的版本1段文件，只用于比较压缩效果"""
+        out = SegmentFile(path, 1)
+        out.write('meta', _pack_meta(self.app_name, self.model_name, self.fields, self.doc_count, self.ngram_size))
+        out.write_strings('pk_offsets', 'pk_data', self.primary_keys)
+
+        # 词典按utf-8字节排序，读取时就可以直接在mmap上二分查找
+        terms = sorted(self.postings, key=lambda item: item.encode('utf-8'))
+        out.write_strings('term_offsets', 'term_data', terms)
+        term_postings = array.array('I', [0])
+        posting_docs, posting_fields, posting_tfs = array.array('I'), array.array('H'), array.array('I')
+        for term in terms:
+            docs, fields, tfs = self.postings[term]
+            posting_docs.extend(docs)
+            posting_fields.extend(fields)
+            posting_tfs.extend(tfs)
+            term_postings.append(len(posting_docs))
+        out.write('term_postings', term_postings)
+        out.write('posting_docs', posting_docs)
+        out.write('posting_fields', posting_fields)
+        out.write('posting_tfs', posting_tfs)
+
+        grams = sorted(self.grams, key=lambda item: item.encode('utf-8'))
+        out.write_strings('gram_offsets', 'gram_data', grams)
+        gram_postings = array.array('I', [0])
+        gram_docs = array.array('I')
+        for gram in grams:
+            gram_docs.extend(self.grams[gram])
+            gram_postings.append(len(gram_docs))
+        out.write('gram_postings', gram_postings)
+        out.write('gram_docs', gram_docs)
+
+        # 存储字段按 文档 * 字段 展开
+        field_lengths = array.array('I')
+        stored = []
+        for doc_id in range(self.doc_count):
+            for field_id in range(len(self.fields)):
+                field_lengths.append(self.field_lengths[doc_id].get(field_id, 0))
+                stored.append(self.stored[doc_id].get(field_id, ''))
+        out.write('field_lengths', field_lengths)
+        out.write_strings('stored_offsets', 'stored_data', stored)
+        out.close()
+
+
+class SegmentFile:
+    """
+    段文件写入器，各个区域可以分多次写入，数据先保存在临时文件里，关闭时再按 SECTIONS 的顺序拼接成段文件
+    合并很大的索引段时不需要把数据全部放在内存里
+    """
+
+    def __init__(self, path: str, version: int = VERSION):
+        """
+        :param path: 段文件路径
+        :param version: 段文件版本，决定有哪些区域
+        """
+        self.path = path
+        self.version = version
+        self.sections, self.array_types = FORMATS[version]
+        directory = os.path.dirname(os.path.abspath(path))
+        self.buffers = {name: tempfile.TemporaryFile(dir=directory) for name in self.sections}
+        # 字符串区域当前的长度，用于计算偏移
+        self.string_sizes = dict()
+
+    def write(self, name: str, data):
+        if isinstance(data, array.array):
+            data = data.tobytes()
+        self.buffers[name].write(data)
+
+    def write_strings(self, offsets_name: str, data_name: str, items, encoded: bool = False):
+        """写入字符串，可以多次调用，偏移接着上次写入的位置"""
+        offsets = array.array(self.array_types[offsets_name])
+        if offsets_name not in self.string_sizes:
+            offsets.append(0)
+            self.string_sizes[offsets_name] = 0
+        size = self.string_sizes[offsets_name]
+        data = bytearray()
+        for item in items:
+            data += item if encoded else item.encode('utf-8')
+            offsets.append(size + len(data))
+        self.string_sizes[offsets_name] = size + len(data)
+        self.write(offsets_name, offsets)
+        self.write(data_name, bytes(data))
+
+    def close(self):
+        with open(self.path, 'wb') as f:
+            header_size = HEADER.size + SECTION_ENTRY.size * len(self.sections)
+            f.write(b'\0' * _align(header_size))
+            entries = []
+            for name in self.sections:
+                buffer = self.buffers[name]
+                length = buffer.tell()
+                buffer.seek(0)
+                entries.append((f.tell(), length))
+                shutil.copyfileobj(buffer, f)
+                f.write(b'\0' * (_align(length) - length))
+                buffer.close()
+            f.seek(0)
+            f.write(HEADER.pack(MAGIC, self.version, len(self.sections)))
+            for offset, length in entries:
+                f.write(SECTION_ENTRY.pack(offset, length))
+
+
+class _ArrayBuffer:
+    """流式写入数组区域，缓冲区满了就写入段文件"""
+
+    def __init__(self, out: SegmentFile, name: str, first=None):
+        self.out = out
+        self.name = name
+        self.data = array.array(out.array_types[name])
+        self.count = 0
+        self.last = None
+        if first is not None:
+            self.append(first)
+
+    def append(self, value: int):
+        self.data.append(value)
+        self.count += 1
+        self.last = value
+        if len(self.data) >= BUFFER_SIZE:
+            self.flush()
+
+    def flush(self):
+        self.out.write(self.name, self.data)
+        self.data = array.array(self.out.array_types[self.name])
+
+
+class _PostingBuffer:
+    """
+    流式写入varint编码的倒排列表，每个词一块，缓冲区满了就一起编码写入段文件
+    offsets_name 区域保存每块在 data_name 区域里的字节范围
+    """
+
+    def __init__(self, out: SegmentFile, offsets_name: str, data_name: str, types: tuple):
+        """
+        :param types: 每一列的数组类型，倒排列表是 (doc_id, 字段下标, 词频)，n-gram 索引只有 doc_id
+        """
+        self.out = out
+        self.offsets_name = offsets_name
+        self.data_name = data_name
+        self.columns = tuple(array.array(type_code) for type_code in types)
+        # 缓冲区里每块的长度
+        self.counts = array.array('I')
+        # 缓冲区里已经结束的块的数据数量
+        self.pending = 0
+        # 已经添加的数据数量 (包括已经写入的)
+        self.count = 0
+        # 已经写入 data_name 区域的字节数
+        self.size = 0
+        out.write(offsets_name, array.array('Q', [0]))
+
+    def append(self, *values):
+        for column, value in zip(self.columns, values):
+            column.append(value)
+        self.count += 1
+
+    def extend(self, *columns):
+        for column, values in zip(self.columns, columns):
+            column.extend(values)
+        self.count += len(columns[0])
+
+    def end_block(self):
+        """结束一个词的倒排列表"""
+        self.counts.append(len(self.columns[0]) - self.pending)
+        self.pending = len(self.columns[0])
+        if self.pending >= BUFFER_SIZE:
+            self.flush()
+
+    def flush(self):
+        if len(self.counts) == 0:
+            return
+        data, ends = _encode_postings(self.counts, *self.columns)
+        self.out.write(self.data_name, data)
+        self.out.write(self.offsets_name, (ends + self.size).astype(np.uint64).tobytes())
+        self.size += len(data)
+        self.columns = tuple(array.array(column.typecode) for column in self.columns)
+        self.counts = array.array('I')
+        self.pending = 0
+
+
+class _StoredBuffer:
+    """流式写入存储字段，每 block_size 个文档的 clean_data 压缩成一块"""
+
+    def __init__(self, out: SegmentFile, block_size: int, compression: str):
+        self.out = out
+        self.block_size = block_size
+        self.compress = COMPRESSORS[compression][0]
+        self.doc_count = 0
+        # 正在写入的块: 每个字符串在块里的结束位置，以及utf-8数据
+        self.offsets = array.array('I', [0])
+        self.data = bytearray()
+        # 已经写入 stored_data 区域的字节数
+        self.size = 0
+        out.write('stored_offsets', array.array('Q', [0]))
+
+    def append(self, items: list):
+        """添加一个文档每个字段的 clean_data"""
+        for item in items:
+            self.data += item.encode('utf-8')
+            self.offsets.append(len(self.data))
+        self.doc_count += 1
+        if self.doc_count % self.block_size == 0:
+            self.flush()
+
+    def flush(self):
+        if len(self.offsets) == 1:
+            return
+        # 块的内容: 字符串的偏移数组 + utf-8数据
+        block = self.compress(self.offsets.tobytes() + bytes(self.data))
+        self.out.write('stored_data', block)
+        self.size += len(block)
+        self.out.write('stored_offsets', array.array('Q', [self.size]))
+        self.offsets = array.array('I', [0])
+        self.data = bytearray()
+
+
+def merge_segments(app_name: str, model_name: str, segments: list, path: str) -> int:
+    """
+    流式合并多个段文件，跳过已删除的文档，合并时只在内存里保存文档编号的映射
+    :param segments: SegmentReader 列表，合并后的文档顺序与列表顺序一致
+    :param path: 合并后的段文件路径
+    :return: 合并后的文档数量
+    """
+    out = SegmentFile(path)
+    stored = _StoredBuffer(out, STORED_BLOCK_SIZE, STORED_COMPRESSION)
+    fields = []
+    for segment in segments:
+        for field_name in segment.fields:
+            if field_name not in fields:
+                fields.append(field_name)
+    field_maps = [[fields.index(field_name) for field_name in segment.fields] for segment in segments]
+
+    # 主键、存储字段，记录每个索引段 原doc_id -> 新doc_id，已删除的为 -1
+    doc_maps = []
+    doc_count = 0
+    field_lengths = _ArrayBuffer(out, 'field_lengths')
+    for segment, field_map in zip(segments, field_maps):
+        doc_map = array.array('i')
+        primary_keys = []
+        for doc_id in range(segment.doc_count):
+            if doc_id in segment.deleted:
+                doc_map.append(-1)
+                continue
+            doc_map.append(doc_count)
+            doc_count += 1
+            primary_keys.append(segment.get_primary_key(doc_id))
+            lengths = [0] * len(fields)
+            data = [''] * len(fields)
+            clean_data = segment.get_clean_data(doc_id)
+            for field_id, field_name in enumerate(segment.fields):
+                lengths[field_map[field_id]] = segment.get_field_length(doc_id, field_id)
+                data[field_map[field_id]] = clean_data[field_name]
+            for length in lengths:
+                field_lengths.append(length)
+            stored.append(data)
+            if len(primary_keys) >= BUFFER_SIZE:
+                out.write_strings('pk_offsets', 'pk_data', primary_keys)
+                primary_keys = []
+        out.write_strings('pk_offsets', 'pk_data', primary_keys)
+        doc_maps.append(doc_map)
+    field_lengths.flush()
+    stored.flush()
+
+    # 词典与倒排列表，各个索引段的词典都是排好序的，多路归并即可
+    term_postings = _ArrayBuffer(out, 'term_postings', 0)
+    postings = _PostingBuffer(out, 'posting_offsets', 'posting_data', ('I', 'H', 'I'))
+    terms = []
+    for term, items in _merge_keys([segment.iter_term_keys() for segment in segments]):
+        for segment_index, i in items:
+            doc_map, field_map = doc_maps[segment_index], field_maps[segment_index]
+            docs, fields_, tfs = segments[segment_index].get_postings_at(i)
+            for doc_id, field_id, tf in zip(docs, fields_, tfs):
+                if doc_map[doc_id] >= 0:
+                    postings.append(doc_map[doc_id], field_map[field_id], tf)
+        # 文档全部删除的词不再保留
+        if postings.count != term_postings.last:
+            terms.append(term)
+            term_postings.append(postings.count)
+            postings.end_block()
+        if len(terms) >= BUFFER_SIZE:
+            out.write_strings('term_offsets', 'term_data', terms, encoded=True)
+            terms = []
+    out.write_strings('term_offsets', 'term_data', terms, encoded=True)
+    for buffer in (term_postings, postings):
+        buffer.flush()
+
+    # n-gram 索引
+    gram_docs = _PostingBuffer(out, 'gram_postings', 'gram_docs', ('I',))
+    grams = []
+    for gram, items in _merge_keys([segment.iter_gram_keys() for segment in segments]):
+        count = gram_docs.count
+        for segment_index, i in items:
+            doc_map = doc_maps[segment_index]
+            for doc_id in segments[segment_index].get_gram_docs_at(i):
+                if doc_map[doc_id] >= 0:
+                    gram_docs.append(doc_map[doc_id])
+        if gram_docs.count != count:
+            grams.append(gram)
+            gram_docs.end_block()
+        if len(grams) >= BUFFER_SIZE:
+            out.write_strings('gram_offsets', 'gram_data', grams, encoded=True)
+            grams = []
+    out.write_strings('gram_offsets', 'gram_data', grams, encoded=True)
+    gram_docs.flush()
+
+    ngram_size = min([segment.ngram_size for segment in segments] or [NGRAM_SIZE])
+    out.write('meta', _pack_meta(app_name, model_name, fields, doc_count, ngram_size,
+                                 stored_block_size=STORED_BLOCK_SIZE, stored_compression=STORED_COMPRESSION))
+    out.close()
+    return doc_count
+
+
+class SegmentReader(Segment):
+    """
+    通过mmap读取段文件，多个进程打开同一个文件时共享系统的页缓存
+    打开时只映射元数据、主键和词典，倒排列表和存储字段等数据区域在第一次使用时再映射，release 之后释放，下次使用时重新映射；
+    倒排列表和 n-gram 索引在读取时解码，存储字段按块解压，最近使用的几块缓存在内存里
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        # 保持文件打开，段文件被替换或者删除之后仍然可以重新映射数据区域
+        self._fd = os.open(path, os.O_RDONLY)
+        self.stat = os.fstat(self._fd)
+        self._mmap = mmap.mmap(self._fd, 0, access=mmap.ACCESS_READ)
+        magic, version, section_count = HEADER.unpack_from(self._mmap, 0)
+        if magic != MAGIC or version not in FORMATS or section_count != len(FORMATS[version][0]):
+            raise SegmentError('不支持的段文件: {}'.format(path))
+        self.version = version
+        sections, self._array_types = FORMATS[version]
+        # key: 区域名称, value: (偏移, 长度)
+        self._entries = dict()
+        for i, name in enumerate(sections):
+            self._entries[name] = SECTION_ENTRY.unpack_from(self._mmap, HEADER.size + SECTION_ENTRY.size * i)
+        self._sections = self._map_sections(self._mmap, [name for name in sections if name not in DATA_SECTIONS])
+
+        meta = json.loads(bytes(self._sections['meta']).decode('utf-8'))
+        if meta['byteorder'] != sys.byteorder:
+            raise SegmentError('段文件字节序与当前系统不一致: {}'.format(path))
+        super(SegmentReader, self).__init__(meta['app_name'], meta['model_name'])
+        self.fields = meta['fields']
+        self.ngram_size = meta['ngram_size']
+        self._doc_count = meta['doc_count']
+
+        self._pk_offsets = self._sections['pk_offsets']
+        self._pk_data = self._sections['pk_data']
+        self._term_offsets = self._sections['term_offsets']
+        self._term_data = self._sections['term_data']
+        self._term_postings = self._sections['term_postings']
+        self._gram_offsets = self._sections['gram_offsets']
+        self._gram_data = self._sections['gram_data']
+        self._gram_postings = self._sections['gram_postings']
+        if version != 1:
+            self._posting_offsets = self._sections['posting_offsets']
+            self._stored_block_size = meta['stored_block_size']
+            self._decompress = COMPRESSORS[meta['stored_compression']][1]
+        # 数据区域，key: 区域名称, value: memoryview，没有映射时为None
+        self._data = None
+        self._data_lock = threading.Lock()
+        # 最后一次读取数据区域的时间，按这个时间释放最久没有使用的model
+        self.last_used = 0
+        # key: 块编号, value: (偏移数组, utf-8数据)，按加入的顺序淘汰
+        self._stored_blocks = dict()
+        self._stored_size = 0
+        self._stored_lock = threading.Lock()
+
+    def __del__(self):
+        fd = getattr(self, '_fd', None)
+        if fd is not None:
+            os.close(fd)
+
+    def _map_sections(self, mapped: mmap.mmap, names: list) -> dict:
+        view = memoryview(mapped)
+        sections = dict()
+        for name in names:
+            offset, length = self._entries[name]
+            section = view[offset:offset + length]
+            if name in self._array_types:
+                section = section.cast(self._array_types[name])
+            sections[name] = section
+        return sections
+
+    def _get_data(self) -> dict:
+        """获取数据区域，第一次使用或者释放之后重新映射"""
+        self.last_used = time.monotonic()
+        data = self._data
+        if data is None:
+            with self._data_lock:
+                data = self._data
+                if data is None:
+                    mapped = mmap.mmap(self._fd, 0, access=mmap.ACCESS_READ)
+                    data = self._map_sections(mapped, [name for name in self._entries if name in DATA_SECTIONS])
+                    self._data = data
+        return data
+
+    @property
+    def loaded(self) -> bool:
+        """数据区域是否已经映射"""
+        return self._data is not None
+
+    @property
+    def memory_size(self) -> int:
+        """可以释放的内存上限 (字节)：映射的数据区域大小、解压缓存的块大小、词典辅助索引的大小"""
+        size = self._stored_size
+        data = self._data
+        if data is not None:
+            size += sum(self._entries[name][1] for name in data)
+        term_index = self._term_index
+        if term_index is not None:
+            size += term_index[1].memory_size
+        return size
+
+    def release(self):
+        """
+        释放数据区域、解压缓存和词典辅助索引，词典仍然保留，下次使用时重新映射
+        正在搜索的线程持有的数据区域在用完之后才解除映射
+        """
+        with self._data_lock:
+            self._data = None
+        with self._stored_lock:
+            self._stored_blocks = dict()
+            self._stored_size = 0
+        self._term_index = None
+
+    @property
+    def doc_count(self) -> int:
+        return self._doc_count
+
+    def get_doc_id(self, primary_key) -> int or None:
+        """
+        通过主键查找 doc_id
+        第一次查找时把 doc_id 按主键排序保存在数组里 (每个文档4字节)，之后二分查找，不需要建立 主键 -> doc_id 的dict
+        """
+        if self._doc_ids is None:
+            self._doc_ids = array.array('I', sorted(range(self.doc_count), key=self.get_primary_key))
+        primary_key = str(primary_key)
+        lo, hi = 0, len(self._doc_ids)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.get_primary_key(self._doc_ids[mid]) < primary_key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < len(self._doc_ids) and self.get_primary_key(self._doc_ids[lo]) == primary_key:
+            return self._doc_ids[lo]
+        return None
+
+    def is_same_file(self, stat: os.stat_result) -> bool:
+        """判断段文件是否已经被替换"""
+        return (self.stat.st_ino, self.stat.st_mtime_ns, self.stat.st_size) == (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+    def get_primary_key(self, doc_id: int) -> str:
+        return _read_string(self._pk_offsets, self._pk_data, doc_id)
+
+    def get_clean_data(self, doc_id: int) -> dict:
+        if self.version == 1:
+            data = self._get_data()
+            base = doc_id * len(self.fields)
+            return {field_name: _read_string(data['stored_offsets'], data['stored_data'], base + field_id)
+                    for field_id, field_name in enumerate(self.fields)}
+        if not self.fields:
+            return dict()
+        block_id, position = divmod(doc_id, self._stored_block_size)
+        offsets, data = self._get_stored_block(block_id)
+        base = position * len(self.fields)
+        return {field_name: _read_string(offsets, data, base + field_id) for field_id, field_name in enumerate(self.fields)}
+
+    def _get_stored_block(self, block_id: int) -> tuple:
+        """解压一块存储字段，全匹配、正则匹配按 doc_id 顺序读取，连续的文档会用到同一块"""
+        block = self._stored_blocks.get(block_id)
+        if block is not None:
+            self.last_used = time.monotonic()
+            return block
+        data = self._get_data()
+        raw = self._decompress(data['stored_data'][data['stored_offsets'][block_id]:data['stored_offsets'][block_id + 1]])
+        doc_count = min(self._stored_block_size, self.doc_count - block_id * self._stored_block_size)
+        size = (doc_count * len(self.fields) + 1) * 4
+        offsets = array.array('I')
+        offsets.frombytes(raw[:size])
+        block = (offsets, memoryview(raw)[size:])
+        with self._stored_lock:
+            if block_id not in self._stored_blocks:
+                if len(self._stored_blocks) >= STORED_CACHE_BLOCKS:
+                    offsets, data = self._stored_blocks.pop(next(iter(self._stored_blocks)))
+                    self._stored_size -= offsets.itemsize * len(offsets) + len(data)
+                self._stored_blocks[block_id] = block
+                self._stored_size += len(raw)
+        return block
+
+    def get_field_length(self, doc_id: int, field_id: int) -> int:
+        return self._get_data()['field_lengths'][doc_id * len(self.fields) + field_id]
+
+    def get_field_lengths(self):
+        # 直接使用mmap里的数据，不复制
+        return np.frombuffer(self._get_data()['field_lengths'], dtype=np.uint32).reshape(self.doc_count, len(self.fields))
+
+    def get_postings(self, word: str) -> tuple:
+        i = _search(self._term_offsets, self._term_data, word.encode('utf-8'))
+        if i is None:
+            return EMPTY_POSTINGS
+        return self.get_postings_at(i)
+
+    def get_postings_at(self, i: int) -> tuple:
+        """获取词典里第i个词的倒排列表"""
+        start, end = self._term_postings[i], self._term_postings[i + 1]
+        data = self._get_data()
+        if self.version == 1:
+            return data['posting_docs'][start:end], data['posting_fields'][start:end], data['posting_tfs'][start:end]
+        count = end - start
+        values = _decode_varints(data['posting_data'][self._posting_offsets[i]:self._posting_offsets[i + 1]])
+        return np.cumsum(values[:count], dtype=np.uint32), values[count:count * 2], values[count * 2:]
+
+    def get_gram_docs(self, gram: str):
+        i = _search(self._gram_offsets, self._gram_data, gram.encode('utf-8'))
+        if i is None:
+            return ()
+        return self.get_gram_docs_at(i)
+
+    def get_gram_docs_at(self, i: int):
+        docs = self._get_data()['gram_docs'][self._gram_postings[i]:self._gram_postings[i + 1]]
+        if self.version == 1:
+            return docs
+        return np.cumsum(_decode_varints(docs), dtype=np.uint32)
+
+    def iter_terms(self):
+        for term in self.iter_term_keys():
+            yield term.decode('utf-8')
+
+    def iter_grams(self):
+        for gram in self.iter_gram_keys():
+            yield gram.decode('utf-8')
+
+    def iter_term_keys(self):
+        """按顺序遍历词典里的词 (utf-8字节)"""
+        for i in range(len(self._term_offsets) - 1):
+            yield bytes(self._term_data[self._term_offsets[i]:self._term_offsets[i + 1]])
+
+    def iter_gram_keys(self):
+        for i in range(len(self._gram_offsets) - 1):
+            yield bytes(self._gram_data[self._gram_offsets[i]:self._gram_offsets[i + 1]])
+
+
+def _align(size: int) -> int:
+    return (size + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def _pack_meta(app_name: str, model_name: str, fields: list, doc_count: int, ngram_size: int, **extra) -> bytes:
+    """:param extra: 版本2的存储字段参数 stored_block_size、stored_compression"""
+    meta = {
+        'app_name': app_name,
+        'model_name': model_name,
+        'fields': fields,
+        'doc_count': doc_count,
+        'ngram_size': ngram_size,
+        'byteorder': sys.byteorder,
+    }
+    meta.update(extra)
+    return json.dumps(meta, ensure_ascii=False).encode('utf-8')
+
+
+def _encode_varints(values) -> tuple:
+    """
+    把32位非负整数编码成varint：每个字节保存7位，最高位为1表示后面还有字节，小于128的数只占1个字节
+    :param values: 整数数组
+    :return: (编码后的字节, numpy数组: 每个数结束位置的累计字节数)
+    """
+    values = np.asarray(values, dtype=np.int64)
+    if len(values) and (values.min() < 0 or values.max() > 0xffffffff):
+        raise SegmentError('varint只能编码32位非负整数')
+    values = values.astype(np.uint64)
+    lengths = np.ones(len(values), dtype=np.int64)
+    for k in range(1, 5):
+        lengths += values >= (1 << (7 * k))
+    ends = np.cumsum(lengths)
+    starts = ends - lengths
+    out = np.empty(int(ends[-1]) if len(ends) else 0, dtype=np.uint8)
+    for k in range(int(lengths.max()) if len(lengths) else 0):
+        mask = lengths > k
+        data = (values[mask] >> np.uint64(7 * k)) & np.uint64(0x7f)
+        data[lengths[mask] > k + 1] |= np.uint64(0x80)
+        out[starts[mask] + k] = data
+    return out.tobytes(), ends
+
+
+def _decode_varints(data) -> np.ndarray:
+    """解码 _encode_varints 编码的数据，返回 uint32 数组"""
+    data = np.frombuffer(data, dtype=np.uint8)
+    last = data < 0x80
+    if last.all():
+        # 所有数都只有1个字节，大部分倒排列表是这种情况
+        return data.astype(np.uint32)
+    starts = np.flatnonzero(np.concatenate(([True], last[:-1])))
+    # 每个字节在所在的数里是第几个字节
+    positions = np.arange(len(data)) - np.repeat(starts, np.diff(np.append(starts, len(data))))
+    payload = (data & 0x7f).astype(np.uint32) << (positions * 7).astype(np.uint32)
+    return np.bitwise_or.reduceat(payload, starts)
+
+
+def _encode_postings(counts, docs, *columns) -> tuple:
+    """
+    把多个词的倒排列表编码成varint，每个词一块，块里依次是 doc_id 的差值 (每块从0开始累加)、其他各列
+    doc_id 按顺序排列，差值通常很小，大部分只占1个字节
+    :param counts: 每个词的倒排列表长度
+    :param docs: 所有词的 doc_id，按词依次排列
+    :param columns: 与 docs 对应的其他列 (字段下标、词频)
+    :return: (编码后的字节, numpy数组: 每块结束位置的累计字节数)
+    """
+    counts = np.asarray(counts, dtype=np.int64)
+    docs = np.asarray(docs, dtype=np.int64)
+    starts = np.cumsum(counts) - counts
+    deltas = np.diff(docs, prepend=0)
+    first = starts[counts > 0]
+    deltas[first] = docs[first]
+    if len(deltas) and deltas.min() < 0:
+        raise SegmentError('倒排列表里的 doc_id 没有按顺序排列')
+    columns = (deltas,) + columns
+    width = len(columns)
+    # 第t个词的块从 width * starts[t] 开始，第c列从块里的 c * counts[t] 开始
+    positions = np.arange(len(docs)) + np.repeat(starts * (width - 1), counts)
+    term_counts = np.repeat(counts, counts)
+    values = np.empty(len(docs) * width, dtype=np.int64)
+    for c, column in enumerate(columns):
+        values[positions + c * term_counts] = np.asarray(column, dtype=np.int64)
+    data, ends = _encode_varints(values)
+    ends = np.concatenate(([0], ends))
+    return data, ends[np.cumsum(counts) * width]
+
+
+def _merge_keys(key_iterators: list):
+    """
+    多路归并多个排好序的字符串表
+    :return: 迭代 (字符串, [(第几个字符串表, 在表中的下标), ...])
+    """
+    iterators = [_enumerate_keys(index, keys) for index, keys in enumerate(key_iterators)]
+    for key, group in itertools.groupby(heapq.merge(*iterators), key=lambda item: item[0]):
+        yield key, [(index, i) for _, index, i in group]
+
+
+def _enumerate_keys(index: int, keys):
+    for i, key in enumerate(keys):
+        yield key, index, i
+
+
+def _read_string(offsets, data, i: int) -> str:
+    return bytes(data[offsets[i]:offsets[i + 1]]).decode('utf-8')
+
+
+def _search(offsets, data, key: bytes) -> int or None:
+    """在按字节排序的字符串表里二分查找"""
+    lo, hi = 0, len(offsets) - 1
+    while lo < hi:
+        mid = (lo + hi) // 2
+        item = bytes(data[offsets[mid]:offsets[mid + 1]])
+        if item < key:
+            lo = mid + 1
+        elif item > key:
+            hi = mid
+        else:
+            return mid
+    return None
@@ -0,0 +1,195 @@
+from .config import ConfigManager
+from .indexes import IndexManager
+import bisect
+import heapq
+import logging
+import numpy as np
+import os
+import threading
+import time
+import ujson as json
+
+logger = logging.getLogger(ConfigManager.logger_name)
+
+# 搜索建议数据文件，与段文件一起保存在索引版本目录里
+SUGGEST_FILE = 'suggest.json'
+# 比所有字符都大，用于找出某个前缀的范围
+_MAX_CHAR = '\U0010ffff'
+
+
+class Suggester:
+    """
+    搜索建议 (输入提示)，单例模式
+    建立索引时把所有词和 SUGGEST_FIELDS 字段的内容按小写排序保存，前缀查找就是有序数组上的二分查找；
+    长度不超过 SUGGEST_PREFIX_LENGTH 的前缀匹配的文档最多，建立索引时预先计算好按文档数量排序的前 SUGGEST_SIZE 个
+    """
+
+    suggester_instance = None
+    instance_lock = threading.Lock()
+
+    def __init__(self, path: str = None):
+        """
+        :param path: 搜索建议数据文件，不存在时没有搜索建议
+        """
+        self.path = path
+        # 加载的文件的 (路径, 修改时间)，文件变化之后重新加载
+        self.stat = None
+        # 上次检查 CURRENT 和文件是否变化的时间
+        self.checked_time = time.time()
+        # 按 keys 排序的三个列: 小写的查找key、显示的内容、文档数量
+        self.keys = []
+        self.texts = []
+        self.weights = []
+        # key: 短前缀, value: 预先计算的结果在列表里的下标
+        self.top = dict()
+        self.size = 0
+        self.prefix_length = 0
+        if path is not None:
+            self.load(path)
+
+    @classmethod
+    def get_instance(cls):
+        """
+        当前索引版本的搜索建议，重新建立索引、切换版本之后自动重新加载
+        和索引一样距离上次检查超过 INDEX_RELOAD_INTERVAL 秒才检查 CURRENT 和数据文件，不需要加载索引
+        """
+        suggester = cls.suggester_instance
+        if suggester is not None and not suggester.expired():
+            return suggester
+        with cls.instance_lock:
+            suggester = cls.suggester_instance
+            if suggester is None or suggester.expired():
+                path = os.path.join(IndexManager.read_current(), SUGGEST_FILE)
+                if suggester is None or suggester.stat != _file_stat(path):
+                    suggester = Suggester(path)
+                    cls.suggester_instance = suggester
+                suggester.checked_time = time.time()
+        return suggester
+
+    def expired(self) -> bool:
+        """距离上次检查是否超过 INDEX_RELOAD_INTERVAL 秒，为0时不再检查"""
+        interval = ConfigManager.index_reload_interval
+        return bool(interval) and time.time() - self.checked_time >= interval
+
+    def load(self, path: str):
+        self.stat = _file_stat(path)
+        if self.stat is None:
+            logger.debug('未找到搜索建议文件: {}'.format(path))
+            return
+        with open(path, 'r', encoding=ConfigManager.default_file_encoding) as f:
+            data = json.loads(f.read())
+        for key, text, weight in data['entries']:
+            self.keys.append(key)
+            self.texts.append(text)
+            self.weights.append(weight)
+        self.top = data['top']
+        self.size = data['size']
+        self.prefix_length = data['prefix_length']
+
+    def suggest(self, prefix: str, limit: int = None) -> list:
+        """
+        查找以 prefix 开头的词和内容，不区分大小写
+        :param prefix: 已经输入的内容
+        :param limit: 返回的数量，不指定则使用配置 SUGGEST_SIZE
+        :return: [{'text': 内容, 'weight': 文档数量}, ...]，按文档数量从多到少排序
+        """
+        limit = limit or ConfigManager.suggest_size
+        key = prefix.strip().lower()
+        if not key:
+            return []
+        if len(key) <= self.prefix_length and limit <= self.size:
+            positions = self.top.get(key, [])[:limit]
+        else:
+            start = bisect.bisect_left(self.keys, key)
+            end = bisect.bisect_left(self.keys, key + _MAX_CHAR, start)
+            positions = heapq.nsmallest(limit, range(start, end), key=lambda i: (-self.weights[i], self.keys[i]))
+        return [{'text': self.texts[i], 'weight': self.weights[i]} for i in positions]
+
+
+def _file_stat(path: str) -> tuple or None:
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return path, stat.st_mtime_ns, stat.st_size
+
+
+def _is_suggestion(text: str) -> bool:
+    """单个字符和标点不作为搜索建议"""
+    return len(text) >= 2 and any(char.isalnum() for char in text)
+
+
+def _count_docs(docs, deleted) -> int:
+    """倒排列表里不同的未删除文档数量"""
+    docs = np.unique(np.asarray(docs, dtype=np.int64))
+    if deleted:
+        docs = docs[~np.isin(docs, list(deleted))]
+    return len(docs)
+
+
+def collect_suggestions(segments: list) -> dict:
+    """
+    统计索引段里所有的词和 SUGGEST_FIELDS 字段的内容，以及包含它们的文档数量
+    :return: dict, key: 内容, value: 文档数量
+    """
+    weights = dict()
+    for segment in segments:
+        for term in segment.iter_terms():
+            if _is_suggestion(term):
+                count = _count_docs(segment.get_postings(term)[0], segment.deleted)
+                if count > 0:
+                    weights[term] = weights.get(term, 0) + count
+        fields = ConfigManager.suggest_fields.get('{}.{}'.format(segment.app_name, segment.model_name), [])
+        fields = [field_name for field_name in fields if field_name in segment.fields]
+        if not fields:
+            continue
+        for doc_id in range(segment.doc_count):
+            if doc_id in segment.deleted:
+                continue
+            clean_data = segment.get_clean_data(doc_id)
+            for field_name in fields:
+                text = clean_data.get(field_name, '').strip()
+                if _is_suggestion(text):
+                    weights[text] = weights.get(text, 0) + 1
+    return weights
+
+
+def write_suggest(segments: list, index_root: str = None) -> str:
+    """
+    建立搜索建议数据文件，build_index 建立索引之后调用
+    :param segments: 索引段列表
+    :param index_root: 索引版本目录，不指定则使用当前版本
+    :return: 文件路径
+    """
+    weights = collect_suggestions(segments)
+    # 同一个小写key只保留文档数量最多的写法
+    entries = dict()
+    for text, weight in weights.items():
+        key = text.lower()
+        if key not in entries or weight > entries[key][1]:
+            entries[key] = (text, weight)
+    keys = sorted(entries)
+    size = ConfigManager.suggest_size
+    prefix_length = ConfigManager.suggest_prefix_length
+    # 按文档数量从多到少依次放进每个短前缀的列表，放满 size 个为止
+    top = dict()
+    for i in sorted(range(len(keys)), key=lambda i: (-entries[keys[i]][1], keys[i])):
+        for n in range(1, min(prefix_length, len(keys[i])) + 1):
+            positions = top.setdefault(keys[i][:n], [])
+            if len(positions) < size:
+                positions.append(i)
+
+    index_root = index_root or IndexManager.get_index_root()
+    path = os.path.join(index_root, SUGGEST_FILE)
+    temp_file = '{}.{}.tmp'.format(path, os.getpid())
+    data = {
+        'entries': [[key, entries[key][0], entries[key][1]] for key in keys],
+        'top': top,
+        'size': size,
+        'prefix_length': prefix_length,
+    }
+    with open(temp_file, 'w', encoding=ConfigManager.default_file_encoding) as f:
+        f.write(json.dumps(data, ensure_ascii=False))
+    os.replace(temp_file, path)
+    logger.info('写入搜索建议文件:{}，共{}条'.format(path, len(keys)))
+    return path
@@ -0,0 +1,201 @@
+from .config import ConfigManager
+import logging
+import numpy as np
+import threading
+
+try:
+    import pypinyin
+except ImportError:
+    pypinyin = None
+
+logger = logging.getLogger(ConfigManager.logger_name)
+
+# 超过这个长度的词不做模糊匹配
+MAX_TERM_LENGTH = 32
+# 删除2个字符的变体数量随长度平方增长，超过这个长度的词只保存删除1个字符的变体，只匹配编辑距离为1的搜索词
+MAX_DISTANCE2_LENGTH = 10
+
+_lock = threading.Lock()
+
+
+class TermIndex:
+    """
+    一个索引段词典的辅助索引，用于模糊匹配和拼音匹配
+    模糊匹配使用对称删除：每个词删除最多 max_distance 个字符得到的所有变体都指向这个词，
+    搜索时只需要查找搜索词的删除变体，再计算编辑距离确认，不需要遍历整个词典
+    """
+
+    def __init__(self, terms, max_distance: int, pinyin: bool):
+        """
+        :param terms: 索引段词典里的词 (按顺序排列)
+        :param max_distance: 最大编辑距离
+        :param pinyin: 是否建立拼音 -> 词的索引，需要安装 pypinyin
+        """
+        self.max_distance = max_distance
+        self.terms = []
+        # key: 不带声调的拼音 (小写，没有分隔符), value: 词列表
+        self.pinyins = dict()
+        # 删除变体的hash和对应的词在 self.terms 里的下标，按hash排序，每个变体12字节，不为每个变体创建字符串；
+        # hash相同的其他变体会多找出几个候选词，再用编辑距离排除
+        hashes, term_ids = [], []
+        for term in terms:
+            if not _is_word(term):
+                continue
+            term_id = len(self.terms)
+            self.terms.append(term)
+            if len(term) <= MAX_TERM_LENGTH:
+                distance = max_distance if len(term) <= MAX_DISTANCE2_LENGTH else min(max_distance, 1)
+                for variant in _delete_variants(term, distance):
+                    hashes.append(hash(variant))
+                    term_ids.append(term_id)
+            if pinyin and pypinyin is not None and _has_chinese(term):
+                self.pinyins.setdefault(''.join(pypinyin.lazy_pinyin(term)).lower(), []).append(term)
+        hashes = np.array(hashes, dtype=np.int64)
+        order = np.argsort(hashes, kind='stable')
+        self.hashes = hashes[order]
+        self.term_ids = np.array(term_ids, dtype=np.uint32)[order]
+
+    @property
+    def memory_size(self) -> int:
+        """大致的内存占用 (字节)"""
+        return self.hashes.nbytes + self.term_ids.nbytes + sum(len(term) * 2 + 60 for term in self.terms) + \
+            sum(len(key) + 100 for key in self.pinyins)
+
+    def fuzzy(self, word: str, max_distance: int) -> list:
+        """
+        查找编辑距离不超过 max_distance 的词，不包括 word 本身；超过 MAX_DISTANCE2_LENGTH 的词编辑距离不超过1，
+        编辑距离要小于较长的词的长度，所有字符都不同的词 (例如 ab 和 ba) 不算相近
+        :return: [(词, 编辑距离), ...]
+        """
+        max_distance = min(max_distance, self.max_distance)
+        if max_distance <= 0 or len(word) > MAX_TERM_LENGTH:
+            return []
+        keys = np.array([hash(variant) for variant in _delete_variants(word, max_distance)], dtype=np.int64)
+        starts = np.searchsorted(self.hashes, keys, side='left')
+        ends = np.searchsorted(self.hashes, keys, side='right')
+        term_ids = set()
+        for start, end in zip(starts.tolist(), ends.tolist()):
+            term_ids.update(self.term_ids[start:end].tolist())
+        result = []
+        for term_id in term_ids:
+            term = self.terms[term_id]
+            if term == word:
+                continue
+            distance = edit_distance(word, term, max_distance)
+            # 只保存了删除1个字符的变体的词，编辑距离为2的词有的能找到有的找不到，统一排除
+            limit = max_distance if len(term) <= MAX_DISTANCE2_LENGTH else 1
+            if distance <= limit and distance < max(len(word), len(term)):
+                result.append((term, distance))
+        return result
+
+    def pinyin(self, word: str) -> list:
+        """通过拼音查找中文词，例如 tianqi -> [天气]"""
+        return self.pinyins.get(word.lower(), [])
+
+
+def _is_word(term: str) -> bool:
+    """标点、空白等单独的符号不参与模糊匹配"""
+    return len(term) >= 2 and any(char.isalnum() for char in term)
+
+
+def _has_chinese(term: str) -> bool:
+    return any('一' <= char <= '鿿' for char in term)
+
+
+def _delete_variants(word: str, max_distance: int) -> set:
+    """删除最多 max_distance 个字符得到的所有字符串 (包括 word 本身)"""
+    variants = {word}
+    current = {word}
+    for _ in range(max_distance):
+        current = {item[:i] + item[i + 1:] for item in current if len(item) > 1 for i in range(len(item))}
+        variants.update(current)
+    return variants
+
+
+def edit_distance(a: str, b: str, max_distance: int) -> int:
+    """
+    Levenshtein编辑距离，超过 max_distance 之后提前结束
+    :return: 编辑距离，超过 max_distance 时返回 max_distance + 1
+    """
+    if abs(len(a) - len(b)) > max_distance:
+        return max_distance + 1
+    previous = list(range(len(b) + 1))
+    for i, char_a in enumerate(a, 1):
+        current = [i]
+        for j, char_b in enumerate(b, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (char_a != char_b)))
+        if min(current) > max_distance:
+            return max_distance + 1
+        previous = current
+    return min(previous[-1], max_distance + 1)
+
+
+def allowed_distance(word: str) -> int:
+    """搜索词允许的编辑距离：1个字符不做模糊匹配，2~4个字符最多1，更长的最多2，都不超过 FUZZY_MAX_DISTANCE"""
+    if len(word) <= 1:
+        distance = 0
+    elif len(word) <= 4:
+        distance = 1
+    else:
+        distance = 2
+    return min(distance, ConfigManager.fuzzy_max_distance)
+
+
+def get_term_index(segment) -> TermIndex:
+    """
+    获取索引段的辅助索引，第一次使用时建立，保存在索引段对象上
+    段文件是只读的，重新加载索引时没有变化的段文件会继续使用已经建立的辅助索引；实时索引的增量段在文档数量变化之后重新建立；
+    辅助索引计入索引段的 memory_size，超过 INDEX_MEMORY_LIMIT 时和数据区域一起释放，下次使用时重新建立
+    """
+    cached = getattr(segment, '_term_index', None)
+    if cached is not None and cached[0] == segment.doc_count:
+        return cached[1]
+    with _lock:
+        cached = getattr(segment, '_term_index', None)
+        if cached is None or cached[0] != segment.doc_count:
+            doc_count = segment.doc_count
+            term_index = TermIndex(segment.iter_terms(), ConfigManager.fuzzy_max_distance, ConfigManager.pinyin_match)
+            cached = (doc_count, term_index)
+            segment._term_index = cached
+    return cached[1]
+
+
+def expand_keywords(keywords: list, segments: list) -> dict:
+    """
+    为索引里不存在的关键词找出相近的词：编辑距离在允许范围内的词 (FUZZY_MATCH)、拼音对应的中文词 (PINYIN_MATCH)
+    相近的词按较低的权重参与词匹配的相关度计算，索引里存在的关键词不扩展，结果与关闭这两个功能时一样
+    :param keywords: 搜索词分词之后的关键词
+    :param segments: 索引段列表
+    :return: dict, key: 关键词, value: [(相近的词, 权重), ...]
+    """
+    if not ConfigManager.fuzzy_match and not ConfigManager.pinyin_match:
+        return {}
+    if ConfigManager.pinyin_match and pypinyin is None:
+        logger.warning('开启 PINYIN_MATCH 需要安装 pypinyin')
+    expansions = dict()
+    for keyword in set(keywords):
+        if not _is_word(keyword) or any(len(segment.get_postings(keyword)[0]) > 0 for segment in segments):
+            continue
+        # key: 相近的词, value: (权重, 文档数量)
+        candidates = dict()
+        for segment in segments:
+            term_index = get_term_index(segment)
+            if ConfigManager.fuzzy_match:
+                for term, distance in term_index.fuzzy(keyword, allowed_distance(keyword)):
+                    _add_candidate(candidates, segment, term, ConfigManager.fuzzy_weight ** distance)
+            if ConfigManager.pinyin_match:
+                for term in term_index.pinyin(keyword):
+                    _add_candidate(candidates, segment, term, ConfigManager.pinyin_weight)
+        if candidates:
+            # 权重高的优先，权重一样时优先使用文档数量多的
+            ranked = sorted(candidates.items(), key=lambda item: (-item[1][0], -item[1][1], item[0]))
+            expansions[keyword] = [(term, weight) for term, (weight, doc_freq) in ranked[:ConfigManager.fuzzy_max_expansions]]
+    return expansions
+
+
+def _add_candidate(candidates: dict, segment, term: str, weight: float):
+    doc_freq = len(segment.get_postings(term)[0])
+    if term in candidates:
+        weight = max(weight, candidates[term][0])
+        doc_freq += candidates[term][1]
+    candidates[term] = (weight, doc_freq)
@@ -0,0 +1,711 @@
+import multiprocessing
+import os
+import math
+import random
+import re
+import shutil
+import tempfile
+import ujson as json
+from unittest import mock
+
+from django.apps import apps
+from django.db import connection, models
+from django.db.models.signals import post_delete, post_save
+from django.test import RequestFactory, SimpleTestCase, TransactionTestCase
+
+from . import index_builder, regex_engine
+from .config import ConfigManager
+from .index_builder import chunk_bounds, create_index
+from .indexes import BUILDING_FILE, CHANGES_SUFFIX, DELTA_SUFFIX, IndexManager
+from .live_index import LiveIndexer
+from .processer import CHARACTER_CN_FILTER, CHARACTER_FILTER, character_cn_filter, character_filter, normalize_text
+from .query import SearchQuery, SearchResultObjectType, _merge_word_results, get_shards
+from .regex_engine import compile_pattern, extract_literals
+from .segment import (SegmentError, SegmentReader, SegmentWriter, merge_segments, _decode_varints,
+                      _encode_postings, _encode_varints)
+from .suggest import SUGGEST_FILE, Suggester
+from .term_index import MAX_DISTANCE2_LENGTH, TermIndex, edit_distance, get_term_index
+from .view import views
+
+
+class Article(models.Model):
+    title = models.CharField(max_length=100)
+    content = models.TextField()
+    views = models.IntegerField(default=0)
+
+    class Meta:
+        app_label = 'cloversearch'
+
+
+WORDS = ['python', 'django', '天气', '搜索', '索引', 'x', 'y']
+ARTICLES = [('天气预报', '今天的天气不错'), ('搜索引擎', '倒排索引和分词'), ('python', 'django orm'), ('中文分词', 'jieba')]
+
+
+def article_index(article: Article):
+    return create_index('cloversearch', 'Article', article.pk, {'title': article.title, 'content': article.content})
+
+
+def make_writer(*ranges: tuple) -> SegmentWriter:
+    """
+    生成测试用的索引段，同一个主键每次生成的数据相同
+    :param ranges: (第一个文档的主键, 文档数量)
+    """
+    writer = SegmentWriter('blog', 'Post')
+    for first, count in ranges:
+        add_documents(writer, first, count)
+    return writer
+
+
+def add_documents(writer: SegmentWriter, first: int, count: int):
+    rnd = random.Random(first)
+    for primary_key in range(first, first + count):
+        words = [rnd.choice(WORDS + ['w{}'.format(rnd.randint(0, 3000))]) for _ in range(rnd.randint(0, 20))]
+        writer.add(primary_key, {'title': words[:3], 'content': words},
+                   {'title': ' '.join(words[:3]), 'content': '内容{} {}'.format(primary_key, ''.join(words))})
+
+
+class SegmentAssertions:
+    def assertSameSegment(self, expected, actual):
+        """两个索引段的主键、倒排列表、n-gram、字段长度和存储字段完全相同"""
+        self.assertEqual(expected.doc_count, actual.doc_count)
+        self.assertEqual(expected.fields, actual.fields)
+        self.assertEqual(sorted(expected.iter_terms()), sorted(actual.iter_terms()))
+        for term in expected.iter_terms():
+            self.assertEqual([list(map(int, column)) for column in expected.get_postings(term)],
+                             [list(map(int, column)) for column in actual.get_postings(term)], term)
+        self.assertEqual(sorted(expected.iter_grams()), sorted(actual.iter_grams()))
+        for gram in expected.iter_grams():
+            self.assertEqual(list(map(int, expected.get_gram_docs(gram))),
+                             list(map(int, actual.get_gram_docs(gram))), gram)
+        for doc_id in range(expected.doc_count):
+            self.assertEqual(expected.get_primary_key(doc_id), actual.get_primary_key(doc_id))
+            self.assertEqual(expected.get_clean_data(doc_id), actual.get_clean_data(doc_id))
+            self.assertEqual([expected.get_field_length(doc_id, field_id) for field_id in range(len(expected.fields))],
+                             [actual.get_field_length(doc_id, field_id) for field_id in range(len(actual.fields))])
+
+
+class IndexTestCase(TransactionTestCase):
+    """使用测试表和临时索引目录"""
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        with connection.schema_editor() as editor:
+            editor.create_model(Article)
+
+    @classmethod
+    def tearDownClass(cls):
+        with connection.schema_editor() as editor:
+            editor.delete_model(Article)
+        super().tearDownClass()
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.old_index_dir = ConfigManager.index_dir
+        ConfigManager.index_dir = os.path.join(self.dir, 'index')
+        os.makedirs(ConfigManager.index_dir)
+        IndexManager.index_manager_instance = None
+        IndexManager.index_root = None
+
+    def tearDown(self):
+        IndexManager.index_manager_instance = None
+        IndexManager.index_root = None
+        ConfigManager.index_dir = self.old_index_dir
+        shutil.rmtree(self.dir)
+
+
+class LiveIndexTest(IndexTestCase):
+    def setUp(self):
+        super().setUp()
+        self.indexer = LiveIndexer(0)
+        self.indexer.models[Article] = ('cloversearch', 'Article', ['title', 'content'])
+
+    def tearDown(self):
+        post_save.disconnect(self.indexer.on_save, sender=Article)
+        post_delete.disconnect(self.indexer.on_delete, sender=Article)
+        super().tearDown()
+
+    def read_delta(self) -> dict:
+        """增量段里的文档, key: 主键, value: 存储的字段"""
+        delta = SegmentReader(IndexManager.get_segment_file('cloversearch', 'Article', DELTA_SUFFIX))
+        return {delta.get_primary_key(doc_id): delta.get_clean_data(doc_id) for doc_id in range(delta.doc_count)}
+
+    def test_deferred_instances(self):
+        articles = [Article.objects.create(title=title, content=content) for title, content in ARTICLES]
+        index_manager = IndexManager.get_instance()
+        for article in articles:
+            index_manager.add(article_index(article))
+        index_manager.save()
+        post_save.connect(self.indexer.on_save, sender=Article)
+        post_delete.connect(self.indexer.on_delete, sender=Article)
+
+        # 修改了延迟加载的字段
+        first = Article.objects.only('title').get(pk=articles[0].pk)
+        first.title = '明天天气'
+        first.save()
+        # 索引字段都没有加载，只修改了其他字段
+        second = Article.objects.defer('title', 'content').get(pk=articles[1].pk)
+        second.views = 10
+        second.save()
+        Article.objects.get(pk=articles[2].pk).delete()
+        self.indexer.process()
+
+        first.refresh_from_db()
+        self.assertEqual(self.read_delta(), {str(article.pk): article_index(article).clean_data
+                                             for article in (first, articles[1])})
+        self.assertEqual(IndexManager.read_deleted('cloversearch', 'Article'),
+                         {str(article.pk) for article in articles[:3]})
+        # 再次加载索引，修改和删除的文档不会重复出现
+        IndexManager.index_manager_instance = None
+        primary_keys = sorted(index.primary_key for index in IndexManager.get_instance().iter_indexes())
+        self.assertEqual(primary_keys, sorted(str(article.pk) for article in (first, articles[1], articles[3])))
+
+
+class BuildTest(SegmentAssertions, IndexTestCase):
+    # 主键不连续，插入顺序和主键顺序不同
+    PRIMARY_KEYS = [7, 3, 20, 1, 15, 4, 11, 30, 2, 9, 25]
+
+    def setUp(self):
+        super().setUp()
+        self.old_config = (ConfigManager.config_dir, ConfigManager.app_list)
+        ConfigManager.config_dir = os.path.join(self.dir, 'config')
+        ConfigManager.app_list = ['cloversearch']
+        os.makedirs(ConfigManager.config_dir)
+        field_config_file = os.path.join(ConfigManager.config_dir, 'cloversearch' + ConfigManager.field_config_filename_suffix)
+        with open(field_config_file, 'w', encoding='utf-8') as f:
+            f.write('[Article]\ntitle = true\ncontent = true\n')
+        for primary_key in self.PRIMARY_KEYS:
+            title, content = ARTICLES[primary_key % len(ARTICLES)]
+            Article.objects.create(pk=primary_key, title='{} {}'.format(title, primary_key), content=content)
+
+    def tearDown(self):
+        ConfigManager.config_dir, ConfigManager.app_list = self.old_config
+        super().tearDown()
+
+    def build(self, workers: int, chunk_size: int, memory_limit: int = 64 * 1024 * 1024) -> SegmentReader:
+        """建立索引，测试数据库不能在子进程里访问，数据块在当前进程里处理"""
+        index_builder._build(workers, None, chunk_size, memory_limit)
+        path = os.path.join(self.dir, 'build-{}-{}-{}.seg'.format(workers, chunk_size, memory_limit))
+        shutil.copy(IndexManager.get_segment_file('cloversearch', 'Article'), path)
+        return SegmentReader(path)
+
+    def test_chunk_bounds(self):
+        self.assertEqual(chunk_bounds(Article, 3), [(None, 3), (3, 9), (9, 20), (20, None)])
+        self.assertEqual(chunk_bounds(Article, 11), [(None, 30)])
+        self.assertEqual(chunk_bounds(Article, 100), [(None, None)])
+        Article.objects.all().delete()
+        self.assertEqual(chunk_bounds(Article, 3), [])
+
+    def test_chunked_build(self):
+        expected = self.build(0, 1000)
+        self.assertEqual([expected.get_primary_key(doc_id) for doc_id in range(expected.doc_count)],
+                         [str(primary_key) for primary_key in sorted(self.PRIMARY_KEYS)])
+        for chunk_size in (1, 3, 10, 100):
+            self.assertSameSegment(expected, self.build(1, chunk_size))
+        # 超过内存上限时先写入临时段文件再合并
+        self.assertSameSegment(expected, self.build(0, 1000, memory_limit=1))
+        self.assertSameSegment(expected, self.build(1, 3, memory_limit=1))
+
+    def test_incremental_rebuild(self):
+        self.build(0, 1000)
+        old_root = IndexManager.get_index_root()
+        Article.objects.create(pk=40, title='新文章', content='天气')
+        # Article 没有更新时间字段，增量建立索引时重新建立全部索引，也要在新的版本目录里建立
+        index_builder._build_incremental(0, None, 1000, 64 * 1024 * 1024, None)
+        self.assertNotEqual(IndexManager.get_index_root(), old_root)
+        self.assertEqual(IndexManager.read_current(), IndexManager.get_index_root())
+        old_segment = SegmentReader(IndexManager.get_segment_file('cloversearch', 'Article', index_root=old_root))
+        self.assertEqual(old_segment.doc_count, len(self.PRIMARY_KEYS))
+        primary_keys = sorted(int(index.primary_key) for index in IndexManager.get_instance().iter_indexes())
+        self.assertEqual(primary_keys, sorted(self.PRIMARY_KEYS + [40]))
+
+    def test_live_changes_during_build(self):
+        self.build(0, 1000)
+        old_root = IndexManager.get_index_root()
+        build_model = index_builder.build_model
+        exitcodes = []
+
+        def build_model_and_flush(*args, **kwargs):
+            # 新版本已经建立好段文件，还没有切换 CURRENT 时其他进程写入实时索引
+            temp_file = build_model(*args, **kwargs)
+            self.assertTrue(os.path.exists(os.path.join(old_root, BUILDING_FILE)))
+            process = multiprocessing.get_context('fork').Process(target=flush_live_changes)
+            process.start()
+            process.join()
+            exitcodes.append(process.exitcode)
+            return temp_file
+
+        with mock.patch.object(index_builder, 'build_model', build_model_and_flush):
+            self.build(0, 1000)
+        self.assertEqual(exitcodes, [0])
+        self.assertNotEqual(IndexManager.get_index_root(), old_root)
+        self.assertFalse(os.path.exists(os.path.join(old_root, BUILDING_FILE)))
+        self.assertFalse(os.path.exists(IndexManager.get_segment_file('cloversearch', 'Article', CHANGES_SUFFIX, old_root)))
+
+        IndexManager.index_root = None
+        IndexManager.index_manager_instance = None
+        indexes = {index.primary_key: index.clean_data for index in IndexManager.get_instance().iter_indexes()}
+        self.assertEqual(sorted(indexes, key=int), [str(primary_key) for primary_key in sorted(self.PRIMARY_KEYS)
+                                                    if primary_key != 3])
+        self.assertEqual(indexes['7']['title'], '实时修改')
+
+
+def flush_live_changes():
+    """在子进程里模拟另一个进程的实时索引：修改主键7，删除主键3"""
+    IndexManager.index_root = None
+    IndexManager.index_manager_instance = None
+    index_manager = IndexManager.get_instance()
+    index_manager.update(create_index('cloversearch', 'Article', 7, {'title': '实时修改', 'content': '天气'}))
+    index_manager.delete('cloversearch', 'Article', 3)
+    index_manager.flush()
+
+
+class StartTest(SimpleTestCase):
+    def test_auto_start(self):
+        app_config = apps.get_app_config('cloversearch')
+        old_auto_start = ConfigManager.auto_start
+        try:
+            with mock.patch('cloversearch.apps.start') as start:
+                ConfigManager.auto_start = False
+                app_config.ready()
+                start.assert_not_called()
+                ConfigManager.auto_start = True
+                app_config.ready()
+                start.assert_called_once_with()
+        finally:
+            ConfigManager.auto_start = old_auto_start
+
+
+class QueryCacheKeyTest(SimpleTestCase):
+    def search(self, raw: str, **kwargs) -> tuple:
+        """执行 SearchQuery.search，返回 (缓存key, 实际搜索的搜索词)"""
+        with mock.patch.object(IndexManager, 'get_instance'), \
+                mock.patch.object(SearchQuery, 'cached', lambda key, compute, cache: (key, compute())), \
+                mock.patch.object(SearchQuery, '_search', lambda raw, *args: raw):
+            return SearchQuery.search(raw, **kwargs)
+
+    def test_raw_query_is_executed(self):
+        self.assertEqual(self.search('  天气   预报 ')[1], '  天气   预报 ')
+
+    def test_whitespace(self):
+        # 只有词匹配时空白不影响结果，共用缓存
+        self.assertEqual(self.search(' 天气  预报', full_match=False)[0], self.search('天气 预报', full_match=False)[0])
+        self.assertNotEqual(self.search(' 天气  预报')[0], self.search('天气 预报')[0])
+        self.assertNotEqual(self.search('a  b', full_match=False, regex_match=True)[0],
+                            self.search('a b', full_match=False, regex_match=True)[0])
+
+    def test_boolean_models(self):
+        with mock.patch.object(IndexManager, 'get_instance'), \
+                mock.patch.object(SearchQuery, 'cached', lambda key, compute, cache: (key, compute())), \
+                mock.patch.object(SearchQuery, '_boolean_search', lambda *args: args[-1]):
+            key, models = SearchQuery.boolean_search('python AND django', models=['blog.Post'])
+            self.assertEqual(models, ['blog.Post'])
+            self.assertEqual(SearchQuery.boolean_search('python AND django', models=['BLOG.post'])[0], key)
+            self.assertNotEqual(SearchQuery.boolean_search('python AND django')[0], key)
+        # 搜索接口的 q= 查询语句也使用 models 参数
+        with mock.patch.object(SearchQuery, 'boolean_search') as boolean_search:
+            boolean_search.return_value.hydrate.return_value.all = []
+            boolean_search.return_value.hydrate.return_value.total = 0
+            boolean_search.return_value.hydrate.return_value.partial = False
+            views.search(RequestFactory().get('/search', {'q': 'python', 'models': 'Post,blog.Note'}))
+            self.assertEqual(boolean_search.call_args[1]['models'], ['Post', 'blog.Note'])
+
+    def test_settings(self):
+        old_settings = (ConfigManager.scoring, ConfigManager.fuzzy_match, ConfigManager.pinyin_match)
+        try:
+            ConfigManager.scoring = 'bm25'
+            key = self.search('天气')[0]
+            self.assertEqual(self.search('天气', scoring='BM25')[0], key)
+            self.assertNotEqual(self.search('天气', scoring='tfidf')[0], key)
+            ConfigManager.fuzzy_match = not ConfigManager.fuzzy_match
+            self.assertNotEqual(self.search('天气')[0], key)
+            ConfigManager.fuzzy_match = old_settings[1]
+            ConfigManager.pinyin_match = not ConfigManager.pinyin_match
+            self.assertNotEqual(self.search('天气')[0], key)
+        finally:
+            ConfigManager.scoring, ConfigManager.fuzzy_match, ConfigManager.pinyin_match = old_settings
+
+
+class CharacterFilterTest(SimpleTestCase):
+    ALPHABET = ''.join(CHARACTER_FILTER + CHARACTER_CN_FILTER) + '—…-ab天气 ，Ａ'
+
+    def test_same_as_replace(self):
+        """编译的过滤器与逐个 str.replace 的结果一致，包括 —— 和 …… 与单个字符相邻的情况"""
+        rnd = random.Random(13)
+        old_config = (ConfigManager.normalize_width, ConfigManager.normalize_case)
+        ConfigManager.normalize_width = ConfigManager.normalize_case = False
+        try:
+            for _ in range(5000):
+                data = ''.join(rnd.choice(self.ALPHABET) for _ in range(rnd.randint(0, 12)))
+                expected_en, expected_cn = data, data
+                for item in CHARACTER_FILTER:
+                    expected_en = expected_en.replace(item, '')
+                for item in CHARACTER_CN_FILTER:
+                    expected_cn = expected_cn.replace(item, '')
+                expected = expected_en
+                for item in CHARACTER_CN_FILTER:
+                    expected = expected.replace(item, '')
+                self.assertEqual(character_filter(data), expected_en, data)
+                self.assertEqual(character_cn_filter(data), expected_cn, data)
+                self.assertEqual(normalize_text(data), expected, data)
+        finally:
+            ConfigManager.normalize_width, ConfigManager.normalize_case = old_config
+
+
+class FullMatchTest(SimpleTestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.old_config = (ConfigManager.normalize_width, ConfigManager.normalize_case)
+        ConfigManager.normalize_width = ConfigManager.normalize_case = False
+        rnd = random.Random(2)
+        # 段文件和实时索引的内存索引段，有的文档没有字段或者已经删除
+        self.segments = []
+        for first, count in ((0, 60), (60, 40), (100, 30)):
+            writer = SegmentWriter('blog', 'Post' if first < 100 else 'Note')
+            for primary_key in range(first, first + count):
+                clean_data = {field_name: ''.join(rnd.choice('ab天气x') for _ in range(rnd.randint(0, 10)))
+                              for field_name in ('title', 'content') if rnd.random() < 0.8}
+                writer.add(primary_key, {field_name: list(data) for field_name, data in clean_data.items()}, clean_data)
+            if first < 100:
+                path = os.path.join(self.dir, '{}.seg'.format(first))
+                writer.write(path)
+                writer = SegmentReader(path)
+            writer.deleted.update(rnd.sample(range(count), 4))
+            self.segments.append(writer)
+
+    def tearDown(self):
+        ConfigManager.normalize_width, ConfigManager.normalize_case = self.old_config
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+    def test_same_as_substring_scan(self):
+        """与原来对每个文档的每个字段做 data in clean_data 的结果和顺序完全一样"""
+        rnd = random.Random(3)
+        queries = ['', 'a', '天', '天气', 'a,b', '（天气）', 'xxxx', 'zz'] + \
+                  [''.join(rnd.choice('ab天气x，.') for _ in range(rnd.randint(1, 5))) for _ in range(200)]
+        with mock.patch.object(IndexManager, 'get_instance') as get_instance:
+            get_instance.return_value.get_segments.return_value = self.segments
+            for raw in queries:
+                data = character_cn_filter(character_filter(raw))
+                expected = [segment.get_primary_key(doc_id) for segment in self.segments for doc_id in range(segment.doc_count)
+                            if doc_id not in segment.deleted
+                            and any(data in clean_data for clean_data in segment.get_clean_data(doc_id).values())]
+                search_set = SearchQuery.full_match(raw)
+                self.assertEqual([search_obj.index.primary_key for search_obj in search_set.objects], expected, raw)
+                for search_obj in search_set.objects:
+                    self.assertEqual(search_obj.matching_score, 1)
+                    self.assertEqual(search_obj.matching_type, SearchResultObjectType.FullMatch)
+
+
+class ScoringTest(SimpleTestCase):
+    MODELS = [('Post', [(0, 40), (40, 25)]), ('Note', [(100, 30)])]
+    QUERY = ['python', '天气', 'python', 'x', 'nosuch']
+    BOOSTS = {'title': 2.0, 'content': 1.0}
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        # 每个model的 [(索引段, {doc_id: keywords})]
+        self.models = []
+        rnd = random.Random(8)
+        for model_name, ranges in self.MODELS:
+            model = []
+            for first, count in ranges:
+                writer = SegmentWriter('blog', model_name)
+                documents = dict()
+                for primary_key in range(first, first + count):
+                    words = [rnd.choice(WORDS) for _ in range(rnd.randint(0, 12))]
+                    keywords = {'title': words[:rnd.randint(0, 3)], 'content': words}
+                    documents[writer.add(primary_key, keywords, {'content': ''.join(words)})] = keywords
+                path = os.path.join(self.dir, '{}-{}.seg'.format(model_name, first))
+                writer.write(path)
+                segment = SegmentReader(path)
+                segment.deleted.update(rnd.sample(sorted(documents), 3))
+                model.append((segment, documents))
+            self.models.append(model)
+        self.segments = [segment for model in self.models for segment, documents in model]
+
+    def tearDown(self):
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+    def reference_scores(self, scoring: str) -> dict:
+        """原来的逐个文档循环计算相关度，key: (索引段序号, doc_id), value: (相关度, 匹配词数量)"""
+        word_counts = {word: self.QUERY.count(word) for word in self.QUERY}
+        results = dict()
+        for model in self.models:
+            all_keywords = [keywords for segment, documents in model for keywords in documents.values()]
+            doc_count = len(all_keywords)
+            avg_lengths = {field_name: max(sum(len(keywords.get(field_name, [])) for keywords in all_keywords) / doc_count, 1.0)
+                           for field_name in self.BOOSTS}
+            doc_freqs = {word: sum(1 for keywords in all_keywords if any(word in words for words in keywords.values()))
+                         for word in word_counts}
+            for segment, documents in model:
+                for doc_id, keywords in documents.items():
+                    if doc_id in segment.deleted:
+                        continue
+                    score, matching_count = 0.0, 0
+                    for word, word_count in word_counts.items():
+                        found = False
+                        for field_name, words in keywords.items():
+                            tf = words.count(word)
+                            if tf == 0:
+                                continue
+                            found = True
+                            boost, length, avg_length = self.BOOSTS[field_name], len(words), avg_lengths[field_name]
+                            if scoring == 'bm25':
+                                idf = math.log(1 + (doc_count - doc_freqs[word] + 0.5) / (doc_freqs[word] + 0.5))
+                                k1, b = ConfigManager.bm25_k1, ConfigManager.bm25_b
+                                score += word_count * boost * idf * tf * (k1 + 1) / (tf + k1 * (1 - b + b * length / avg_length))
+                            elif scoring == 'tfidf':
+                                idf = math.log(1 + doc_count / doc_freqs[word])
+                                score += word_count * boost * (1 + math.log(tf)) * idf / math.sqrt(max(length, 1) / avg_length)
+                        if found:
+                            matching_count += word_count
+                    if matching_count > 0:
+                        if scoring == 'count':
+                            score = matching_count / len(self.QUERY)
+                        results[(self.segments.index(segment), doc_id)] = (score, matching_count)
+        if scoring != 'count':
+            max_score = max(score for score, matching_count in results.values())
+            results = {key: (score / max_score, matching_count) for key, (score, matching_count) in results.items()}
+        return results
+
+    def assertSameScores(self, expected: dict, results: list):
+        actual = dict()
+        for segment, doc_ids, scores, matching_counts in results:
+            for doc_id, score, matching_count in zip(doc_ids.tolist(), scores.tolist(), matching_counts.tolist()):
+                actual[(self.segments.index(segment), doc_id)] = (score, matching_count)
+        self.assertEqual(sorted(actual), sorted(expected))
+        for key, (score, matching_count) in expected.items():
+            self.assertAlmostEqual(actual[key][0], score, places=9, msg=key)
+            self.assertEqual(actual[key][1], matching_count, key)
+
+    def test_vectorized_scores(self):
+        with mock.patch('cloversearch.query.query_segment', return_value=list(self.QUERY)), \
+                mock.patch('cloversearch.query.expand_keywords', return_value={}), \
+                mock.patch('cloversearch.scoring.get_field_boosts', return_value=self.BOOSTS), \
+                mock.patch.object(IndexManager, 'get_instance') as get_instance:
+            get_instance.return_value.get_segments.return_value = self.segments
+            for scoring in ('bm25', 'tfidf', 'count'):
+                expected = self.reference_scores(scoring)
+                keyword_count, results = SearchQuery.word_scores('', scoring)
+                self.assertEqual(keyword_count, len(self.QUERY))
+                self.assertSameScores(expected, results)
+                # 分片计算的结果与不分片一样
+                for shard_count in (1, 2, 3):
+                    shards = get_shards(self.segments, shard_count)
+                    keyword_count, shard_results = SearchQuery.shard_word_scores('', scoring, self.segments, shards)
+                    self.assertSameScores(expected, _merge_word_results(self.segments, shard_results))
+
+
+class RegexLiteralTest(SimpleTestCase):
+    PIECES = ['a', 'b', '天', 'ab', '(?:ab)', '(ab)', '[ab]', 'a|b', '(a|天)', 'a*', 'b+', '(?:a天)+', 'a?', 'a{2}',
+              '\\d', '.', '^', '$', '\\b', '(?i:a)', '(?=a)', '(?!b)']
+
+    def test_literals(self):
+        cases = {
+            'python\\d+教程': ['python', '教程'],
+            'abc': ['abc'],
+            'a(?:bc)d': ['abcd'],
+            '^天气$': ['天气'],
+            '\\b天气\\b预报': ['天气预报'],
+            'ab|cd': [],
+            '(?i)abc': [],
+            'x*y': ['y'],
+            '[ab]c': ['c'],
+            '(ab)+c': ['ab', 'c'],
+        }
+        for pattern, literals in cases.items():
+            self.assertEqual(extract_literals(pattern, re.compile(pattern).flags), literals, pattern)
+        self.assertEqual(sorted(extract_literals('a(?i:bc)d')), ['a', 'd'])
+
+    def test_literals_must_appear(self):
+        """随机组合的表达式匹配的每一段文本都包含提取出的所有字面量"""
+        rnd = random.Random(11)
+        texts = [''.join(rnd.choice('ab天1A ') for _ in range(rnd.randint(0, 8))) for _ in range(300)]
+        for _ in range(500):
+            pattern = ''.join(rnd.choice(self.PIECES) for _ in range(rnd.randint(1, 5)))
+            compiled = compile_pattern(pattern)
+            for text in texts:
+                if compiled.regex.search(text) is not None:
+                    for literal in compiled.literals:
+                        self.assertIn(literal, text, pattern)
+
+    def test_fallback(self):
+        # 解析器不可用或者解析结果和预期不一致时不提取字面量，检查所有文档
+        with mock.patch.object(regex_engine, 'sre_parse', None):
+            self.assertEqual(extract_literals('abc'), [])
+        with mock.patch.object(regex_engine, '_required_literals', side_effect=TypeError):
+            self.assertEqual(extract_literals('abc'), [])
+
+
+class SuggestTest(SimpleTestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.old_config = (ConfigManager.index_dir, ConfigManager.index_reload_interval, IndexManager.index_root)
+        ConfigManager.index_dir = self.dir
+        IndexManager.index_root = None
+        Suggester.suggester_instance = None
+
+    def tearDown(self):
+        ConfigManager.index_dir, ConfigManager.index_reload_interval, IndexManager.index_root = self.old_config
+        Suggester.suggester_instance = None
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+    def write_suggest(self, *texts: str):
+        entries = [[text.lower(), text, 1] for text in sorted(texts)]
+        with open(os.path.join(self.dir, SUGGEST_FILE), 'w', encoding='utf-8') as f:
+            f.write(json.dumps({'entries': entries, 'top': {}, 'size': 0, 'prefix_length': 0}))
+
+    def test_reload_interval(self):
+        ConfigManager.index_reload_interval = 60
+        self.write_suggest('python')
+        suggester = Suggester.get_instance()
+        self.write_suggest('python', 'pypy')
+        # 没有超过检查间隔时不检查文件
+        with mock.patch('cloversearch.suggest._file_stat') as file_stat:
+            self.assertIs(Suggester.get_instance(), suggester)
+            file_stat.assert_not_called()
+        suggester.checked_time -= 60
+        self.assertEqual([item['text'] for item in Suggester.get_instance().suggest('py')], ['pypy', 'python'])
+
+    def test_view_parameters(self):
+        factory = RequestFactory()
+        self.assertEqual(views.suggest(factory.get('/suggest')).status_code, 400)
+        self.assertEqual(views.suggest(factory.get('/suggest', {'w': 'py', 'size': 'abc'})).status_code, 400)
+        with mock.patch.object(Suggester, 'get_instance') as get_instance:
+            get_instance.return_value.suggest.return_value = []
+            for size, limit in (('1000', views.MAX_SUGGEST_SIZE), ('-1', None), ('5', 5)):
+                self.assertEqual(views.suggest(factory.get('/suggest', {'w': 'py', 'size': size})).status_code, 200)
+                get_instance.return_value.suggest.assert_called_with('py', limit)
+
+
+class TermIndexTest(SimpleTestCase):
+    ALPHABET = 'abcde天气搜索'
+
+    def random_word(self, rnd: random.Random) -> str:
+        return ''.join(rnd.choice(self.ALPHABET) for _ in range(rnd.randint(1, 14)))
+
+    def mutate(self, rnd: random.Random, word: str) -> str:
+        """随机插入、删除、替换0~3个字符"""
+        for _ in range(rnd.randint(0, 3)):
+            i = rnd.randint(0, len(word))
+            operation = rnd.choice('idr')
+            if operation == 'i':
+                word = word[:i] + rnd.choice(self.ALPHABET) + word[i:]
+            elif len(word) > 1 and i < len(word):
+                word = word[:i] + (rnd.choice(self.ALPHABET) if operation == 'r' else '') + word[i + 1:]
+        return word
+
+    def test_edit_distance(self):
+        self.assertEqual(edit_distance('kitten', 'sitting', 3), 3)
+        self.assertEqual(edit_distance('kitten', 'sitting', 2), 3)
+        self.assertEqual(edit_distance('天气', '天气', 2), 0)
+        self.assertEqual(edit_distance('天气', '天汽', 2), 1)
+        self.assertEqual(edit_distance('ab', 'abcde', 2), 3)
+
+    def test_fuzzy_matches_brute_force(self):
+        rnd = random.Random(22)
+        terms = sorted({self.random_word(rnd) for _ in range(600)})
+        term_index = TermIndex(terms, 2, False)
+        for _ in range(150):
+            word = self.mutate(rnd, rnd.choice(terms))
+            for max_distance in (1, 2):
+                expected = []
+                for term in term_index.terms:
+                    distance = edit_distance(word, term, max_distance)
+                    limit = max_distance if len(term) <= MAX_DISTANCE2_LENGTH else 1
+                    if term != word and distance <= limit and distance < max(len(word), len(term)):
+                        expected.append((term, distance))
+                self.assertEqual(sorted(term_index.fuzzy(word, max_distance)), sorted(expected), word)
+        # 单独的字符不参与模糊匹配
+        self.assertEqual(term_index.terms, [term for term in terms if len(term) >= 2])
+
+    def test_memory_size(self):
+        small = TermIndex(['python', 'django'], 2, False)
+        self.assertGreaterEqual(small.memory_size, small.hashes.nbytes + small.term_ids.nbytes)
+        large = TermIndex(['python{}'.format(i) for i in range(100)], 2, False)
+        self.assertGreater(large.memory_size, small.memory_size)
+        # 超过 MAX_DISTANCE2_LENGTH 的词只保存删除1个字符的变体 (和词本身)
+        long_term = 'abcdefghijkl'
+        self.assertEqual(len(TermIndex([long_term], 2, False).hashes), len(long_term) + 1)
+
+
+class VarintTest(SimpleTestCase):
+    def test_edge_values(self):
+        values = [0, 127, 128, 16383, 16384, 2 ** 31, 2 ** 32 - 1]
+        data, ends = _encode_varints(values)
+        self.assertEqual([int(end) for end in ends], [1, 2, 4, 6, 9, 14, 19])
+        self.assertEqual(data[:4], b'\x00\x7f\x80\x01')
+        self.assertEqual(_decode_varints(data).tolist(), values)
+
+    def test_empty(self):
+        data, ends = _encode_varints([])
+        self.assertEqual(data, b'')
+        self.assertEqual(len(ends), 0)
+        self.assertEqual(len(_decode_varints(data)), 0)
+
+    def test_out_of_range(self):
+        with self.assertRaises(SegmentError):
+            _encode_varints([2 ** 32])
+        with self.assertRaises(SegmentError):
+            _encode_varints([-1])
+
+    def test_postings_out_of_order(self):
+        with self.assertRaises(SegmentError):
+            _encode_postings([2], [5, 3], [0, 0], [1, 1])
+
+
+class SegmentFormatTest(SegmentAssertions, SimpleTestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def write(self, writer: SegmentWriter, name: str, **kwargs) -> SegmentReader:
+        path = os.path.join(self.dir, name)
+        writer.write(path, **kwargs)
+        return SegmentReader(path)
+
+    def test_versions(self):
+        writer = make_writer((0, 300))
+        v1 = self.write(writer, 'v1.seg', version=1)
+        v2 = self.write(writer, 'v2.seg')
+        self.assertEqual(v1.version, 1)
+        self.assertEqual(v2.version, 2)
+        self.assertSameSegment(writer, v1)
+        self.assertSameSegment(v1, v2)
+
+    def test_stored_compression(self):
+        writer = make_writer((0, 100))
+        for compression in ('zlib', 'lzma'):
+            reader = self.write(writer, '{}.seg'.format(compression), compression=compression)
+            self.assertSameSegment(writer, reader)
+            # 重新打开之后倒序读取，每次都要解压新的存储块
+            reader = SegmentReader(os.path.join(self.dir, '{}.seg'.format(compression)))
+            for doc_id in reversed(range(writer.doc_count)):
+                self.assertEqual(writer.get_clean_data(doc_id), reader.get_clean_data(doc_id))
+
+    def test_merge(self):
+        first = make_writer((0, 150))
+        second = make_writer((150, 200))
+        merged_path = os.path.join(self.dir, 'merged.seg')
+        doc_count = merge_segments('blog', 'Post', [self.write(first, 'a.seg', version=1),
+                                                     self.write(second, 'b.seg')], merged_path)
+        expected = make_writer((0, 150), (150, 200))
+        self.assertEqual(doc_count, 350)
+        self.assertSameSegment(self.write(expected, 'single.seg'), SegmentReader(merged_path))
+
+    def test_memory_size(self):
+        reader = self.write(make_writer((0, 200)), 'memory.seg')
+        self.assertEqual(reader.memory_size, 0)
+        reader.get_postings('python')
+        reader.get_clean_data(0)
+        mapped = reader.memory_size
+        self.assertGreater(mapped, 0)
+        # 模糊匹配的辅助索引也计入内存占用，和数据区域一起释放
+        term_index = get_term_index(reader)
+        self.assertEqual(reader.memory_size, mapped + term_index.memory_size)
+        reader.release()
+        self.assertIsNone(reader._term_index)
+        self.assertEqual(reader.memory_size, 0)
+        self.assertIsNot(get_term_index(reader), term_index)
@@ -1,8 +1,12 @@
 from django.urls import path
-from Search.view import views
+from .view import views
 
 urlpatterns = [
     path('', views.search),
+    path('async', views.async_search),
+    path('suggest', views.suggest),
     path('page/', views.index),
     path('page/search', views.page_search),
+    path('page/async/search', views.async_page_search),
+    path('cache/stats', views.cache_stats),
 ]
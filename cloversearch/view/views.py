@@ -1,11 +1,23 @@
 from django.shortcuts import render
-from django.core.paginator import Paginator
 from django.http import HttpResponseRedirect
+from cloversearch.cache import QueryCache
+from cloversearch.config import ConfigManager
 from cloversearch.encoder import SearchQueryObjectEncoder
+from cloversearch.boolean_query import QuerySyntaxError
 from cloversearch.query import SearchQuery
+from cloversearch.suggest import Suggester
 from .response import Response
 import time
 
+# suggest 接口一次最多返回的数量
+MAX_SUGGEST_SIZE = 100
+
+
+def _get_models(request) -> list or None:
+    """models 参数：只搜索这些model，多个用逗号分隔，例如 models=Post,blog.Note"""
+    models = [name.strip() for name in request.GET.get('models', '').split(',') if name.strip()]
+    return models or None
+
 
 def index(request):
     return render(request, 'search/index.html')
@@ -17,12 +29,33 @@ def page_search(request):
         return HttpResponseRedirect('/search/page')
     start_time = time.time()
     r['keyword'] = request.GET['w']
-    result = SearchQuery.query(request.GET['w'])
+    # 只取前10个结果，不需要对全部结果排序
+    result = SearchQuery.search(request.GET['w'], limit=10, count=True, timeout=ConfigManager.query_timeout).hydrate()
     end_time = time.time()
     took_time = end_time - start_time
     r['took_time'] = took_time
-    r['result_count'] = len(result.all)
-    r['result'] = result.all[0:10]
+    r['result_count'] = result.total
+    r['result'] = result.all
+    r['partial'] = result.partial
+
+    return render(request, 'search/result.html', context=r)
+
+
+async def async_page_search(request):
+    """page_search 的异步版本，在ASGI下使用，搜索在线程池里执行，客户端断开连接时停止搜索"""
+    r = {}
+    if 'w' not in request.GET:
+        return HttpResponseRedirect('/search/page')
+    start_time = time.time()
+    r['keyword'] = request.GET['w']
+    result = await SearchQuery.asearch(request.GET['w'], limit=10, count=True, timeout=ConfigManager.query_timeout)
+    await result.ahydrate()
+    end_time = time.time()
+    took_time = end_time - start_time
+    r['took_time'] = took_time
+    r['result_count'] = result.total
+    r['result'] = result.all
+    r['partial'] = result.partial
 
     return render(request, 'search/result.html', context=r)
 
@@ -30,25 +63,87 @@ def page_search(request):
 def search(request):
     r = Response()
     r.encoder = SearchQueryObjectEncoder
-    if 'w' not in request.GET:
+    if 'w' not in request.GET and 'q' not in request.GET:
         return r.error('NoKeyWord', '未提供搜索关键词')
     start_time = time.time()
 
-    result = SearchQuery.query(request.GET['w'])
     each_page = int(request.GET.get('each_page', '10'))
-    page = int(request.GET.get('page', '1'))
+    page = max(int(request.GET.get('page', '1')), 1)
+    # 只取当前页的结果
+    if 'q' in request.GET:
+        # 查询语言：AND / OR / NOT、"短语"、字段名:词、model:Model名称
+        try:
+            result = SearchQuery.boolean_search(request.GET['q'], limit=each_page, offset=(page - 1) * each_page,
+                                                count=True, timeout=ConfigManager.query_timeout,
+                                                models=_get_models(request)).hydrate()
+        except QuerySyntaxError as e:
+            return r.error('QuerySyntaxError', str(e))
+    else:
+        result = SearchQuery.search(request.GET['w'], limit=each_page, offset=(page - 1) * each_page, count=True,
+                                    timeout=ConfigManager.query_timeout, models=_get_models(request)).hydrate()
 
     end_time = time.time()
     took_time = end_time - start_time
 
-    if len(result.all) > 0:
-        paginator = Paginator(result.all, each_page)
-        current_page = paginator.page(page)
-        r['result'] = current_page.object_list
+    r['result'] = result.all
+    r['took_time'] = took_time
+    r['result_count'] = result.total
+    r['partial'] = result.partial
+
+    return r.ok('Search Request, Keyword:{}'.format(request.GET.get('q', request.GET.get('w'))))
+
+
+async def async_search(request):
+    """search 的异步版本，在ASGI下使用，搜索在线程池里执行，客户端断开连接时停止搜索"""
+    r = Response()
+    r.encoder = SearchQueryObjectEncoder
+    if 'w' not in request.GET and 'q' not in request.GET:
+        return r.error('NoKeyWord', '未提供搜索关键词')
+    start_time = time.time()
+
+    each_page = int(request.GET.get('each_page', '10'))
+    page = max(int(request.GET.get('page', '1')), 1)
+    if 'q' in request.GET:
+        try:
+            result = await SearchQuery.aboolean_search(request.GET['q'], limit=each_page, offset=(page - 1) * each_page,
+                                                       count=True, timeout=ConfigManager.query_timeout,
+                                                       models=_get_models(request))
+        except QuerySyntaxError as e:
+            return r.error('QuerySyntaxError', str(e))
     else:
-        r['result'] = []
+        result = await SearchQuery.asearch(request.GET['w'], limit=each_page, offset=(page - 1) * each_page, count=True,
+                                           timeout=ConfigManager.query_timeout, models=_get_models(request))
+    await result.ahydrate()
+
+    end_time = time.time()
+    took_time = end_time - start_time
 
+    r['result'] = result.all
     r['took_time'] = took_time
-    r['result_count'] = len(result.all)
+    r['result_count'] = result.total
+    r['partial'] = result.partial
+
+    return r.ok('Search Request, Keyword:{}'.format(request.GET.get('q', request.GET.get('w'))))
 
-    return r.ok('Search Request, Keyword:{}'.format(request.GET['w']))
+
+def suggest(request):
+    """搜索建议，输入时按前缀查找建立索引时预先保存的词和标题，不执行搜索"""
+    r = Response()
+    if 'w' not in request.GET:
+        return r.error('NoKeyWord', '未提供搜索关键词', status_code=400)
+    try:
+        size = int(request.GET.get('size', '0'))
+    except ValueError:
+        return r.error('InvalidParameter', 'size必须是整数', status_code=400)
+    # 不指定或者不大于0时使用配置 SUGGEST_SIZE
+    size = min(size, MAX_SUGGEST_SIZE) if size > 0 else None
+    r['suggestions'] = Suggester.get_instance().suggest(request.GET['w'], size)
+    return r.ok('Suggest Request, Prefix:{}'.format(request.GET['w']))
+
+
+def cache_stats(request):
+    """当前进程的搜索结果缓存命中统计"""
+    r = Response()
+    for key, value in QueryCache.get_instance().stats.items():
+        r[key] = value
+    return r.ok('Query Cache Stats')
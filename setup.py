@@ -17,8 +17,13 @@ setup(
     install_requires=[
         'jieba>=0.39',
         'django',
-        'ujson'
+        'ujson',
+        'numpy'
     ],
+    extras_require={
+        # 拼音匹配 (PINYIN_MATCH)
+        'pinyin': ['pypinyin'],
+    },
     url='https://github.com/Deali-Axy/CloverSearch',
     # license='GPLv3',
     author='DealiAxy',